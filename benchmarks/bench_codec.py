@@ -0,0 +1,116 @@
+"""Benchmark the raw-buffer ndarray format against the legacy pickle one
+
+Raw-like documents (final cell/positions/forces and their trajectories, forces
+all NaN as most raw records) are encoded to and decoded from BSON with each
+format, as NumpyDatabase does. "policy" is the raw-buffer format with an
+ArrayPolicy: constant arrays compacted and scaled positions in float32 (random
+positions do not compress, so no compressor).
+
+    python benchmarks/bench_codec.py --ndocs 2000 --natoms 32 --nframes 2
+"""
+import argparse
+import time
+
+import bson
+import numpy as np
+from bson.binary import USER_DEFINED_SUBTYPE, Binary
+from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
+
+from calypsokit.calydb.codec import (
+    ArrayPolicy,
+    decode_ndarray,
+    encode_ndarray,
+    encode_pickle,
+)
+from calypsokit.calydb.login import NumpyDatabase
+
+
+def make_docs(ndocs, natoms, nframes, seed=0):
+    rng = np.random.default_rng(seed)
+    docs = []
+    for _ in range(ndocs):
+        docs.append(
+            {
+                "cell": rng.random((3, 3)),
+                "positions": rng.random((natoms, 3)),
+                "scaled_positions": rng.random((natoms, 3)),
+                "forces": np.full((natoms, 3), np.nan),
+                "trajectory": {
+                    "cell": rng.random((nframes, 3, 3)),
+                    "positions": rng.random((nframes, natoms, 3)),
+                    "scaled_positions": rng.random((nframes, natoms, 3)),
+                    "forces": np.full((nframes, natoms, 3), np.nan),
+                },
+            }
+        )
+    return docs
+
+
+def codec_options(encode):
+    class Codec(TypeCodec):
+        python_type = np.ndarray
+        bson_type = Binary
+
+        def transform_python(self, value):
+            return Binary(encode(value), USER_DEFINED_SUBTYPE)
+
+        def transform_bson(self, value):
+            if value.subtype == USER_DEFINED_SUBTYPE:
+                return decode_ndarray(value)
+            return value
+
+    return CodecOptions(type_registry=TypeRegistry([Codec()]))
+
+
+def run(docs, options, policy=None):
+    start = time.perf_counter()
+    if policy is not None:
+        docs = [policy.apply(doc) for doc in docs]
+    encoded = [bson.encode(doc, codec_options=options) for doc in docs]
+    t_encode = time.perf_counter() - start
+    start = time.perf_counter()
+    [bson.decode(data, codec_options=options) for data in encoded]
+    t_decode = time.perf_counter() - start
+    return t_encode, t_decode, sum(len(data) for data in encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--ndocs", type=int, default=2000)
+    parser.add_argument("--natoms", type=int, default=32)
+    parser.add_argument("--nframes", type=int, default=2)
+    args = parser.parse_args()
+
+    docs = make_docs(args.ndocs, args.natoms, args.nframes)
+    print(f"{len(docs)} documents, {args.natoms} atoms, {args.nframes} frames")
+    results = {
+        "pickle": run(docs, codec_options(encode_pickle)),
+        "raw buffer": run(docs, codec_options(encode_ndarray)),
+        "policy": run(
+            docs,
+            NumpyDatabase.codec_options,
+            ArrayPolicy(
+                fields={
+                    "scaled_positions": {"float32": True},
+                    "trajectory.scaled_positions": {"float32": True},
+                },
+            ),
+        ),
+    }
+    for name, (t_encode, t_decode, nbytes) in results.items():
+        print(
+            f"{name:<10} : encode {len(docs) / t_encode:9.0f} doc/s, "
+            f"decode {len(docs) / t_decode:9.0f} doc/s, "
+            f"{nbytes / len(docs):7.0f} bytes/doc"
+        )
+    pe, pd, pn = results["pickle"]
+    for name in ("raw buffer", "policy"):
+        re, rd, rn = results[name]
+        print(
+            f"{name} vs pickle : encode {pe / re:.2f}x, decode {pd / rd:.2f}x, "
+            f"size {rn / pn:.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
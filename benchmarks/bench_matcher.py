@@ -0,0 +1,81 @@
+"""Benchmark StructureMatcher.fit against MemoMatcher and NativeMatcher on one group
+
+Each structure is compared to all the lower ones in its energy window, as
+UniqueFinder does, so every structure takes part in many pairs.
+
+    python benchmarks/bench_matcher.py --nbase 40 --ncopies 5 --window 30
+"""
+import argparse
+import time
+
+import numpy as np
+from pymatgen.analysis.structure_matcher import StructureMatcher
+from pymatgen.core.structure import Structure
+
+from calypsokit.analysis.matcher import MemoMatcher, NativeMatcher
+
+
+def make_group(nbase, ncopies, natoms, seed=0):
+    """nbase random La-H structures, each with ncopies perturbed copies"""
+    rng = np.random.default_rng(seed)
+    nla = natoms // 4
+    structures = []
+    for _ in range(nbase):
+        cell = np.diag(rng.uniform(3, 5, 3)) + rng.normal(0, 0.3, (3, 3))
+        species = ["La"] * nla + ["H"] * (natoms - nla)
+        base = Structure(cell, species, rng.random((natoms, 3)))
+        for icopy in range(ncopies):
+            structure = base.copy()
+            structure.perturb(0.02 * icopy)
+            structures.append(structure)
+    order = rng.permutation(len(structures))
+    return [structures[i] for i in order]
+
+
+def pairs_in_window(n, window):
+    return [(i, j) for i in range(n) for j in range(max(0, i - window), i)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--nbase", type=int, default=40)
+    parser.add_argument("--ncopies", type=int, default=5)
+    parser.add_argument("--natoms", type=int, default=8)
+    parser.add_argument("--window", type=int, default=30)
+    args = parser.parse_args()
+
+    structures = make_group(args.nbase, args.ncopies, args.natoms)
+    pairs = pairs_in_window(len(structures), args.window)
+    matcher = StructureMatcher()
+    print(f"{len(structures)} structures, {len(pairs)} pairs")
+
+    start = time.perf_counter()
+    plain = [matcher.fit(structures[i], structures[j]) for i, j in pairs]
+    t_plain = time.perf_counter() - start
+
+    memo = MemoMatcher(matcher)
+    start = time.perf_counter()
+    memoized = [memo.fit(i, structures[i], j, structures[j]) for i, j in pairs]
+    t_memo = time.perf_counter() - start
+
+    native = NativeMatcher(matcher)
+    start = time.perf_counter()
+    natived = [native.fit(i, structures[i], j, structures[j]) for i, j in pairs]
+    t_native = time.perf_counter() - start
+
+    assert plain == memoized, "verdicts of MemoMatcher differ"
+    assert plain == natived, "verdicts of NativeMatcher differ"
+    print(f"{sum(plain)} pairs matched")
+    print(f"StructureMatcher.fit : {t_plain:.2f} s")
+    print(
+        f"MemoMatcher.fit      : {t_memo:.2f} s ({memo.nreduced} reductions), "
+        f"{t_plain / t_memo:.2f}x"
+    )
+    print(
+        f"NativeMatcher.fit    : {t_native:.2f} s ({native.nfallback} fallbacks), "
+        f"{t_plain / t_native:.2f}x"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -4,36 +4,114 @@
 
 
 import logging
-from datetime import datetime
+import os
+import time
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta
 from functools import lru_cache
 from itertools import chain
 
+import numpy as np
 import pymongo
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateOne
 from joblib import Parallel, delayed
 from pymatgen.analysis.structure_matcher import StructureMatcher
 from tqdm import tqdm
 
-from calypsokit.calydb.login import login
+from calypsokit.analysis.fingerprint import FingerprintFilter
+from calypsokit.analysis.match_cache import MatchCache
+from calypsokit.analysis.matcher import MemoMatcher, NativeMatcher
+from calypsokit.analysis.scheduler import log_worker_stats, plan_tasks
+from calypsokit.calydb.login import worker_config, worker_object
 from calypsokit.calydb.queries import Pipes, QueryStructure
+from calypsokit.utils.unionfind import UnionFind
 
 logger = logging.getLogger(__name__)
 
 
+def _run_task(config, task, incremental, e_thresholds=None):
+    """Find unique of each group in one task, return results and the task stat"""
+    start = time.time()
+    finder = worker_object(config)
+    results = list(
+        chain.from_iterable(
+            finder._find_unique_in_group(group, incremental, e_thresholds)
+            for group in task
+        )
+    )
+    stat = {
+        "pid": os.getpid(),
+        "start": start,
+        "end": time.time(),
+        "nstructures": sum(group["count"] for group in task),
+    }
+    return results, stat
+
+
+def _only_duplicates(error: pymongo.errors.BulkWriteError) -> bool:
+    """Whether a BulkWriteError is made of duplicate key errors (code 11000) only"""
+    details = error.details
+    return len(details.get("writeConcernErrors", [])) == 0 and all(
+        write_error["code"] == 11000 for write_error in details.get("writeErrors", [])
+    )
+
+
 class UniqueFinder:
-    def __init__(self, rawcol, uniqcol, e_threshold=0.005, match_kwargs={}):
+    def __init__(
+        self,
+        rawcol,
+        uniqcol,
+        e_threshold=0.005,
+        match_kwargs={},
+        matcher_backend="pymatgen",
+        prefilter=True,
+        prefilter_kwargs={},
+        match_cache=None,
+        login_kwargs=None,
+        n_jobs=None,
+        chunk_size=1000,
+        max_group_size=5000,
+        write_batch_size=1000,
+    ):
         """_summary_
 
         Determine unique by enthalpy_per_atom threshold 5meV (default) and pymatgen
         StructureMatcher method match or not.
 
         1. Group structures by task and formula.
-        2. For each structure in on group, one is compared to every picked structures.
-        3. If this two structures have the same space group (1e-1) and energy differs
-        less than 5meV, then they need to *match*. Otherwise they are considered to
-        be different and pick the one directly.
-        4. If matched, they are the same, the lower energy one will replace higher one.
+        2. Sort structures in one group by enthalpy_per_atom and bucket them by space
+        group (1e-1).
+        3. From low to high enthalpy, one is compared to the picked structures in
+        its bucket whose energy is less than 5meV lower, which need to *match*.
+        Others are considered to be different.
+        4. If matched to any one, they are the same, the picked (lower energy) one is
+        kept, and this one joins its duplicate cluster.
         5. If not matched, this one is added to the picked structures.
-        6. Finally the picked structures are the uniqe structures.
+        6. Finally the picked structures are the uniqe structures. Each one is stored
+        with the _id of its cluster `members` (itself included) and `cluster_size`.
+
+        Before *match*, a pair is rejected directly if their cheap fingerprints
+        (see FingerprintFilter) clearly differ. Each structure is reduced only once in
+        a group and shared by the fingerprint and all its *match* (see MemoMatcher).
+        The number of pairs, `fit` calls and skipped `fit` calls are counted in
+        `self.counter`.
+
+        Groups are run in parallel largest-first (see scheduler.plan_tasks), tiny
+        groups are batched and huge groups are split into energy-window shards and
+        merged at last. If `match_cache` is given, the verdicts of `fit` are cached in
+        this file and reused by later runs. Each worker process logins once by itself
+        with `login_kwargs`, or with those of the database of rawcol if it was opened
+        by `login`; collections cannot be pickled to the workers.
+
+        `update` writes the results to uniqcol as soon as groups finish, in bulk
+        writes of about `write_batch_size` operations, and records the finished
+        groups in the journal collection "<uniqcol>_journal". An interrupted `update`
+        called again with the same arguments skips the finished groups.
+        `sync_deprecated` removes the records deprecated since its last run from
+        uniqcol, keeping its watermark in "<uniqcol>_sync".
+        `update_levels` finds unique for several `e_threshold` in one pass, sharing
+        the verdicts of pairs.
 
         Examples
         --------
@@ -58,11 +136,75 @@ class UniqueFinder:
             enthalpy_per_atom threshold used to determine unique, by default 0.005
         match_kwargs: dict, optional
             other kwargs for pymatgen StructureMatcher
+        matcher_backend: str, optional
+            "pymatgen" for StructureMatcher.fit, or "native" for the vectorized
+            NativeMatcher which falls back to pymatgen out of its envelope, by default
+            "pymatgen"
+        prefilter: bool, optional
+            reject pairs by fingerprints before StructureMatcher, off anyway if no
+            fingerprint check bounds the matcher (see FingerprintFilter.from_matcher),
+            by default True
+        prefilter_kwargs: dict, optional
+            kwargs for FingerprintFilter, tolerances follow the matcher by default
+        match_cache: str, optional
+            SQLite file of the persistent match verdict cache, by default None
+        login_kwargs: dict, optional
+            kwargs of `login` for each worker process to connect by itself, by
+            default those of the database of rawcol, required for n_jobs != 1 if
+            it was not opened by `login`
+        n_jobs: int, optional
+            number of parallel jobs of joblib, by default None
+        chunk_size: int, optional
+            batch groups smaller than it into one task, by default 1000
+        max_group_size: int, optional
+            split groups larger than it into shards, by default 5000
+        write_batch_size: int, optional
+            number of operations in one bulk write to uniqcol, by default 1000
         """
+        self.finder_kwargs = {
+            "e_threshold": e_threshold,
+            "match_kwargs": match_kwargs,
+            "matcher_backend": matcher_backend,
+            "prefilter": prefilter,
+            "prefilter_kwargs": prefilter_kwargs,
+            "match_cache": match_cache,
+        }
+        self.login_kwargs = login_kwargs
+        self.n_jobs = n_jobs
+        self.chunk_size = chunk_size
+        self.max_group_size = max_group_size
+        self.write_batch_size = write_batch_size
+        self.token = uuid.uuid4().hex
         self.rawcol = rawcol
         self.uniqcol = uniqcol
+        self.journal = uniqcol.database.get_collection(f"{uniqcol.name}_journal")
+        self.watermarks = uniqcol.database.get_collection(f"{uniqcol.name}_sync")
         self.e_threshold = e_threshold
         self.matcher = StructureMatcher(**match_kwargs)
+        if matcher_backend == "pymatgen":
+            self.memo = MemoMatcher(self.matcher)
+        elif matcher_backend == "native":
+            self.memo = NativeMatcher(self.matcher)
+        else:
+            raise ValueError(f"Unknown matcher_backend {matcher_backend}")
+        if prefilter:
+            self.prefilter = FingerprintFilter.from_matcher(
+                self.matcher, **prefilter_kwargs
+            )
+        else:
+            self.prefilter = None
+        if match_cache is not None:
+            self.match_cache = MatchCache(
+                match_cache, MatchCache.hash_params(match_kwargs, e_threshold)
+            )
+        else:
+            self.match_cache = None
+        self.verdicts = {}  # {(_id, _id): bool}, shared by thresholds of one group
+        self.counter = Counter()
+
+    def collections(self) -> list:
+        """Positional collection arguments to build this finder again in workers"""
+        return [self.rawcol, self.uniqcol]
 
     @lru_cache
     def group(self, mindate=None, maxdate=None):
@@ -96,26 +238,368 @@ class UniqueFinder:
             yield i_uniq_list
 
     def update(
-        self, mindate=(1, 1, 1, 0, 0, 0), maxdate=(9999, 12, 31, 0, 0, 0), *, version
+        self,
+        mindate=(1, 1, 1, 0, 0, 0),
+        maxdate=(9999, 12, 31, 0, 0, 0),
+        *,
+        version,
+        incremental=False,
+        resume=True,
+    ):
+        """Find unique records in (mindate, maxdate) and insert to uniqcol
+
+        Results are written group by group, and the finished groups are recorded in
+        the journal until the whole update is done.
+
+        Parameters
+        ----------
+        mindate, maxdate : tuple, optional
+            utc date (year, month, day, hour, minute, second, ...) of
+            'last_updated_utc'
+        version : int
+            version stored with each unique _id
+        incremental : bool, optional
+            only match the records in date range against the unique ones already in
+            uniqcol of the same task and formula. If a new record matches and is lower
+            in enthalpy, it replaces the old unique one. By default False
+        resume : bool, optional
+            skip the groups finished by an interrupted update with the same
+            arguments, by default True
+        """
+        levels = [(self.e_threshold, version, self.uniqcol)]
+        self._update(levels, mindate, maxdate, incremental, resume)
+
+    def update_levels(
+        self,
+        mindate=(1, 1, 1, 0, 0, 0),
+        maxdate=(9999, 12, 31, 0, 0, 0),
+        *,
+        levels,
+        resume=True,
     ):
+        """Find unique records in (mindate, maxdate) for several enthalpy thresholds
+        in one pass, and insert each to its own uniqcol
+
+        Each group is loaded once and swept once for each threshold, the verdict of
+        a pair is shared by all thresholds, so the matching costs about the same as
+        the run of the largest threshold. The result of each threshold is the same
+        as `update` with that `e_threshold`.
+
+        Examples
+        --------
+        >>> uniquefinder.update_levels(
+        ...     levels=[(0.005, 1, db.uniq_5meV), (0.025, 1, db.uniq_25meV)]
+        ... )
+
+        Parameters
+        ----------
+        mindate, maxdate : tuple, optional
+            utc date (year, month, day, hour, minute, second, ...) of
+            'last_updated_utc'
+        levels : list[tuple]
+            (e_threshold, version, uniqcol) of each level. Unique records are keyed
+            by the raw _id, so each level is stored in its own collection with its
+            version.
+        resume : bool, optional
+            skip the groups finished by an interrupted update with the same
+            arguments, by default True
+        """
+        levels = sorted(levels, key=lambda level: level[0])
+        self._update(levels, mindate, maxdate, False, resume)
+
+    def _update(self, levels, mindate, maxdate, incremental, resume):
+        """Find unique for each (e_threshold, version, uniqcol) level and write
+        group by group"""
         cursor = self.group(mindate, maxdate)
-        uniq_list = self.find_unique(cursor)
-        try:
-            self.uniqcol.insert_many(
-                [{"_id": uniq_id, "version": version} for uniq_id in uniq_list],
+        for _, _, uniqcol in levels:
+            self.maintain_indexes(uniqcol)
+        if incremental:
+            self.maintain_group_keys()
+        e_thresholds = [e_threshold for e_threshold, _, _ in levels]
+        targets = {
+            e_threshold: (version, uniqcol) for e_threshold, version, uniqcol in levels
+        }
+        run = "|".join(
+            [f"{e}:{v}:{col.name}" for e, v, col in levels]
+            + [str(mindate), str(maxdate), str(incremental)]
+        )
+        if resume:
+            finished = self.finished_groups(run, e_thresholds)
+            if len(finished) > 0:
+                logger.info(f"Resume: skip {len(finished)} finished groups")
+                cursor = [
+                    group
+                    for group in cursor
+                    if tuple(group["_id"].values()) not in finished
+                ]
+        else:
+            self.journal.delete_many({"run": run})
+
+        requests = {e_threshold: [] for e_threshold in e_thresholds}
+        keys, stat = [], {e_threshold: Counter() for e_threshold in e_thresholds}
+        for res in self._find_unique(cursor, incremental, e_thresholds):
+            e_threshold = res["e_threshold"]
+            version = targets[e_threshold][0]
+            requests[e_threshold].extend(self._result_requests(res, version))
+            keys.append((res["_id"], e_threshold))
+            stat[e_threshold]["unique"] += len(res["unique"])
+            stat[e_threshold]["dropped"] += len(res["dropped"])
+            if sum(map(len, requests.values())) >= self.write_batch_size:
+                self._commit(run, targets, requests, keys)
+                requests = {e_threshold: [] for e_threshold in e_thresholds}
+                keys = []
+        self._commit(run, targets, requests, keys)
+        for e_threshold, (_, uniqcol) in targets.items():
+            logger.info(
+                f"{uniqcol.name} (e_threshold {e_threshold}): "
+                f"{stat[e_threshold]['unique']} new unique records, "
+                f"{stat[e_threshold]['dropped']} unique records replaced by lower ones."
+            )
+        self.journal.delete_many({"run": run})
+
+    @staticmethod
+    def _result_requests(res, version):
+        """Write requests of one group result to uniqcol"""
+        requests = []
+        if len(res["dropped"]) > 0:
+            requests.append(DeleteMany({"_id": {"$in": res["dropped"]}}))
+        new_unique = set(res["unique"])
+        for uniq_id, members in res["members"].items():
+            if uniq_id in new_unique:
+                doc = {
+                    "_id": uniq_id,
+                    "version": version,
+                    **res["_id"],
+                    "members": members,
+                    "cluster_size": len(members),
+                }
+                requests.append(InsertOne(doc))
+            else:
+                upd = {"$set": {"members": members, "cluster_size": len(members)}}
+                requests.append(UpdateOne({"_id": uniq_id}, upd))
+        return requests
+
+    def _commit(self, run, targets, requests, keys):
+        """Bulk write requests to the uniqcol of each level, then journal the levels
+        of these groups as finished
+
+        Duplicate _id are skipped, any other write error is raised before the
+        journal, so that these groups are run again on resume."""
+        for e_threshold, level_requests in requests.items():
+            if len(level_requests) == 0:
+                continue
+            uniqcol = targets[e_threshold][1]
+            try:
+                uniqcol.bulk_write(level_requests, ordered=False)
+            except pymongo.errors.BulkWriteError as error:
+                if not _only_duplicates(error):
+                    raise
+                logger.info("Duplicate _id encountered. Skipped duplicate documents.")
+            logger.log(
+                19, f"{len(level_requests)} operations written to {uniqcol.name}"
+            )
+        if len(keys) > 0:
+            now = datetime.utcnow()
+            self.journal.bulk_write(
+                [
+                    UpdateOne(
+                        {"run": run, "group": key},
+                        {
+                            "$addToSet": {"levels": e_threshold},
+                            "$set": {"finished_utc": now},
+                        },
+                        upsert=True,
+                    )
+                    for key, e_threshold in keys
+                ],
                 ordered=False,
             )
-            logger.info("Documents inserted successfully.")
-        except pymongo.errors.DuplicateKeyError:
-            logger.info("Duplicate _id encountered. Skipped duplicate documents.")
 
-    def find_unique(self, cursor):
-        results = Parallel(backend="multiprocessing")(
-            delayed(self.find_unique_in_group)(cur) for cur in tqdm(cursor)
+    def finished_groups(self, run, e_thresholds) -> set:
+        """Keys (tuple of the group _id values) of the groups already written for all
+        `e_thresholds` by the interrupted `run`"""
+        return {
+            tuple(record["group"].values())
+            for record in self.journal.find(
+                {"run": run, "levels": {"$all": e_thresholds}}, {"group": 1}
+            )
+        }
+
+    def maintain_indexes(self, uniqcol=None):
+        """Index uniqcol (self.uniqcol by default) by group keys and cluster
+        members, and rawcol by the keyset of `sync_deprecated`"""
+        uniqcol = self.uniqcol if uniqcol is None else uniqcol
+        self.rawcol.create_index(
+            [("deprecated", 1), ("last_updated_utc", 1), ("_id", 1)],
+            name="deprecated_1_last_updated_utc_1__id_1",
+        )
+        uniqcol.create_index([("task", 1), ("formula", 1)], name="task_1_formula_1")
+        uniqcol.create_index([("members", 1)], name="members_1")
+        self.journal.create_index(
+            [("run", 1), ("group", 1)], name="run_1_group_1", unique=True
         )
-        uniq_list = list(chain.from_iterable(results))
+
+    def representative_of(self, _id):
+        """_id of the unique record whose cluster contains `_id`, None if not found"""
+        record = self.uniqcol.find_one({"members": _id}, {"_id": 1})
+        return None if record is None else record["_id"]
+
+    def maintain_group_keys(self):
+        """Fill task and formula to the unique records inserted without them"""
+        pipeline = [
+            {"$match": {"task": {"$exists": False}}},
+            {
+                "$lookup": {
+                    "from": self.rawcol.name,
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "raw",
+                }
+            },
+            {"$unwind": "$raw"},
+            {
+                "$project": {
+                    "task": "$raw.trajectory.source_dir",
+                    "formula": "$raw.formula",
+                }
+            },
+            {
+                "$merge": {
+                    "into": self.uniqcol.name,
+                    "on": "_id",
+                    "whenMatched": "merge",
+                    "whenNotMatched": "discard",
+                }
+            },
+        ]
+        self.uniqcol.aggregate(pipeline)
+
+    def find_unique(self, cursor):
+        results = self._find_unique(cursor)
+        uniq_list = list(chain.from_iterable(res["unique"] for res in results))
         return uniq_list
 
+    def _find_unique(self, cursor, incremental=False, e_thresholds=None):
+        """Yield the result of each group (and each of `e_thresholds`) as soon as it
+        finishes, shards of huge groups are held until all of them finish and yield
+        merged"""
+        tasks = plan_tasks(cursor, self.chunk_size, self.max_group_size)
+
+        shards = {}
+        for res in self._run_tasks(tasks, incremental, e_thresholds):
+            if "shard" in res:
+                key = (*res["_id"].values(), res["e_threshold"])
+                shards.setdefault(key, []).append(res)
+            else:
+                self.counter.update(res["counter"])
+                yield res
+
+        # merge the shards of huge groups
+        merge_groups = [self._merge_group(shard_res) for shard_res in shards.values()]
+        if len(merge_groups) > 0:
+            logger.info(f"Merging shards of {len(merge_groups)} groups")
+            tasks = plan_tasks(merge_groups, self.chunk_size, float("inf"))
+            for res in self._run_tasks(tasks, False):
+                self._merge_shard_members(res)
+                self.counter.update(res["counter"])
+                yield res
+        self.log_counter()
+
+    def _worker_config(self):
+        """This finder if the tasks run in this process, else the picklable config
+        for each worker to login and build its own finder"""
+        return worker_config(
+            self,
+            self.token,
+            self.collections(),
+            self.finder_kwargs,
+            self.login_kwargs,
+            self.n_jobs,
+        )
+
+    def _run_tasks(self, tasks, incremental, e_thresholds=None):
+        """Run tasks in parallel, yield group results in the order they finish"""
+        config = self._worker_config()
+        start = time.time()
+        returns = Parallel(
+            n_jobs=self.n_jobs,
+            backend="loky",
+            batch_size=1,
+            return_as="generator_unordered",
+        )(delayed(_run_task)(config, task, incremental, e_thresholds) for task in tasks)
+        stats = []
+        for results, stat in tqdm(returns, total=len(tasks)):
+            stats.append(stat)
+            yield from results
+        log_worker_stats(stats, time.time() - start)
+
+    @staticmethod
+    def _merge_group(shard_res):
+        """Merge the unique ones of each shard into a new group, those from the same
+        shard are labeled to never be matched again"""
+        group = {
+            "_id": shard_res[0]["_id"],
+            "e_threshold": shard_res[0]["e_threshold"],
+            "ids": [],
+            "enth_list": [],
+            "labels": [],
+            "members": {},
+            "shard_dropped": [],
+            "shard_members": {},
+            "shard_counter": Counter(),
+        }
+        for res in shard_res:
+            group["ids"].extend(res["unique"])
+            group["enth_list"].extend(res["enth_list"])
+            group["labels"].extend([res["shard"][0]] * len(res["unique"]))
+            group["shard_dropped"].extend(res["dropped"])
+            group["shard_counter"].update(res["counter"])
+            new_unique = set(res["unique"])
+            for uniq_id, members in res["members"].items():
+                if uniq_id in new_unique:
+                    group["members"][uniq_id] = members
+                else:  # unique ones in uniqcol, grown in more than one shard
+                    shard_members = group["shard_members"].setdefault(uniq_id, [])
+                    shard_members.extend(m for m in members if m not in shard_members)
+        group["count"] = len(group["ids"])
+        return group
+
+    @staticmethod
+    def _merge_shard_members(res):
+        """Put the dropped, counter and the clusters of unique ones in uniqcol found
+        by each shard back to the merged result"""
+        res["dropped"] = res.pop("shard_dropped")
+        res["counter"].update(res.pop("shard_counter"))
+        dropped = set(res["dropped"])
+        owner = {m: root for root, members in res["members"].items() for m in members}
+        for uniq_id, members in res.pop("shard_members").items():
+            if uniq_id in dropped:
+                uniq_id = owner[uniq_id]
+            kept = res["members"].setdefault(uniq_id, [])
+            kept.extend(m for m in members if m not in kept)
+
+    def log_counter(self):
+        logger.info(
+            f"Compared {self.counter['pairs']} pairs, "
+            f"skipped {self.counter['skipped']} fit by prefilter, "
+            f"called {self.counter['fit']} fit"
+        )
+        if self.counter["memo_hit"] > 0:
+            logger.info(
+                f"Reused {self.counter['memo_hit']} verdicts of other thresholds"
+            )
+        if self.match_cache is not None:
+            ncached = self.counter["cache_hit"] + self.counter["cache_miss"]
+            logger.info(
+                f"Match cache hit {self.counter['cache_hit']} of {ncached} "
+                f"({self.counter['cache_hit'] / max(ncached, 1):.1%})"
+            )
+        if self.prefilter is not None and self.prefilter.verify:
+            logger.info(
+                f"Prefilter rejected {self.counter['rejected']} pairs, "
+                f"{self.counter['false_rejected']} of them are matched by fit"
+            )
+
     def find_unique_in_group(self, task_formula_group):
         """Find the unique structures' _id in task_formula group
 
@@ -126,52 +610,445 @@ class UniqueFinder:
 
         Returns
         -------
-        _type_
-            _description_
+        list
+            unique _id list
         """
-        logger.log(19, f"Finding unique in {task_formula_group['_id']['task']}")
-        ids = task_formula_group["ids"]
-        projection = {"symmetry.1e-1.number": 1, "enthalpy_per_atom": 1}
+        (res,) = self._find_unique_in_group(task_formula_group)
+        self.counter.update(res["counter"])
+        return res["unique"]
+
+    def _find_unique_in_group(
+        self, task_formula_group, incremental=False, e_thresholds=None
+    ):
+        """Find unique in one group, for each of `e_thresholds` (by default the
+        "e_threshold" of the group or self.e_threshold)
+
+        Returns
+        -------
+        list[dict]
+            result of each e_threshold,
+            {"_id": <task, formula>, "e_threshold": float,
+            "unique": [<new unique _id>, ...],
+            "enth_list": [<enthalpy_per_atom of unique>, ...],
+            "dropped": [<replaced unique _id>, ...],
+            "members": {<unique _id>: [<_id in this cluster>, ...]},
+            "counter": Counter}, with "shard" or "shard_*" copied from the group if
+            exist. "members" has the new unique ones and those in uniqcol whose
+            cluster grows.
+        """
+        key = task_formula_group["_id"]
+        logger.log(19, f"Finding unique in {key}")
+        if e_thresholds is None:
+            e_thresholds = [task_formula_group.get("e_threshold", self.e_threshold)]
+        fingerprints = {}  # _id: fingerprint, computed once in this group
+        ids = list(task_formula_group["ids"])
+        enth_list = list(task_formula_group["enth_list"])
+        projection = {
+            "symmetry.1e-1.number": 1,
+            "enthalpy_per_atom": 1,
+            "deprecated": 1,
+        }
+
+        # unique ones already in uniqcol of this group, {_id: members}
+        representatives = {}
+        if incremental:
+            representatives = {
+                record["_id"]: record.get("members", [record["_id"]])
+                for record in self.uniqcol.find(
+                    {"task": key["task"], "formula": key["formula"]},
+                    {"_id": 1, "members": 1},
+                )
+            }
 
         qs = QueryStructure(self.rawcol, projection)
-        [qs.find({"_id": {"$in": ids}})]  # cache all structures in this group
+        # cache all structures in this group
+        missing = set(qs.prefetch(ids + list(representatives)))
+
+        # deprecated ones are left to maintain_deprecated
+        representatives = {
+            _id: members
+            for _id, members in representatives.items()
+            if _id not in missing and not qs[_id].get("deprecated", False)
+        }
+        # pairs with the same label are known to be different
+        labels = dict(zip(ids, task_formula_group.get("labels", [None] * len(ids))))
+        in_group = set(ids)
+        for _id in representatives:
+            labels[_id] = "uniqcol"
+            if _id not in in_group:
+                ids.append(_id)
+                enth_list.append(qs[_id]["enthalpy_per_atom"])
+
+        if self.match_cache is not None:
+            self.match_cache.preload(ids)
+        results = []
+        for e_threshold in e_thresholds:
+            counter = Counter()
+            clusters = UnionFind(ids)
+            unique_list = self._sweep(
+                ids, enth_list, qs, fingerprints, counter, labels, clusters, e_threshold
+            )
+            res = self._group_result(
+                task_formula_group,
+                ids,
+                enth_list,
+                unique_list,
+                clusters,
+                representatives,
+            )
+            res["e_threshold"] = e_threshold
+            res["counter"] = counter
+            results.append(res)
+        if self.match_cache is not None:
+            self.match_cache.flush()
+        self.memo.clear()
+        self.verdicts = {}
+        return results
+
+    @staticmethod
+    def _group_result(
+        task_formula_group, ids, enth_list, unique_list, clusters, representatives
+    ):
+        """Result of one sweep, members merged before are expanded"""
+        unique_set = set(unique_list)
+        enth_map = dict(zip(ids, enth_list))
+        new_unique = [_id for _id in unique_list if _id not in representatives]
+
+        # expand members merged before, by shards or in uniqcol
+        prior = task_formula_group.get("members", {}) | representatives
+        members = {}
+        for root, cluster in clusters.groups().items():
+            if root in representatives and len(cluster) == 1:
+                continue  # untouched unique ones in uniqcol
+            members[root] = list(
+                dict.fromkeys(
+                    chain.from_iterable(prior.get(_id, [_id]) for _id in cluster)
+                )
+            )
+        res = {
+            "_id": task_formula_group["_id"],
+            "unique": new_unique,
+            "enth_list": [enth_map[_id] for _id in new_unique],
+            "dropped": [_id for _id in representatives if _id not in unique_set],
+            "members": members,
+        }
+        for k in ("shard", "shard_dropped", "shard_members", "shard_counter"):
+            if k in task_formula_group:
+                res[k] = task_formula_group[k]
+        return res
+
+    def _sweep(
+        self,
+        ids,
+        enth_list,
+        qs,
+        fingerprints,
+        counter,
+        labels={},
+        clusters=None,
+        e_threshold=None,
+    ):
+        """Sort by enthalpy and sweep with a window of `e_threshold` in each bucket
+
+        Structures are visited from low to high enthalpy and bucketed by space group
+        (1e-1). Each one is only compared to the unique ones in its bucket whose
+        enthalpy is within `e_threshold`, so the first of a matched set is always the
+        lowest in enthalpy and never needs to be replaced.
+
+        Parameters
+        ----------
+        ids : list
+            _id list of this group
+        enth_list : list
+            enthalpy_per_atom of each _id
+        qs : QueryStructure
+            query and cache of the structures
+        fingerprints, counter : dict, Counter
+            fingerprint cache and counter of this group
+        labels : dict, optional
+            {_id: label}, pairs with the same label (not None) are already known to be
+            different and never matched, by default empty
+        clusters : UnionFind, optional
+            matched one is merged into the cluster of the unique one, by default None
+        e_threshold : float, optional
+            width of the window, by default self.e_threshold
+
+        Returns
+        -------
+        list
+            unique _id list in ascending enthalpy
+        """
+        if e_threshold is None:
+            e_threshold = self.e_threshold
+        enth_arr = np.array(enth_list, dtype=float)
+        order = np.argsort(enth_arr, kind="stable")
 
         unique_list = []  # _id
-        for i_id in ids:
-            i_structure = qs[i_id]["_structure_"]
+        buckets = {}  # spg number: deque of (_id, enthalpy) in window
+        for idx in order:
+            i_id, i_enth = ids[idx], enth_arr[idx]
             i_properties = qs[i_id]
-            for j_id in unique_list:
-                j_structure = qs[j_id]["_structure_"]
-                j_properties = qs[j_id]
-                same_sym = (
-                    i_properties["symmetry"]["1e-1"]["number"]
-                    == j_properties["symmetry"]["1e-1"]["number"]
-                )
-                d_e = (
-                    i_properties["enthalpy_per_atom"]
-                    - j_properties["enthalpy_per_atom"]
-                )
-                # only compare with those with same symmetry and energy is close
-                if same_sym and abs(d_e) < self.e_threshold:
-                    match = self.matcher.fit(i_structure, j_structure)
-                    # match, replace to the lowest energy one
-                    if match:
-                        if d_e < 0:
-                            unique_list.remove(j_id)
-                            unique_list.append(i_id)
-                        break
-                    # do not match, add
-                    else:
-                        unique_list.append(i_id)
-                        break
-                # otherwise treat as a different one
+            # error enthalpy is never compared, treat as a different one
+            if np.isnan(i_enth):
+                unique_list.append(i_id)
+                continue
+            bucket = buckets.setdefault(
+                i_properties["symmetry"]["1e-1"]["number"], deque()
+            )
+            # slide the window, drop those lower than i_enth - e_threshold
+            while bucket and i_enth - bucket[0][1] >= e_threshold:
+                bucket.popleft()
+            i_label = labels.get(i_id, None)
+            window = [
+                j_id
+                for j_id, _ in bucket
+                if i_label is None or i_label != labels.get(j_id, None)
+            ]
+            j_id = self._match_window(
+                i_id, i_properties, window, qs, fingerprints, counter
+            )
             # do not match to any one, add
-            else:
+            if j_id is None:
+                bucket.append((i_id, i_enth))
                 unique_list.append(i_id)
+            elif clusters is not None:
+                clusters.union(j_id, i_id)
         return unique_list
 
+    @staticmethod
+    def _verdict_key(i_id, j_id):
+        return (i_id, j_id) if str(i_id) < str(j_id) else (j_id, i_id)
+
+    def _match_window(self, i_id, i_record, window, qs, fingerprints, counter):
+        """First _id of `window` matching `i_id`, None if none
+
+        Each pair in order is looked up in the verdicts of this group, then in the
+        match cache, then prefiltered by fingerprints. The pairs left, up to the
+        first one known to match, are fitted together by one `fit_many`; those
+        after the first match among them are fitted in vain, the price of the
+        batch. The records are of QueryStructure, `_structure_` is only read (and
+        built) when the pair is fingerprinted or fitted.
+        """
+        pending = []  # (key, j_id, j_record, rejected) to fit, in window order
+        decided = None  # first _id decided as matched without a fit
+        for j_id in window:
+            counter["pairs"] += 1
+            key = self._verdict_key(i_id, j_id)
+            if key in self.verdicts:
+                counter["memo_hit"] += 1
+                match = self.verdicts[key]
+            else:
+                j_record = qs[j_id]
+                match, rejected = self._prejudge(
+                    i_id, i_record, j_id, j_record, fingerprints, counter
+                )
+                if match is None:
+                    pending.append((key, j_id, j_record, rejected))
+                    continue
+                self.verdicts[key] = match
+            if match:
+                decided = j_id
+                break
+        if len(pending) > 0:
+            others = [
+                (j_id, j_record, rejected) for _, j_id, j_record, rejected in pending
+            ]
+            matches = self._fit_many(i_id, i_record, others, counter)
+            for (key, _, _, _), match in zip(pending, matches):
+                self.verdicts[key] = match
+            for (_, j_id, _, _), match in zip(pending, matches):
+                if match:
+                    return j_id
+        return decided
+
+    def _prejudge(self, i_id, i_record, j_id, j_record, fingerprints, counter):
+        """Verdict by the match cache or the prefilter, None if the pair is to fit,
+        and whether the prefilter rejected it (still fitted if verify)"""
+        if self.match_cache is not None:
+            match = self.match_cache.get(i_id, j_id)
+            if match is not None:
+                counter["cache_hit"] += 1
+                return match, False
+            counter["cache_miss"] += 1
+        if self.prefilter is not None:
+            i_structure, j_structure = i_record["_structure_"], j_record["_structure_"]
+            for _id, structure in ((i_id, i_structure), (j_id, j_structure)):
+                if _id not in fingerprints:
+                    fingerprints[_id] = self.prefilter.fingerprint(
+                        structure, self._shared_reduced(_id, structure)
+                    )
+            if self.prefilter.differ(fingerprints[i_id], fingerprints[j_id]):
+                counter["rejected"] += 1
+                if not self.prefilter.verify:
+                    counter["skipped"] += 1
+                    return False, True
+                return None, True
+        return None, False
+
+    def _shared_reduced(self, _id, structure):
+        """Reduced structure of the matcher if the prefilter reduces the same way"""
+        if (
+            self.prefilter.primitive_cell == self.matcher._primitive_cell
+            and not self.matcher._ignored_species
+        ):
+            return self.memo.reduced_structure(_id, structure)
+        return None
+
+    def _fit_many(self, i_id, i_record, others, counter):
+        """Fit i to each (j_id, j_record, rejected) of others in one call"""
+        counter["fit"] += len(others)
+        matches = self.memo.fit_many(
+            i_id,
+            i_record["_structure_"],
+            [(j_id, j_record["_structure_"]) for j_id, j_record, _ in others],
+        )
+        for (j_id, _, rejected), match in zip(others, matches):
+            if self.match_cache is not None:
+                self.match_cache.put(i_id, j_id, match)
+            if rejected and match:
+                counter["false_rejected"] += 1
+                logger.warning(f"Prefilter rejected matched pair {i_id} {j_id}")
+        return matches
+
+    def sync_deprecated(self, batch_size=None, lag=600.0) -> dict:
+        """Remove the records deprecated since the last sync from uniqcol
+
+        Deprecated raw records are scanned in (last_updated_utc, _id) order from
+        the watermark saved in "<uniqcol>_sync" by the last run, `batch_size` at a
+        time. A deprecated member is pruned from its cluster; a deprecated unique
+        record is replaced by the lowest-enthalpy member left in its cluster, or
+        deleted if none is left. The watermark is saved after each batch, so an
+        interrupted sync resumes where it stopped. Records deprecated without
+        `last_updated_utc` are never seen, `maintain_deprecated` handles them.
+
+        `last_updated_utc` is stamped by the clients and a write becomes visible
+        some time after its stamp, so each run starts `lag` seconds before the
+        watermark; records read twice are already synced and change nothing. The
+        index of the scan is created by `maintain_indexes`.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            deprecated records per read and bulk_write, by default
+            `write_batch_size`
+        lag : float, optional
+            seconds re-read before the watermark, longer than the clock skew of the
+            clients and their longest deprecation write, by default 600.0
+
+        Returns
+        -------
+        dict
+            {"nrecords": deprecated records read, "pruned": clusters shrunk,
+            "promoted": unique records replaced, "removed": unique records
+            deleted, "seconds": ...}
+        """
+        batch_size = self.write_batch_size if batch_size is None else batch_size
+        start = time.perf_counter()
+        watermark = self.watermarks.find_one({"_id": "deprecated"})
+        if watermark is None:
+            watermark = {"last_updated_utc": datetime.min, "last_id": None}
+        else:
+            since = watermark["last_updated_utc"] - timedelta(seconds=lag)
+            watermark = watermark | {"last_updated_utc": since}
+        stat = Counter({"nrecords": 0, "pruned": 0, "promoted": 0, "removed": 0})
+        while True:
+            last_updated, last_id = watermark["last_updated_utc"], watermark["last_id"]
+            filter = {"deprecated": True, "last_updated_utc": {"$gt": last_updated}}
+            if last_id is not None:
+                filter = {
+                    "deprecated": True,
+                    "$or": [
+                        {"last_updated_utc": {"$gt": last_updated}},
+                        {"last_updated_utc": last_updated, "_id": {"$gt": last_id}},
+                    ],
+                }
+            batch = list(
+                self.rawcol.find(filter, {"last_updated_utc": 1})
+                .sort([("last_updated_utc", 1), ("_id", 1)])
+                .limit(batch_size)
+            )
+            if len(batch) == 0:
+                break
+            requests = self._sync_requests([record["_id"] for record in batch], stat)
+            if len(requests) > 0:
+                # ordered, an old unique record is deleted only after its successor
+                # is written, a failed write stops before losing the cluster
+                self.uniqcol.bulk_write(requests)
+            watermark = {
+                "last_updated_utc": batch[-1]["last_updated_utc"],
+                "last_id": batch[-1]["_id"],
+                "synced_utc": datetime.utcnow(),
+            }
+            self.watermarks.replace_one({"_id": "deprecated"}, watermark, upsert=True)
+            stat["nrecords"] += len(batch)
+        stat = dict(stat, seconds=time.perf_counter() - start)
+        logger.info(
+            f"Synced {stat['nrecords']} deprecated records to {self.uniqcol.name}: "
+            f"{stat['pruned']} clusters pruned, {stat['promoted']} promoted, "
+            f"{stat['removed']} removed in {stat['seconds']:.2f} s"
+        )
+        return stat
+
+    def _sync_requests(self, ids, stat) -> list:
+        """Write requests to uniqcol removing the deprecated `ids`"""
+        deprecated = set(ids)
+        requests = []
+        orphans = []  # (unique record, its members not in this batch)
+        for record in self.uniqcol.find(
+            {"$or": [{"_id": {"$in": ids}}, {"members": {"$in": ids}}]}
+        ):
+            members = record.get("members", [record["_id"]])
+            remaining = [_id for _id in members if _id not in deprecated]
+            if record["_id"] in deprecated:
+                orphans.append((record, remaining))
+            elif len(remaining) < len(members):
+                upd = {"$set": {"members": remaining, "cluster_size": len(remaining)}}
+                requests.append(UpdateOne({"_id": record["_id"]}, upd))
+                stat["pruned"] += 1
+        # members deprecated in a later batch are dropped here as well
+        candidates = {
+            record["_id"]: record
+            for record in self.rawcol.find(
+                {
+                    "_id": {"$in": list(chain.from_iterable(m for _, m in orphans))},
+                    "deprecated": {"$ne": True},
+                },
+                {"enthalpy_per_atom": 1, "trajectory.source_dir": 1, "formula": 1},
+            )
+        }
+        enthalpy = {
+            _id: (
+                np.inf
+                if record.get("enthalpy_per_atom") is None
+                else record["enthalpy_per_atom"]
+            )
+            for _id, record in candidates.items()
+        }
+        for record, remaining in orphans:
+            members = [_id for _id in remaining if _id in enthalpy]
+            if len(members) == 0:
+                requests.append(DeleteOne({"_id": record["_id"]}))
+                stat["removed"] += 1
+                continue
+            successor = min(members, key=enthalpy.get)
+            raw = candidates[successor]
+            doc = {
+                "_id": successor,
+                "version": record.get("version"),
+                "task": raw.get("trajectory", {}).get("source_dir"),
+                "formula": raw.get("formula"),
+                "members": members,
+                "cluster_size": len(members),
+            }
+            # upsert, the successor may be written by an interrupted sync already
+            requests.append(ReplaceOne({"_id": successor}, doc, upsert=True))
+            requests.append(DeleteOne({"_id": record["_id"]}))
+            stat["promoted"] += 1
+        return requests
+
     def maintain_deprecated(self):
-        """delete the deprecated records in uniqcol"""
+        """delete the deprecated records in uniqcol, a full scan of all deprecated
+        records, see `sync_deprecated` for the incremental one"""
         pipeline = [{"$match": {"deprecated": True}}]
         pipeline += Pipes.unique_records(self.uniqcol.name)
         pipeline += [{"$group": {"_id": None, "ids": {"$push": "$_id"}}}]
@@ -0,0 +1,252 @@
+"""Cheap invariant fingerprints of structures
+
+Used as a prefilter in front of pymatgen StructureMatcher: each structure is
+fingerprinted once, and a pair whose fingerprints clearly differ is rejected
+without calling the (expensive) `StructureMatcher.fit`.
+"""
+import logging
+
+import numpy as np
+from pymatgen.analysis.structure_matcher import (
+    ElementComparator,
+    FrameworkComparator,
+    SpeciesComparator,
+    StructureMatcher,
+)
+from pymatgen.core.structure import Structure
+
+logger = logging.getLogger(__name__)
+
+
+class FingerprintFilter:
+    def __init__(
+        self,
+        vpa_rtol=None,
+        lattice_rtol=0.2,
+        dist_tol=2.4,
+        rcut=2.0,
+        nbins=40,
+        primitive_cell=True,
+        same_nsites=True,
+        species=True,
+        verify=False,
+    ):
+        """Reject structure pairs by cheap invariant fingerprints
+
+        The fingerprint of one structure contains
+
+        - volume per atom
+        - sorted lengths of the niggli reduced (primitive) lattice, in unit of
+          (V/N)^(1/3)
+        - distance histogram of each species pair (or of all sites if not
+          `species`) within `rcut`, in pairs per atom, distance in unit of (V/N)^(1/3)
+
+        Two fingerprints *differ* if the numbers of sites of the reduced cells are
+        different (if `same_nsites`), or any of the three descriptors is out of its
+        tolerance. Because
+        of the unit (V/N)^(1/3), the lattice and distance descriptors are invariant
+        to the volume scaling of StructureMatcher.
+
+        The tolerances are bounds, not estimates: a pair StructureMatcher accepts must
+        never differ. Two matching structures have their sites paired, so their
+        atom pairs are paired too, and each pair distance changes by the lattice
+        strain and the two site displacements. The distance check compares the
+        Wasserstein-1 distance of the two histograms (pairs moved beyond `rcut` stay
+        at `rcut`), per pair of both structures, with that change.
+
+        Examples
+        --------
+        >>> fpfilter = FingerprintFilter.from_matcher(StructureMatcher())
+        >>> fp1 = fpfilter.fingerprint(structure1)
+        >>> fp2 = fpfilter.fingerprint(structure2)
+        >>> fpfilter.differ(fp1, fp2)
+        False
+
+        Parameters
+        ----------
+        vpa_rtol : float, optional
+            relative tolerance of volume per atom, None to skip this check
+            (StructureMatcher with `scale=True` ignores the volume), by default None
+        lattice_rtol : float, optional
+            relative tolerance of each sorted reduced lattice length, by default 0.2
+        dist_tol : float, optional
+            maximum change of one pair distance between two matching structures, in
+            unit of (V/N)^(1/3), None to skip this check, by default 2.4 (the bound
+            of a default StructureMatcher)
+        rcut : float, optional
+            cutoff of distance histograms, in unit of (V/N)^(1/3), by default 2.0
+        nbins : int, optional
+            number of bins of distance histograms, by default 40
+        primitive_cell : bool, optional
+            reduce to the primitive cell before computing lattice descriptor, keep it
+            the same as StructureMatcher, by default True
+        same_nsites : bool, optional
+            reject reduced cells of different numbers of sites, False if the matcher
+            attempts supercells, by default True
+        species : bool, optional
+            one distance histogram per species pair, False for one of all sites if
+            the matcher ignores the species (FrameworkComparator), by default True
+        verify : bool, optional
+            only count the rejection but do not skip the matcher, to check the filter
+            against StructureMatcher on a reference dataset, by default False
+        """
+        self.vpa_rtol = vpa_rtol
+        self.lattice_rtol = lattice_rtol
+        self.dist_tol = dist_tol
+        self.rcut = rcut
+        self.nbins = nbins
+        self.primitive_cell = primitive_cell
+        self.same_nsites = same_nsites
+        self.species = species
+        self.verify = verify
+
+    @classmethod
+    def from_matcher(cls, matcher: StructureMatcher, margin=1.5, **kwargs):
+        """Build a filter whose tolerances are bounded by the StructureMatcher's
+
+        The matcher maps lattice vectors within `ltol` of length and `angle_tol` of
+        angle, so a lattice vector is strained by at most
+        `strain = (1 + ltol) * (1 + angle_tol in rad) - 1`, and it moves every site
+        by at most `stol` after scaling to the same volume.
+
+        - `lattice_rtol` is `ltol`: the sorted niggli lengths are the successive
+          minima of the lattice, which the mapped lengths bound within `ltol`.
+        - `dist_tol` is `margin * (1 + strain) * (2 * stol + strain * rcut)`: the
+          displacements of the two sites plus the strain of a distance below `rcut`,
+          `(1 + strain)` covering the unit of the average lattice.
+        - Without volume scaling, the volume per atom is checked within
+          `(1 + strain) ** 3 - 1` and `lattice_rtol` is widened by the unit ratio.
+
+        The bounds hold only for what the matcher compares:
+
+        - with `attempt_supercell`, cells of different sizes match, the numbers of
+          sites and the lattices are not checked; the per-atom volume and distance
+          histograms of a supercell are those of its cell, so they still are.
+        - with FrameworkComparator, the histograms are of all sites, with a
+          comparator other than SpeciesComparator and ElementComparator the
+          distances are not checked.
+        - with `allow_subset` or `ignored_species`, the structures matched are not
+          the ones fingerprinted, no check is a bound.
+
+        Any given kwargs overwrite these defaults.
+
+        Returns
+        -------
+        FingerprintFilter or None
+            None if no fingerprint check is a bound of this matcher, i.e. no
+            prefilter
+        """
+        if matcher._subset or len(matcher._ignored_species) > 0:
+            return None
+        strain = (1 + matcher.ltol) * (1 + np.radians(matcher.angle_tol)) - 1
+        defaults = {
+            "vpa_rtol": None,
+            "lattice_rtol": matcher.ltol,
+            "primitive_cell": matcher._primitive_cell,
+        }
+        if not matcher._scale:
+            defaults["vpa_rtol"] = margin * ((1 + strain) ** 3 - 1)
+            defaults["lattice_rtol"] = margin * ((1 + matcher.ltol) * (1 + strain) - 1)
+        if matcher._supercell:
+            defaults["lattice_rtol"] = None
+            defaults["same_nsites"] = False
+        comparator = matcher._comparator
+        if isinstance(comparator, FrameworkComparator):
+            defaults["species"] = False
+        elif not isinstance(comparator, (SpeciesComparator, ElementComparator)):
+            defaults["dist_tol"] = None
+        fpfilter = cls(**(defaults | kwargs))
+        if "dist_tol" not in kwargs and "dist_tol" not in defaults:
+            fpfilter.dist_tol = (
+                margin * (1 + strain) * (2 * matcher.stol + strain * fpfilter.rcut)
+            )
+        checks = (fpfilter.vpa_rtol, fpfilter.lattice_rtol, fpfilter.dist_tol)
+        if not fpfilter.same_nsites and all(tol is None for tol in checks):
+            return None
+        return fpfilter
+
+    def fingerprint(self, structure: Structure, reduced: Structure = None) -> dict:
+        """Compute the fingerprint of one structure
+
+        Parameters
+        ----------
+        structure : Structure
+            pymatgen structure
+        reduced : Structure, optional
+            niggli reduced (primitive if `primitive_cell`) `structure` if already
+            known, by default None to reduce here
+
+        Returns
+        -------
+        dict
+            {"nsites": int, "volume_per_atom": float, "lattice": ndarray(3),
+            "dist_hist": {(<sp1>, <sp2>): ndarray(nbins)}}, pairs per atom
+        """
+        natoms = len(structure)
+        volume_per_atom = structure.volume / natoms
+        unit = volume_per_atom ** (1 / 3)
+
+        if reduced is None:
+            reduced = StructureMatcher._get_reduced_structure(
+                structure, self.primitive_cell, niggli=True
+            )
+        nsites = len(reduced)
+        reduced_unit = (reduced.volume / nsites) ** (1 / 3)
+        lattice = np.sort(reduced.lattice.abc) / reduced_unit
+
+        if self.species:
+            species = np.array([site.specie.symbol for site in structure])
+        else:
+            species = np.full(natoms, "*")
+        center, neighbor, _, distances = structure.get_neighbor_list(self.rcut * unit)
+        distances = distances / unit
+        bins = np.linspace(0, self.rcut, self.nbins + 1)
+        dist_hist = {}
+        for sp1 in np.unique(species):
+            for sp2 in np.unique(species):
+                if sp1 > sp2:
+                    continue
+                mask = (species[center] == sp1) & (species[neighbor] == sp2)
+                hist, _ = np.histogram(distances[mask], bins=bins)
+                dist_hist[(sp1, sp2)] = hist / natoms
+        return {
+            "nsites": nsites,
+            "volume_per_atom": volume_per_atom,
+            "lattice": lattice,
+            "dist_hist": dist_hist,
+        }
+
+    def differ(self, fp1: dict, fp2: dict) -> bool:
+        """Whether two fingerprints clearly differ
+
+        Returns
+        -------
+        bool
+            True if these two structures cannot match
+        """
+        if self.same_nsites and fp1["nsites"] != fp2["nsites"]:
+            return True
+        if self.vpa_rtol is not None:
+            vpa1, vpa2 = fp1["volume_per_atom"], fp2["volume_per_atom"]
+            if abs(vpa1 - vpa2) > self.vpa_rtol * min(vpa1, vpa2):
+                return True
+        if self.lattice_rtol is not None:
+            ratio = np.abs(np.log(fp1["lattice"] / fp2["lattice"]))
+            if np.any(ratio > np.log1p(self.lattice_rtol)):
+                return True
+        if self.dist_tol is not None:
+            if fp1["dist_hist"].keys() != fp2["dist_hist"].keys():
+                return True
+            bin_width = self.rcut / self.nbins
+            for key, hist1 in fp1["dist_hist"].items():
+                hist2 = fp2["dist_hist"][key]
+                npairs = hist1.sum() + hist2.sum()
+                if npairs == 0:
+                    continue
+                # each of at most `npairs` paired distances moves by dist_tol, and
+                # binning moves each by less than one bin
+                cdf_delta = np.cumsum(hist1) - np.cumsum(hist2)
+                w1 = np.sum(np.abs(cdf_delta)) * bin_width / npairs
+                if w1 > self.dist_tol + bin_width:
+                    return True
+        return False
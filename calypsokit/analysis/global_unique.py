@@ -0,0 +1,171 @@
+"""Find the unique structures across tasks
+
+UniqueFinder only compares the structures of the same task and formula, so the
+same phase found by many tasks is kept once per task. GlobalUniqueFinder compares
+the unique records of all tasks with the same reduced formula and pressure, and
+uses locality-sensitive hashing so that only the colliding pairs are matched.
+"""
+import logging
+
+import numpy as np
+
+from calypsokit.analysis.find_unique import UniqueFinder
+from calypsokit.analysis.lsh import StructureLSH
+from calypsokit.calydb.queries import Pipes
+
+logger = logging.getLogger(__name__)
+
+
+class GlobalUniqueFinder(UniqueFinder):
+    def __init__(
+        self,
+        rawcol,
+        uniqcol,
+        globcol,
+        e_threshold=float("inf"),
+        lsh_kwargs={},
+        **kwargs,
+    ):
+        """Find unique across tasks among the records of uniqcol, insert to globcol
+
+        1. Group the records of uniqcol by reduced formula and pressure
+        (`pressure_range.mid`).
+        2. From low to high enthalpy, each structure is hashed by StructureLSH, and
+        only compared to the picked structures colliding in any hash table (and
+        within `e_threshold` in enthalpy).
+        3. As UniqueFinder, the picked structures are the unique ones, stored in
+        globcol with the uniqcol _id of its cluster `members`.
+
+        Hashing is linear in the number of records, and the number of matched pairs
+        depends on the collisions instead of the square of the group size. A pair of
+        duplicates may not collide, so the result is a superset of the exact one.
+        The prefilter, match cache, matcher backend and parallel options are the
+        same as UniqueFinder.
+
+        Examples
+        --------
+        >>> finder = GlobalUniqueFinder(db.raw, db.uniq, db.glob)
+        >>> finder.update(version=1)
+
+        Parameters
+        ----------
+        rawcol, uniqcol, globcol : pymongo.collection.Collection
+            collections from which to query the structure, from which to read the
+            unique _id of each task, and to which to store the global unique _id
+        e_threshold : float, optional
+            enthalpy_per_atom window, duplicates of different tasks may differ more
+            in enthalpy than those of one task, by default inf (no window)
+        lsh_kwargs : dict, optional
+            kwargs of StructureLSH
+        **kwargs
+            other kwargs of UniqueFinder
+        """
+        super().__init__(rawcol, globcol, e_threshold=e_threshold, **kwargs)
+        self.finder_kwargs["lsh_kwargs"] = lsh_kwargs
+        self.sourcecol = uniqcol
+        self.lsh = StructureLSH(**lsh_kwargs)
+
+    def collections(self) -> list:
+        return [self.rawcol, self.sourcecol, self.uniqcol]
+
+    def group(self, mindate=None, maxdate=None):
+        """Group the records of uniqcol by reduced formula and pressure, dates are
+        not used
+
+        Returns
+        -------
+        cursor: list
+            record list of {"_id": <reduced_formula, pressure>, "count": <int>,
+            "ids": [<_id>, ...], "enth_list": [<enthalpy_per_atom>, ...]}
+        """
+        return list(
+            self.sourcecol.aggregate(
+                Pipes.group_reduced_formula_pressure(self.rawcol.name)
+            )
+        )
+
+    def update(self, *, version, resume=True):
+        """Find unique across tasks and insert to globcol
+
+        Parameters
+        ----------
+        version : int
+            version stored with each unique _id
+        resume : bool, optional
+            skip the groups finished by an interrupted update with the same
+            arguments, by default True
+        """
+        levels = [(self.e_threshold, version, self.uniqcol)]
+        self._update(levels, None, None, False, resume)
+
+    def maintain_indexes(self, uniqcol=None):
+        """Index globcol by group keys and cluster members"""
+        globcol = self.uniqcol if uniqcol is None else uniqcol
+        globcol.create_index(
+            [("reduced_formula", 1), ("pressure", 1)],
+            name="reduced_formula_1_pressure_1",
+        )
+        globcol.create_index([("members", 1)], name="members_1")
+        self.journal.create_index(
+            [("run", 1), ("group", 1)], name="run_1_group_1", unique=True
+        )
+
+    def _sweep(
+        self,
+        ids,
+        enth_list,
+        qs,
+        fingerprints,
+        counter,
+        labels={},
+        clusters=None,
+        e_threshold=None,
+    ):
+        """Sort by enthalpy, compare each one to the picked ones colliding in any
+        hash table
+
+        Parameters are the same as UniqueFinder._sweep.
+
+        Returns
+        -------
+        list
+            unique _id list in ascending enthalpy
+        """
+        if e_threshold is None:
+            e_threshold = self.e_threshold
+        enth_arr = np.array(enth_list, dtype=float)
+        order = np.argsort(enth_arr, kind="stable")
+        enth_map = dict(zip(ids, enth_arr))
+
+        unique_list = []  # _id
+        tables = [{} for _ in range(self.lsh.ntables)]  # key: [picked _id, ...]
+        for idx in order:
+            i_id, i_enth = ids[idx], enth_arr[idx]
+            i_properties = qs[i_id]
+            # error enthalpy is never compared, treat as a different one
+            if np.isnan(i_enth):
+                unique_list.append(i_id)
+                continue
+            keys = self.lsh.keys(self.lsh.vector(i_properties["_structure_"]))
+            candidates = dict.fromkeys(
+                j_id for table, key in zip(tables, keys) for j_id in table.get(key, ())
+            )
+            counter["collisions"] += len(candidates)
+            i_label = labels.get(i_id, None)
+            window = [
+                j_id
+                for j_id in sorted(candidates, key=enth_map.get)
+                if not i_enth - enth_map[j_id] >= e_threshold
+                and (i_label is None or i_label != labels.get(j_id, None))
+            ]
+            j_id = self._match_window(
+                i_id, i_properties, window, qs, fingerprints, counter
+            )
+            # do not match to any colliding one, add
+            if j_id is None:
+                for table, key in zip(tables, keys):
+                    table.setdefault(key, []).append(i_id)
+                unique_list.append(i_id)
+            elif clusters is not None:
+                clusters.union(j_id, i_id)
+        return unique_list
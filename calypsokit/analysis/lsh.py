@@ -0,0 +1,101 @@
+"""Locality-sensitive hashing of structures
+
+Each structure is described by a fixed-length vector invariant to the supercell
+and the volume scaling: the per-atom partial radial distribution of each species
+pair, smeared by gaussians, with distances in unit of (V/N)^(1/3). The vectors are
+hashed by p-stable (gaussian) random projections, so that close vectors collide in
+at least one of the hash tables with high probability, and only the colliding
+pairs need to be matched.
+"""
+import logging
+
+import numpy as np
+from pymatgen.core.structure import Structure
+
+logger = logging.getLogger(__name__)
+
+
+class StructureLSH:
+    def __init__(
+        self, rcut=2.0, nbins=40, sigma=0.1, width=0.25, nhashes=6, ntables=32, seed=0
+    ):
+        """p-stable LSH of supercell invariant structure vectors
+
+        One key of a table is `nhashes` hashes floor((a . v + b) / width), with
+        a ~ N(0, I) and b ~ U(0, width). Structures sharing the key of any of the
+        `ntables` tables are candidates of each other. More tables raise the recall,
+        more hashes per key lower the number of candidates.
+
+        Examples
+        --------
+        >>> lsh = StructureLSH()
+        >>> keys = lsh.keys(lsh.vector(structure))
+        >>> len(keys) == lsh.ntables
+        True
+
+        Parameters
+        ----------
+        rcut : float, optional
+            cutoff of the radial distribution, in unit of (V/N)^(1/3), by default 2.0
+        nbins : int, optional
+            number of points of the radial distribution of each species pair, by
+            default 40
+        sigma : float, optional
+            gaussian smearing of distances, in unit of (V/N)^(1/3), by default 0.1
+        width : float, optional
+            bucket width of each projection, the vector is normalized to unit length,
+            by default 0.25
+        nhashes : int, optional
+            number of hashes in one key, by default 6
+        ntables : int, optional
+            number of hash tables, by default 32
+        seed : int, optional
+            seed of the random projections, the same seed gives the same keys in
+            every process, by default 0
+        """
+        self.rcut = rcut
+        self.nbins = nbins
+        self.sigma = sigma
+        self.width = width
+        self.nhashes = nhashes
+        self.ntables = ntables
+        self.seed = seed
+        self._projections = {}  # {dim: (a, b)}
+
+    def vector(self, structure: Structure) -> np.ndarray:
+        """Unit-length vector of the smeared per-atom partial radial distributions,
+        species pairs in sorted order"""
+        natoms = len(structure)
+        unit = (structure.volume / natoms) ** (1 / 3)
+        species = np.array([site.specie.symbol for site in structure])
+        center, neighbor, _, distances = structure.get_neighbor_list(
+            (self.rcut + 3 * self.sigma) * unit
+        )
+        distances = distances / unit
+        grid = np.linspace(0, self.rcut, self.nbins)
+        symbols = np.unique(species)
+        parts = []
+        for i, sp1 in enumerate(symbols):
+            for sp2 in symbols[i:]:
+                mask = (species[center] == sp1) & (species[neighbor] == sp2)
+                smeared = np.exp(
+                    -(((grid[None, :] - distances[mask, None]) / self.sigma) ** 2) / 2
+                )
+                parts.append(smeared.sum(axis=0) / natoms)
+        vector = np.concatenate(parts)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _projection(self, dim):
+        if dim not in self._projections:
+            rng = np.random.default_rng(self.seed + dim)
+            a = rng.standard_normal((self.ntables, self.nhashes, dim))
+            b = rng.uniform(0, self.width, (self.ntables, self.nhashes))
+            self._projections[dim] = (a, b)
+        return self._projections[dim]
+
+    def keys(self, vector: np.ndarray) -> list[tuple]:
+        """Key of the vector in each table"""
+        a, b = self._projection(len(vector))
+        hashes = np.floor((a @ vector + b) / self.width).astype(int)
+        return [tuple(row) for row in hashes]
@@ -0,0 +1,118 @@
+"""Persistent cache of pairwise match verdicts
+
+Verdicts of StructureMatcher.fit are stored in a local SQLite file keyed by the
+two _id and a hash of the matcher kwargs and e_threshold, so that a rerun of unique
+finding (after a crash or for a new version) does not fit the same pair again.
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from calypsokit.utils.itertools import batched
+
+logger = logging.getLogger(__name__)
+
+
+class MatchCache:
+    def __init__(self, path, params: str, chunk_size=500):
+        """Cache of match verdicts in a SQLite file
+
+        Each process opens its own connection on first use, so it is safe to be
+        pickled to the multiprocessing workers.
+
+        Examples
+        --------
+        >>> params = MatchCache.hash_params(match_kwargs, e_threshold)
+        >>> cache = MatchCache("match_cache.sqlite", params)
+        >>> cache.preload(ids)
+        >>> cache.get(id1, id2)
+        None
+        >>> cache.put(id1, id2, True)
+        >>> cache.flush()
+
+        Parameters
+        ----------
+        path : str or Path
+            SQLite file path, created if not exist
+        params : str
+            hash of the matching parameters, see `hash_params`
+        chunk_size : int, optional
+            number of _id in one query of `preload`, by default 500
+        """
+        self.path = str(path)
+        self.params = params
+        self.chunk_size = chunk_size
+        self.verdicts = {}  # {(id1, id2): bool}
+        self.pending = []
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        state["verdicts"] = {}
+        state["pending"] = []
+        return state
+
+    @staticmethod
+    def hash_params(match_kwargs: dict, e_threshold: float) -> str:
+        """Hash of the matcher kwargs and e_threshold"""
+        params = json.dumps(
+            {"match_kwargs": match_kwargs, "e_threshold": e_threshold},
+            sort_keys=True,
+            default=repr,
+        )
+        return hashlib.sha1(params.encode()).hexdigest()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS verdict ("
+                "params TEXT, id1 TEXT, id2 TEXT, match INTEGER, "
+                "PRIMARY KEY (params, id1, id2)) WITHOUT ROWID"
+            )
+            self._pid = os.getpid()
+        return self._conn
+
+    @staticmethod
+    def _key(id1, id2):
+        id1, id2 = str(id1), str(id2)
+        return (id1, id2) if id1 < id2 else (id2, id1)
+
+    def preload(self, ids):
+        """Load all cached verdicts between the given _id into memory"""
+        ids = {str(_id) for _id in ids}
+        for chunk in batched(sorted(ids), self.chunk_size):
+            cursor = self.conn.execute(
+                "SELECT id1, id2, match FROM verdict WHERE params = ? "
+                f"AND id1 IN ({','.join('?' * len(chunk))})",
+                (self.params, *chunk),
+            )
+            for id1, id2, match in cursor:
+                if id2 in ids:
+                    self.verdicts[(id1, id2)] = bool(match)
+
+    def get(self, id1, id2):
+        """Return the cached verdict, None if not cached"""
+        return self.verdicts.get(self._key(id1, id2), None)
+
+    def put(self, id1, id2, match: bool):
+        key = self._key(id1, id2)
+        self.verdicts[key] = bool(match)
+        self.pending.append((self.params, *key, int(match)))
+
+    def flush(self):
+        """Write the pending verdicts to file and clear the in-memory verdicts"""
+        if len(self.pending) > 0:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO verdict VALUES (?, ?, ?, ?)", self.pending
+                )
+        self.pending = []
+        self.verdicts = {}
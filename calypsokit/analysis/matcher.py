@@ -0,0 +1,388 @@
+"""StructureMatcher with the structure reduction memoized
+
+`StructureMatcher.fit` reduces both structures (primitive cell and niggli) on every
+call. When one structure is compared to many others, the reduction of it is done
+again and again. Here each structure is reduced once by its _id, and the pairs are
+fitted with `skip_structure_reduction=True`. `fit_many` fits one structure to many
+others in one call, which NativeMatcher checks in stacked arrays.
+"""
+import logging
+
+import numpy as np
+from pymatgen.analysis.structure_matcher import StructureMatcher
+from pymatgen.core.lattice import Lattice
+from pymatgen.core.structure import Structure
+from scipy.optimize import linear_sum_assignment
+
+logger = logging.getLogger(__name__)
+
+
+class MemoMatcher:
+    def __init__(self, matcher: StructureMatcher):
+        """Fit structures by StructureMatcher, reduce each structure only once
+
+        The verdict is the same as `matcher.fit`, because `fit` only processes the
+        species and reduces the structures before matching. Call `clear` after one
+        group to release the reduced structures.
+
+        Examples
+        --------
+        >>> memo = MemoMatcher(StructureMatcher())
+        >>> memo.fit(id1, structure1, id2, structure2)
+        True
+        >>> memo.fit(id1, structure1, id3, structure3)  # structure1 not reduced again
+        False
+        >>> memo.clear()
+
+        Parameters
+        ----------
+        matcher : StructureMatcher
+            matcher with all the tolerances
+        """
+        self.matcher = matcher
+        self.reduced = {}  # {_id: reduced Structure}
+        self.nreduced = 0
+
+    def reduced_structure(self, _id, structure: Structure) -> Structure:
+        """Species processed, primitive (if the matcher does) and niggli reduced
+        structure, computed once for each _id"""
+        if _id not in self.reduced:
+            (processed,) = self.matcher._process_species([structure])
+            self.reduced[_id] = self.matcher._get_reduced_structure(
+                processed, self.matcher._primitive_cell, niggli=True
+            )
+            self.nreduced += 1
+        return self.reduced[_id]
+
+    def fit(self, id1, struct1: Structure, id2, struct2: Structure) -> bool:
+        """Same as `StructureMatcher.fit(struct1, struct2)`"""
+        return self.matcher.fit(
+            self.reduced_structure(id1, struct1),
+            self.reduced_structure(id2, struct2),
+            skip_structure_reduction=True,
+        )
+
+    def fit_many(self, id1, struct1: Structure, others) -> list:
+        """Same as `[fit(id1, struct1, id2, struct2) for id2, struct2 in others]`
+
+        Parameters
+        ----------
+        id1, struct1
+            _id and structure fitted to each of the others
+        others : Iterable[tuple]
+            (_id, structure) of each other one
+
+        Returns
+        -------
+        list[bool]
+            `fit(struct1, struct2)` of each other one
+        """
+        return [self.fit(id1, struct1, id2, struct2) for id2, struct2 in others]
+
+    def clear(self):
+        self.reduced = {}
+
+
+class NativeMatcher(MemoMatcher):
+    def __init__(self, matcher: StructureMatcher, max_sites=50):
+        """Vectorized NumPy replica of `StructureMatcher.fit` for small ordered cells
+
+        The lattice mappings of the reduced cells are enumerated with NumPy, all the
+        translations are checked at once, and the sites are assigned by
+        `scipy.optimize.linear_sum_assignment` under periodic boundaries, following
+        the steps of `StructureMatcher._strict_match` with its tolerances and
+        comparator. Pairs out of the supported envelope fall back to pymatgen:
+
+        - disordered structures, or more than `max_sites` sites in the reduced cell
+        - `allow_subset`, or different numbers of sites with `attempt_supercell`
+
+        `fit_many` fits one structure to a batch of others in one call: the lattice
+        points of the one are enumerated once, and the translations of all the
+        lattice mappings of all the pairs are checked together in stacked arrays.
+
+        Examples
+        --------
+        >>> native = NativeMatcher(StructureMatcher())
+        >>> native.fit(id1, structure1, id2, structure2)
+        True
+        >>> native.fit_many(id1, structure1, [(id2, structure2), (id3, structure3)])
+        [True, False]
+
+        Parameters
+        ----------
+        matcher : StructureMatcher
+            matcher with all the tolerances
+        max_sites : int, optional
+            max number of sites in the reduced cell to match natively, by default 50
+        """
+        super().__init__(matcher)
+        self.max_sites = max_sites
+        self.arrays = {}  # {_id: dict of arrays of the reduced structure}
+        self.nfallback = 0
+
+    def clear(self):
+        super().clear()
+        self.arrays = {}
+
+    def _arrays(self, _id, structure) -> dict:
+        if _id not in self.arrays:
+            reduced = self.reduced_structure(_id, structure)
+            self.arrays[_id] = {
+                "supported": reduced.is_ordered and len(reduced) <= self.max_sites,
+                "nsites": len(reduced),
+                "matrix": reduced.lattice.matrix,
+                "frac": reduced.frac_coords,
+                # unique species and the index of each site in them
+                "species": _unique([site.species for site in reduced]),
+                "hash": self.matcher._comparator.get_hash(reduced.composition),
+            }
+        return self.arrays[_id]
+
+    def fit(self, id1, struct1: Structure, id2, struct2: Structure) -> bool:
+        """Same as `StructureMatcher.fit(struct1, struct2)`"""
+        return self.fit_many(id1, struct1, [(id2, struct2)])[0]
+
+    def fit_many(self, id1, struct1: Structure, others) -> list:
+        """Same as `[fit(id1, struct1, id2, struct2) for id2, struct2 in others]`,
+        the supported pairs are matched together"""
+        arr1 = self._arrays(id1, struct1)
+        verdicts = []
+        native = []  # (position in verdicts, arrays) of the pairs matched natively
+        for id2, struct2 in others:
+            arr2 = self._arrays(id2, struct2)
+            verdicts.append(False)
+            if arr1["hash"] != arr2["hash"] and not self.matcher._subset:
+                continue
+            if (
+                not (arr1["supported"] and arr2["supported"])
+                or self.matcher._subset
+                or (arr1["nsites"] != arr2["nsites"] and self.matcher._supercell)
+            ):
+                self.nfallback += 1
+                verdicts[-1] = super().fit(id1, struct1, id2, struct2)
+            elif arr1["nsites"] == arr2["nsites"]:
+                native.append((len(verdicts) - 1, arr2))
+        matches = self._strict_match_many(arr1, [arr2 for _, arr2 in native])
+        for (position, _), match in zip(native, matches):
+            verdicts[position] = match
+        return verdicts
+
+    def _pair(self, arr1, arr2):
+        """Scaled lattices, species mask and translation sites of one pair, None if
+        the species can not be mapped one-to-one"""
+        matcher = self.matcher
+        matrix1, matrix2 = arr1["matrix"], arr2["matrix"]
+        ratio = 1.0
+        if matcher._scale:
+            volume1, volume2 = abs(np.linalg.det(matrix1)), abs(np.linalg.det(matrix2))
+            ratio = (volume2 / volume1) ** (1 / 6)
+            matrix1, matrix2 = matrix1 * ratio, matrix2 / ratio
+
+        # mask[i, j]: site i of struct2 can not be matched to site j of struct1
+        uniq1, inv1 = arr1["species"]
+        uniq2, inv2 = arr2["species"]
+        uniq_mask = np.array(
+            [
+                [not matcher._comparator.are_equal(sp1, sp2) for sp1 in uniq1]
+                for sp2 in uniq2
+            ]
+        )
+        mask = uniq_mask[inv2][:, inv1]
+        # no one-to-one mapping between the same species
+        if mask[linear_sum_assignment(mask)].any():
+            return None
+        s2_t_ind = np.argmax(mask.sum(axis=-1))
+        return {
+            "ratio": ratio,
+            "matrix2": matrix2,
+            "cart1": arr1["frac"] @ matrix1,
+            "fc2": arr2["frac"],
+            "mask": mask,
+            "s1_t_inds": np.where(~mask[s2_t_ind])[0],
+            "s2_t_ind": s2_t_ind,
+        }
+
+    def _strict_match_many(self, arr1, arrs2) -> list:
+        """`StructureMatcher._strict_match` of struct1 to each struct2 of the same
+        number of sites, all the lattice mappings of all the pairs checked together"""
+        matcher = self.matcher
+        matches = [False] * len(arrs2)
+        pairs = [self._pair(arr1, arr2) for arr2 in arrs2]
+        if all(pair is None for pair in pairs):
+            return matches
+
+        # lattice points of struct1 (unscaled) within the longest target of all
+        radius = max(
+            np.linalg.norm(pair["matrix2"], axis=-1).max() / pair["ratio"]
+            for pair in pairs
+            if pair is not None
+        )
+        grid, cart, dist = _lattice_points(arr1["matrix"], radius * (1 + matcher.ltol))
+
+        # one row of each lattice mapping of each pair, by the number of translations
+        rows = {}
+        for index, pair in enumerate(pairs):
+            if pair is None:
+                continue
+            ratio = pair["ratio"]
+            matrix2 = pair["matrix2"]
+            lengths2, angles2 = _parameters(matrix2)
+            for latt in _lattice_mappings(
+                (grid, cart * ratio, dist * ratio),
+                matrix2,
+                matcher.ltol,
+                matcher.angle_tol,
+            ):
+                fc1 = pair["cart1"] @ np.linalg.inv(latt)
+                fc1 -= np.floor(fc1)
+                lengths1, angles1 = _parameters(latt)
+                avg_l = Lattice.from_parameters(
+                    *((lengths1 + lengths2) / 2), *((angles1 + angles2) / 2)
+                )
+                avg_matrix = avg_l.matrix
+                normalization = (len(fc1) / abs(np.linalg.det(avg_matrix))) ** (1 / 3)
+                frac_tol = _inv_abc(avg_matrix) * 2 * matcher.stol / normalization
+                rows.setdefault(len(pair["s1_t_inds"]), []).append(
+                    (index, fc1, avg_l, normalization, frac_tol)
+                )
+
+        for ntrans, group in rows.items():
+            nsites = arr1["nsites"]
+            # bounded memory of the (rows, ntrans, nsites, nsites, 3) differences
+            chunk = max(1, 2**22 // (ntrans * nsites * nsites * 3))
+            for start in range(0, len(group), chunk):
+                block = group[start : start + chunk]
+                block = [row for row in block if not matches[row[0]]]
+                if len(block) == 0:
+                    continue
+                index = np.array([row[0] for row in block])
+                fc1 = np.stack([row[1] for row in block])
+                frac_tol = np.stack([row[4] for row in block])
+                fc2 = np.stack([pairs[i]["fc2"] for i in index])
+                mask = np.stack([pairs[i]["mask"] for i in index])
+                s1_t_inds = np.stack([pairs[i]["s1_t_inds"] for i in index])
+                s2_t_ind = np.array([pairs[i]["s2_t_ind"] for i in index])
+
+                # all translations mapping site s2_t_ind onto a site of struct1
+                rng = np.arange(len(block))
+                translations = (
+                    fc1[rng[:, None], s1_t_inds] - fc2[rng, s2_t_ind][:, None, :]
+                )
+                t_fc2 = fc2[:, None, :, :] + translations[:, :, None, :]
+                diff = fc1[:, None, None, :, :] - t_fc2[:, :, :, None, :]
+                diff -= np.round(diff)
+                close = (
+                    np.all(np.abs(diff) < frac_tol[:, None, None, None, :], axis=-1)
+                    & ~mask[:, None, :, :]
+                )
+                passed = np.all(np.any(close, axis=-1), axis=-1)
+
+                for r, t in zip(*np.nonzero(passed)):
+                    i, fc1_r, avg_l, normalization, _ = block[r]
+                    if matches[i]:
+                        continue
+                    lll_matrix = avg_l.lll_matrix
+                    lll_frac_tol = (
+                        _inv_abc(lll_matrix) * 2 * matcher.stol / normalization
+                    )
+                    dist = _cart_dists(
+                        fc1_r,
+                        t_fc2[r, t],
+                        avg_l.matrix,
+                        lll_matrix,
+                        pairs[i]["mask"],
+                        lll_frac_tol,
+                    )
+                    if np.max(dist) * normalization < matcher.stol:
+                        matches[i] = True
+        return matches
+
+
+# 27 periodic images in [-1, 0, 1]^3
+_IMAGES = np.array(
+    [[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)],
+    dtype=float,
+)
+
+
+def _unique(species):
+    """unique species and the index of each site in them"""
+    uniq = list(dict.fromkeys(species))
+    index = {sp: i for i, sp in enumerate(uniq)}
+    return uniq, np.array([index[sp] for sp in species])
+
+
+def _parameters(matrix):
+    """lengths and angles (degree) of lattice vectors"""
+    lengths = np.linalg.norm(matrix, axis=-1)
+    angles = np.empty(3)
+    for i, (j, k) in enumerate(((1, 2), (0, 2), (0, 1))):
+        cos = np.dot(matrix[j], matrix[k]) / (lengths[j] * lengths[k])
+        angles[i] = np.rad2deg(np.arccos(np.clip(cos, -1, 1)))
+    return lengths, angles
+
+
+def _inv_abc(matrix):
+    """lengths of the reciprocal lattice vectors, without 2 pi"""
+    return np.linalg.norm(np.linalg.inv(matrix), axis=0)
+
+
+def _lattice_points(matrix, radius):
+    """Fractional (integer) and cartesian coordinates and lengths of all the lattice
+    points of `matrix` within `radius`, and some beyond"""
+    nmax = np.ceil(radius * _inv_abc(matrix)).astype(int)
+    grid = np.stack(
+        np.meshgrid(*(np.arange(-n, n + 1) for n in nmax), indexing="ij"), axis=-1
+    ).reshape(-1, 3)
+    cart = grid @ matrix
+    return grid, cart, np.linalg.norm(cart, axis=-1)
+
+
+def _lattice_mappings(points, target, ltol, angle_tol):
+    """Yield the lattices (rows of cartesian vectors) spanned by `points` (see
+    `_lattice_points`, within the longest of `target` times 1 + ltol), whose
+    lengths and angles are close to `target` and of the same volume, as
+    `Lattice.find_all_mappings` does with `supercell_size=1`"""
+    lengths, angles = _parameters(target)
+    grid, cart, dist = points
+    inds = [(dist / l < 1 + ltol) & (dist / l > 1 / (1 + ltol)) for l in lengths]
+    (f_a, f_b, f_c), (c_a, c_b, c_c), (l_a, l_b, l_c) = zip(
+        *((grid[i], cart[i], dist[i]) for i in inds)
+    )
+
+    def angles_close(c1, c2, l1, l2, angle):
+        cos = np.clip(c1 @ c2.T / l1[:, None] / l2[None, :], -1, 1)
+        return np.abs(np.rad2deg(np.arccos(cos)) - angle) <= angle_tol
+
+    alpha_b = angles_close(c_b, c_c, l_b, l_c, angles[0])
+    beta_b = angles_close(c_a, c_c, l_a, l_c, angles[1])
+    gamma_b = angles_close(c_a, c_b, l_a, l_b, angles[2])
+    combos = np.argwhere(gamma_b[:, :, None] & alpha_b[None, :, :] & beta_b[:, None, :])
+    if len(combos) == 0:
+        return
+    scale_m = np.stack((f_a[combos[:, 0]], f_b[combos[:, 1]], f_c[combos[:, 2]]), 1)
+    det = np.abs(np.linalg.det(scale_m))
+    for (i, j, k), d in zip(combos, det):
+        if d > 1e-8 and abs(d - 1) <= 0.5:
+            yield np.array((c_a[i], c_b[j], c_c[k]))
+
+
+def _cart_dists(fc1, fc2, matrix, lll_matrix, mask, lll_frac_tol):
+    """Distances of the assigned sites from fc2 to fc1 after removing the average
+    translation, unnormalized, as `StructureMatcher._cart_dists`"""
+    to_lll = matrix @ np.linalg.inv(lll_matrix)
+    diff = (fc1 @ to_lll)[None, :, :] - (fc2 @ to_lll)[:, None, :]
+    diff -= np.round(diff)
+    skipped = np.any(np.abs(diff) > lll_frac_tol + 1e-8, axis=-1)
+    images = (diff[:, :, None, :] + _IMAGES) @ lll_matrix
+    d2_images = np.sum(images**2, axis=-1)
+    nearest = np.argmin(d2_images, axis=-1)
+    vecs = np.take_along_axis(images, nearest[:, :, None, None], axis=2)[:, :, 0]
+    d2 = np.take_along_axis(d2_images, nearest[:, :, None], axis=2)[:, :, 0]
+    d2[mask | skipped] = np.inf
+    rows, cols = linear_sum_assignment(np.where(np.isinf(d2), 1e20, d2))
+    if np.isinf(d2[rows, cols]).any():
+        return np.array([np.inf])
+    short_vecs = vecs[rows, cols]
+    translation = short_vecs.mean(axis=0)
+    return np.sqrt(np.sum((short_vecs - translation) ** 2, axis=-1))
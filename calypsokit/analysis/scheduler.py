@@ -0,0 +1,110 @@
+"""Size-aware scheduling of task/formula groups to parallel workers
+
+Groups yield by Pipes.group_task_formula are very different in size. Tasks are
+planned largest-first, tiny groups are batched into chunks and huge groups are
+split into energy-window shards, which should be merged after all tasks finished.
+"""
+import logging
+import math
+from collections import defaultdict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def split_group(group: dict, max_group_size: int) -> list[dict]:
+    """Split one group into shards of contiguous enthalpy windows
+
+    Parameters
+    ----------
+    group : dict
+        {"_id": <task, formula>, "count": int, "ids": [...], "enth_list": [...]}
+    max_group_size : int
+        max number of structures in one shard
+
+    Returns
+    -------
+    list[dict]
+        shards as groups with the same "_id" and an extra "shard": (index, nshards)
+    """
+    enth_arr = np.array(group["enth_list"], dtype=float)
+    order = np.argsort(enth_arr, kind="stable")
+    nshards = math.ceil(len(order) / max_group_size)
+    shards = []
+    for ishard, idx in enumerate(np.array_split(order, nshards)):
+        shards.append(
+            {
+                "_id": group["_id"],
+                "count": len(idx),
+                "ids": [group["ids"][i] for i in idx],
+                "enth_list": [group["enth_list"][i] for i in idx],
+                "shard": (ishard, nshards),
+            }
+        )
+    return shards
+
+
+def plan_tasks(groups, chunk_size=1000, max_group_size=5000) -> list[list[dict]]:
+    """Plan groups into tasks, ordered largest-first
+
+    Parameters
+    ----------
+    groups : Iterable[dict]
+        groups yield by Pipes.group_task_formula
+    chunk_size : int, optional
+        groups smaller than it are batched into one task of no more than `chunk_size`
+        structures, by default 1000
+    max_group_size : int, optional
+        groups larger than it are split into energy-window shards, by default 5000
+
+    Returns
+    -------
+    list[list[dict]]
+        each task is a list of groups (or shards)
+    """
+    tasks = []
+    chunk, chunk_count = [], 0
+    for group in sorted(groups, key=lambda g: g["count"], reverse=True):
+        if group["count"] > max_group_size:
+            tasks.extend([shard] for shard in split_group(group, max_group_size))
+        elif group["count"] >= chunk_size:
+            tasks.append([group])
+        else:
+            if chunk_count + group["count"] > chunk_size:
+                tasks.append(chunk)
+                chunk, chunk_count = [], 0
+            chunk.append(group)
+            chunk_count += group["count"]
+    if len(chunk) > 0:
+        tasks.append(chunk)
+    tasks.sort(key=lambda task: sum(group["count"] for group in task), reverse=True)
+    return tasks
+
+
+def log_worker_stats(stats: list[dict], wall: float):
+    """Log throughput and idle time of each worker
+
+    Parameters
+    ----------
+    stats : list[dict]
+        stat of each task, {"pid": int, "start": float, "end": float,
+        "nstructures": int}
+    wall : float
+        wall time of the whole parallel run, in second
+    """
+    workers = defaultdict(lambda: {"ntasks": 0, "nstructures": 0, "busy": 0.0})
+    for stat in stats:
+        worker = workers[stat["pid"]]
+        worker["ntasks"] += 1
+        worker["nstructures"] += stat["nstructures"]
+        worker["busy"] += stat["end"] - stat["start"]
+    logger.info(f"{len(stats)} tasks on {len(workers)} workers in {wall:.1f} s")
+    for pid, worker in sorted(workers.items()):
+        throughput = worker["nstructures"] / max(worker["busy"], 1e-9)
+        logger.info(
+            f"worker {pid}: {worker['ntasks']} tasks, "
+            f"{worker['nstructures']} structures, "
+            f"{throughput:.1f} structures/s, "
+            f"idle {max(wall - worker['busy'], 0.0):.1f} s"
+        )
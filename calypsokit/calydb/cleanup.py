@@ -1,14 +1,28 @@
 import logging
+import time
+from itertools import chain
 
+import numpy as np
 import pymongo
 from datetime import datetime
+from pymongo import UpdateMany, UpdateOne
 
 from calypsokit.calydb.queries import Pipes
-from calypsokit.utils.itertools import groupby_delta
+from calypsokit.utils.itertools import batched
 
 logger = logging.getLogger(__name__)
 
 
+def deprecation(reason) -> dict:
+    """Fields set on a deprecated record, stamped with the time of deprecation so
+    that UniqueFinder.sync_deprecated picks it up"""
+    return {
+        "deprecated": True,
+        "deprecated_reason": reason,
+        "last_updated_utc": datetime.utcnow(),
+    }
+
+
 # 清理enthalpy=610612509的结构
 def deprecate_large_enthalpy(collection):
     """mark those energy_per_atom > 610612508 as deprecated
@@ -26,12 +40,7 @@ def deprecate_large_enthalpy(collection):
     """
     logger.info("Finding enthalpy/atom 610612509")
     fil = {"deprecated": False, "enthalpy_per_atom": {"$gt": 610612508}}
-    upd = {
-        "$set": {
-            "deprecated": True,
-            "deprecated_reason": "error enthalpy : optimization fail",
-        }
-    }
+    upd = {"$set": deprecation("error enthalpy : optimization fail")}
     # Mark those as deprecated
     res = collection.update_many(fil, upd)
     logger.info(
@@ -43,17 +52,23 @@ def deprecate_large_enthalpy(collection):
 
 
 # 清理每个任务少于lte(=10)个的结构（不考虑变组分）
-def deprecate_less_task(collection, mindate=None, maxdate=None, lte: int = 10):
+def deprecate_less_task(
+    collection, mindate=None, maxdate=None, lte: int = 10, dry_run=False
+) -> dict:
     """mark those number structures in one task <= `lte` as deprecated
 
-    Will auto-check after run
+    The not deprecated records (updated between mindate and maxdate if given) are
+    counted by task, and those of the tasks with <= `lte` records are marked by one
+    aggregation ending in `$merge` into the collection itself, so no record goes
+    through the client. Will auto-check after run by counting the tasks left.
 
     Examples
     --------
     >>> col: pymongo.collection.Collection
     >>> mindate = (2023, 1, 1)
     >>> lte = 10
-    >>> deprecate_less_task(col, mindate, 10)
+    >>> deprecate_less_task(col, mindate, lte=10, dry_run=True)
+    {'ntasks': 12, 'nrecords': 57, 'seconds': 0.8}
 
     Parameters
     ----------
@@ -63,58 +78,148 @@ def deprecate_less_task(collection, mindate=None, maxdate=None, lte: int = 10):
         None for 0 and 9999, all None for total.
     lte : int, optional
         <= threshold, by default 10
+    dry_run : bool, optional
+        only count the tasks and records to deprecate, by default False
+
+    Returns
+    -------
+    dict
+        {"ntasks": int, "nrecords": int, "seconds": float}, the tasks and records
+        (to be) deprecated and the seconds taken
     """
     logger.info(f"Finding tasks with structures <= {lte}")
-    if mindate is None and maxdate is None:
-        pipeline = Pipes.group_task(lte=lte) + [{"$match": {"deprecated": False}}]
-    else:
-        pipeline = (
-            Pipes.daterange_records(mindate, maxdate)
-            + Pipes.group_task(lte=lte)
-            + [{"$match": {"deprecated": False}}]
-        )
-    udp = {
-        "$set": {
-            "deprecated": True,
-            "deprecated_reason": f"number of extracted structure <= {lte}"
-            + " in this prediction task",
+    pipeline = [{"$match": {"deprecated": False}}] + Pipes.group_task(lte=lte)
+    if mindate is not None or maxdate is not None:
+        pipeline = Pipes.daterange_records(mindate, maxdate) + pipeline
+    count = [
+        {
+            "$group": {
+                "_id": None,
+                "ntasks": {"$sum": 1},
+                "nrecords": {"$sum": "$count"},
+            }
         }
-    }
-    cursor = list(collection.aggregate(pipeline))
-    # Mark those not deprecated as deprecated
-    for record in cursor:
-        collection.update_many(
-            {"deprecated": False, "_id": {"$in": record["ids"]}}, udp
-        )
-    logger.info(f"{len(cursor)} groups cleaned.")
+    ]
+    start = time.perf_counter()
+    stat = next(collection.aggregate(pipeline + count, allowDiskUse=True), {})
+    stat = {"ntasks": stat.get("ntasks", 0), "nrecords": stat.get("nrecords", 0)}
+    logger.info(
+        f"{stat['nrecords']} records of {stat['ntasks']} tasks to deprecate, "
+        f"counted in {time.perf_counter() - start:.2f} s"
+    )
+    if dry_run or stat["ntasks"] == 0:
+        stat["seconds"] = time.perf_counter() - start
+        return stat
+    reason = f"number of extracted structure <= {lte} in this prediction task"
+    merge = [
+        {"$unwind": "$ids"},
+        {
+            "$project": {"_id": "$ids"}
+            | {key: {"$literal": value} for key, value in deprecation(reason).items()}
+        },
+        {
+            "$merge": {
+                "into": collection.name,
+                "on": "_id",
+                "whenMatched": "merge",
+                "whenNotMatched": "discard",
+            }
+        },
+    ]
+    merge_start = time.perf_counter()
+    collection.aggregate(pipeline + merge, allowDiskUse=True)
+    logger.info(
+        f"{stat['nrecords']} records deprecated in "
+        f"{time.perf_counter() - merge_start:.2f} s"
+    )
     # Check if there exist left
-    cleaned_flag = True
-    for record in cursor:
-        if (
-            collection.find_one({"deprecated": False, "_id": {"$in": record["ids"]}})
-            is not None
-        ):
-            logger.warning(f"Still exist uncleaned records: {record}")
-            cleaned_flag = False
-    if cleaned_flag:
+    left = next(collection.aggregate(pipeline + count, allowDiskUse=True), {})
+    if left.get("ntasks", 0) > 0:
+        logger.warning(f"Still exist {left['nrecords']} uncleaned records")
+    else:
         logger.info(
             f"Cleaned task between ({mindate}, {maxdate}) "
             f"which number of structure <= {lte}"
         )
+    stat["seconds"] = time.perf_counter() - start
+    return stat
+
+
+def find_solitary(enth_lists, delta=1.0, nclusters=5, long=10) -> np.ndarray:
+    """Positions of the solitary records of many groups, by array operations
+
+    Each list of sorted enthalpies is split into clusters where the gap to the next
+    one is not < `delta`, as `groupby_delta` does (which drops the last cluster if
+    it is a single record). Of the first `nclusters` clusters, up to the first one
+    of >= `long` records, the single-record clusters are solitary.
+
+    >>> find_solitary([[1.0, 3.0, 3.1, 5.0], [0.0, 2.0, 4.0]], delta=1.0)
+    array([0, 4, 5])
+
+    Parameters
+    ----------
+    enth_lists : list[list[float]]
+        sorted enthalpies of each group
+    delta : float, optional
+        minimum gap between clusters, by default 1.0
+    nclusters : int, optional
+        number of clusters checked from the lowest, by default 5
+    long : int, optional
+        clusters after the first one of this size are not checked, by default 10
+
+    Returns
+    -------
+    np.ndarray
+        positions in the concatenation of `enth_lists`
+    """
+    sizes = np.fromiter(map(len, enth_lists), dtype=np.int64, count=len(enth_lists))
+    if sizes.sum() == 0:
+        return np.empty(0, dtype=np.int64)
+    enth = np.concatenate([np.asarray(e, dtype=float) for e in enth_lists])
+    return _find_solitary(enth, sizes, delta, nclusters, long)
+
+
+def _find_solitary(enth, sizes, delta=1.0, nclusters=5, long=10) -> np.ndarray:
+    """find_solitary of the concatenated enthalpies and the size of each group"""
+    if enth.size == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.cumsum(sizes) - sizes
+    # a cluster starts a group or follows a gap not < delta (NaN included)
+    is_start = np.empty(enth.size, dtype=bool)
+    is_start[0] = True
+    is_start[1:] = ~(np.diff(enth) < delta)
+    is_start[offsets[sizes > 0]] = True
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, enth.size))
+    group = np.searchsorted(offsets, starts, side="right") - 1
+    first = np.searchsorted(starts, offsets)[group]  # first cluster of the group
+    rank = np.arange(starts.size) - first
+    is_last = np.append(group[1:] != group[:-1], True)
+    checked = (rank < nclusters) & ~(is_last & (lengths == 1))
+    # clusters after the first long one of the group are not checked
+    is_long = checked & (lengths >= long)
+    nlong = np.cumsum(is_long) - is_long  # long clusters before each one
+    checked &= nlong == nlong[first]
+    return starts[checked & (lengths == 1)]
 
 
 # 清理每组任务每个分子式中能量很低的孤立结构（间隔超过delta=1eV）的结构
-def deprecate_solitary_enth(collection, mindate=None, maxdate=None, delta=1.0):
+def deprecate_solitary_enth(
+    collection, mindate=None, maxdate=None, delta=1.0, batch_size=1000
+) -> dict:
     """mark those solitary energy structure as deprecated
 
     Filter the newer (if do) and not deprecated records, group them by task and
     formula and sort group by enthalpy_per_atom (see Pipes.sort_enthalpy). Then
-    find the solitary one accroding to `delta`, and mark it deprecated.
+    find the solitary one accroding to `delta` (see find_solitary), and mark it
+    deprecated. Groups are checked `batch_size` at a time and the solitary ones are
+    written by unordered bulk_write of `batch_size` updates.
 
     Examples
     --------
     >>> col: pymongo.collection.Collection
-    >>> clean_solitary_enth(col, (2023, 1, 1), delta=1.0)
+    >>> deprecate_solitary_enth(col, (2023, 1, 1), delta=1.0)
+    {'ngroups': 310, 'nrecords': 12, 'seconds': 3.2}
 
     Parameters
     ----------
@@ -124,40 +229,50 @@ def deprecate_solitary_enth(collection, mindate=None, maxdate=None, delta=1.0):
         None for 0 and 9999, all None for total.
     delta : float, optional
         determine solitary by energy delta, by default 1.0
+    batch_size : int, optional
+        groups checked and updates written at a time, by default 1000
+
+    Returns
+    -------
+    dict
+        {"ngroups": int, "nrecords": int, "seconds": float}, the groups checked,
+        the records deprecated and the seconds taken
     """
     logger.info(f"Finding too small solitary enthalpy by delta: {delta}")
-    update_dict = {
-        "deprecated": True,
-        "deprecated_reason": "error enthalpy : solitary and too small",
-    }
+    update_dict = deprecation("error enthalpy : solitary and too small")
     if mindate is None and maxdate is None:
         pipeline = Pipes.sort_enthalpy()
     else:
         pipeline = Pipes.daterange_records(mindate, maxdate) + Pipes.sort_enthalpy()
-    for record in collection.aggregate(pipeline):
-        naccumu = 0
-        # 只检查相邻能量间隔为1eV的前5组
-        for ene_group in list(groupby_delta(record["sorted_enth"], delta))[:5]:
-            naccumu += len(ene_group)
-            if len(ene_group) >= 10:  # 若出现连续较长的组，则不再检查后面的组
-                break
-            elif len(ene_group) == 1:  # 孤立组，需要删除
-                solitary_id = record["sorted_ids"][naccumu - 1]
-                logger.info(f"Solitary enthalpy structure: {solitary_id}")
-                # yield (solitary_id, update_dict)
-                collection.update_one(
-                    {"_id": record["sorted_ids"][naccumu - 1]},
-                    {"$set": update_dict},
-                )
+    start = time.perf_counter()
+    stat = {"ngroups": 0, "nrecords": 0}
+    requests = []
+    for batch in batched(collection.aggregate(pipeline, allowDiskUse=True), batch_size):
+        positions = find_solitary([record["sorted_enth"] for record in batch], delta)
+        ids = list(chain.from_iterable(record["sorted_ids"] for record in batch))
+        for position in positions:
+            logger.debug(f"Solitary enthalpy structure: {ids[position]}")
+            requests.append(UpdateOne({"_id": ids[position]}, {"$set": update_dict}))
+        stat["ngroups"] += len(batch)
+        if len(requests) >= batch_size:
+            collection.bulk_write(requests, ordered=False)
+            stat["nrecords"] += len(requests)
+            requests = []
+    if len(requests) > 0:
+        collection.bulk_write(requests, ordered=False)
+        stat["nrecords"] += len(requests)
+    stat["seconds"] = time.perf_counter() - start
+    logger.info(
+        f"{stat['nrecords']} solitary records of {stat['ngroups']} groups deprecated "
+        f"in {stat['seconds']:.2f} s"
+    )
+    return stat
 
 
 def deprecate_min_dist(collection: pymongo.collection.Collection):
     min_dist = 0.5
     logger.info(f"Finding min distances less than {min_dist} A")
-    update_dict = {
-        "deprecated": True,
-        "deprecated_reason": f"distance error : too close ({min_dist})",
-    }
+    update_dict = deprecation(f"distance error : too close ({min_dist})")
     res = collection.update_many(
         {"deprecated": False, "min_distance": {"$lt": min_dist}}, {"$set": update_dict}
     )
@@ -167,6 +282,9 @@ def deprecate_min_dist(collection: pymongo.collection.Collection):
 def clean_deprecated_unique(rawcol, uniqcol):
     """remove records marked deprecated in <rawcol> which still in <uniqcol>
 
+    Only looks at the first 10 deprecated records, `UniqueFinder.sync_deprecated`
+    syncs all the records deprecated since its last run.
+
     Examples
     --------
     >>> rawcol, uniqcol
@@ -203,3 +321,227 @@ def clean_deprecated_unique(rawcol, uniqcol):
             f"from col: {uniqcol.name}"
         )
         uniqcol.delete_many({"_id": {"$in": deprecated_in_uniq}})
+
+
+class DeprecationRule:
+    def __init__(self, name, reason, fields, predicate, by=(), daterange=True):
+        """A deprecation rule, evaluated on the columns of the not deprecated records
+
+        Examples
+        --------
+        >>> DeprecationRule(
+        ...     "min_dist",
+        ...     "distance error : too close (0.5)",
+        ...     ["min_distance"],
+        ...     lambda columns: columns["min_distance"] < 0.5,
+        ...     daterange=False,
+        ... )
+
+        Parameters
+        ----------
+        name : str
+            name in the report
+        reason : str
+            `deprecated_reason` of the deprecated records
+        fields : list[str]
+            dotted paths of the fields the predicate needs, numbers are read as
+            float (NaN if missing) and others as object (None if missing)
+        predicate : callable
+            per-document if `by` is empty, `predicate(columns) -> bool array`,
+            per-group otherwise, `predicate(columns, group) -> bool array` where
+            group is the integer group of each record; columns is {field: array}
+        by : list[str], optional
+            dotted paths of the group keys, by default no grouping
+        daterange : bool, optional
+            only check the records in the date range of the run, by default True
+        """
+        self.name = name
+        self.reason = reason
+        self.fields = list(fields)
+        self.predicate = predicate
+        self.by = list(by)
+        self.daterange = daterange
+
+    def select(self, columns) -> np.ndarray:
+        if len(self.by) == 0:
+            return np.asarray(self.predicate(columns), dtype=bool)
+        keys = {}
+        group = np.fromiter(
+            (
+                keys.setdefault(key, len(keys))
+                for key in zip(*map(columns.get, self.by))
+            ),
+            dtype=np.int64,
+            count=len(columns[self.by[0]]),
+        )
+        return np.asarray(self.predicate(columns, group), dtype=bool)
+
+
+def default_rules(lte=10, delta=1.0, min_dist=0.5) -> list:
+    """Rules of deprecate_large_enthalpy, deprecate_less_task,
+    deprecate_solitary_enth and deprecate_min_dist, in this order"""
+
+    def less_task(columns, group):
+        return np.bincount(group)[group] <= lte
+
+    def solitary(columns, group):
+        enth = columns["enthalpy_per_atom"]
+        # null enthalpies first, as the $sort of Pipes.sort_enthalpy
+        order = np.lexsort((enth, ~np.isnan(enth), group))
+        positions = _find_solitary(enth[order], np.bincount(group), delta)
+        selected = np.zeros(enth.size, dtype=bool)
+        selected[order[positions]] = True
+        return selected
+
+    return [
+        DeprecationRule(
+            "large_enthalpy",
+            "error enthalpy : optimization fail",
+            ["enthalpy_per_atom"],
+            lambda columns: columns["enthalpy_per_atom"] > 610612508,
+            daterange=False,
+        ),
+        DeprecationRule(
+            "less_task",
+            f"number of extracted structure <= {lte} in this prediction task",
+            [],
+            less_task,
+            by=["trajectory.source_dir"],
+        ),
+        DeprecationRule(
+            "solitary",
+            "error enthalpy : solitary and too small",
+            ["enthalpy_per_atom"],
+            solitary,
+            by=["trajectory.source_dir", "formula"],
+        ),
+        DeprecationRule(
+            "min_dist",
+            f"distance error : too close ({min_dist})",
+            ["min_distance"],
+            lambda columns: columns["min_distance"] < min_dist,
+            daterange=False,
+        ),
+    ]
+
+
+def _get_path(doc, path):
+    for key in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key, None)
+    return doc
+
+
+def _column(values) -> np.ndarray:
+    """float array if all values are numbers or None, object array otherwise"""
+    if all(
+        value is None
+        or (isinstance(value, (int, float)) and not isinstance(value, bool))
+        for value in values
+    ):
+        return np.array(values, dtype=float)
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+def deprecate(
+    collection, mindate=None, maxdate=None, rules=None, dry_run=False, batch_size=1000
+) -> dict:
+    """Run deprecation rules in one pass
+
+    The fields of all rules of the not deprecated records are read by one projected
+    cursor. The rules are evaluated in order in memory, each on the records not
+    deprecated by the former ones, as if they were run one after another. Then the
+    deprecated records are written by one unordered bulk_write of `UpdateMany` of
+    `batch_size` _id.
+
+    Examples
+    --------
+    >>> col: pymongo.collection.Collection
+    >>> deprecate(col, (2023, 1, 1), dry_run=True)
+    {'read': {'nrecords': 1000000, 'seconds': 12.1},
+     'large_enthalpy': {'nrecords': 10, 'seconds': 0.01}, ...,
+     'write': {'nrecords': 0, 'seconds': 0.0}}
+
+    Parameters
+    ----------
+    collection : pymongo.collection.Collection
+    mindate, maxdate : tuple, optional
+        utc date (year, month, day, hour, minute, second, ...) of 'last_updated_utc'
+        of the records checked by the rules with daterange, None for 0 and 9999,
+        all None for total.
+    rules : list[DeprecationRule], optional
+        rules in order, by default `default_rules()`
+    dry_run : bool, optional
+        only count the records each rule would deprecate, by default False
+    batch_size : int, optional
+        number of records read at a time and _id in one update, by default 1000
+
+    Returns
+    -------
+    dict
+        {"read": stat, <rule name>: stat, ..., "write": stat}, stat is
+        {"nrecords": int, "seconds": float}
+    """
+    rules = default_rules() if rules is None else rules
+    fields = list(dict.fromkeys(f for rule in rules for f in rule.fields + rule.by))
+    use_dates = mindate is not None or maxdate is not None
+    if use_dates:
+        fields.append("last_updated_utc")
+    stats = {}
+
+    start = time.perf_counter()
+    ids, values = [], {field: [] for field in fields}
+    cursor = collection.find(
+        {"deprecated": False}, {field: 1 for field in fields}, batch_size=batch_size
+    )
+    for doc in cursor:
+        ids.append(doc["_id"])
+        for field in fields:
+            values[field].append(_get_path(doc, field))
+    columns = {field: _column(value) for field, value in values.items()}
+    del values
+    in_range = np.ones(len(ids), dtype=bool)
+    if use_dates:
+        dates = np.array(columns.pop("last_updated_utc"), dtype="datetime64[us]")
+        mindate = np.datetime64(datetime(*(mindate or (1, 1, 1, 0, 0, 0))))
+        maxdate = np.datetime64(datetime(*(maxdate or (9999, 12, 31, 23, 59, 59))))
+        in_range = (dates > mindate) & (dates < maxdate)
+    stats["read"] = {"nrecords": len(ids), "seconds": time.perf_counter() - start}
+    logger.info(f"Read {len(ids)} records in {stats['read']['seconds']:.2f} s")
+
+    alive = np.ones(len(ids), dtype=bool)
+    deprecated = []  # [(rule, indices)]
+    for rule in rules:
+        start = time.perf_counter()
+        rows = np.flatnonzero(alive & in_range if rule.daterange else alive)
+        selected = np.empty(0, dtype=np.int64)
+        if rows.size > 0:
+            subset = {field: columns[field][rows] for field in rule.fields + rule.by}
+            selected = rows[rule.select(subset)]
+        alive[selected] = False
+        deprecated.append((rule, selected))
+        stats[rule.name] = {
+            "nrecords": len(selected),
+            "seconds": time.perf_counter() - start,
+        }
+        logger.info(f"{len(selected)} records deprecated by {rule.name}")
+
+    start = time.perf_counter()
+    requests = []
+    for rule, selected in deprecated:
+        upd = {"$set": deprecation(rule.reason)}
+        for batch in batched(selected, batch_size):
+            requests.append(UpdateMany({"_id": {"$in": [ids[i] for i in batch]}}, upd))
+    nrecords = 0
+    if not dry_run and len(requests) > 0:
+        nrecords = collection.bulk_write(requests, ordered=False).modified_count
+    stats["write"] = {"nrecords": nrecords, "seconds": time.perf_counter() - start}
+    logger.info(
+        f"{'Would deprecate' if dry_run else 'Deprecated'} "
+        f"{sum(len(selected) for _, selected in deprecated)} records, written in "
+        f"{stats['write']['seconds']:.2f} s"
+    )
+    return stats
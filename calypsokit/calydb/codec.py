@@ -0,0 +1,235 @@
+"""Binary format of ndarray in MongoDB documents
+
+An ndarray is stored as a BSON Binary of USER_DEFINED_SUBTYPE:
+
+    b"CKND" | version (uint8) | order (b"C" or b"F") | ndim (uint8)
+    | len(dtype.str) (uint8) | flags (uint8, since version 2)
+    | dtype.str (ascii) | shape (ndim * int64) | payload
+
+The payload is the raw buffer, decoded by np.frombuffer without copying, so the
+decoded arrays are read-only. The flags mark a payload compressed by zlib or lzma,
+or an array of one repeated value (e.g. all NaN) stored as that value only; such
+arrays are decoded into new writable arrays. Arrays of object or structured dtype,
+which have no portable raw buffer, and the documents written before this format
+are pickles (protocol 2), which are still decoded.
+
+Compression, float32 down-casting and constant arrays are opt-in per field by an
+ArrayPolicy, see `NumpyDatabase`.
+"""
+import lzma
+import math
+import pickle
+import struct
+import zlib
+from functools import lru_cache
+
+import numpy as np
+
+MAGIC = b"CKND"
+VERSION = 2
+_HEADER_V1 = struct.Struct("<4sBcBB")  # magic, version, order, ndim, len(dtype)
+_HEADER = struct.Struct("<4sBcBBB")  # ..., flags
+
+COMPRESSORS = {"zlib": 1, "lzma": 2}
+_COMPRESS_MASK = 0b011
+_CONSTANT = 0b100
+
+
+@lru_cache(maxsize=256)
+def _dtype(descr: bytes) -> np.dtype:
+    return np.dtype(descr.decode("ascii"))
+
+
+def is_raw_dtype(dtype: np.dtype) -> bool:
+    """Whether arrays of this dtype are stored as raw buffer"""
+    return not (dtype.hasobject or dtype.names is not None or dtype.subdtype)
+
+
+def is_constant(value: np.ndarray) -> bool:
+    """Whether all elements are the same, NaN equals NaN"""
+    if value.size == 0:
+        return False
+    flat = value.ravel(order="K")
+    if (flat == flat[0]).all():
+        return True
+    return value.dtype.kind in "fc" and bool(np.isnan(flat).all())
+
+
+def encode_ndarray(
+    value: np.ndarray, compress=None, level=None, constant=False, min_nbytes=256
+) -> bytes:
+    """Header and raw buffer of the array, pickle if not `is_raw_dtype`
+
+    Parameters
+    ----------
+    value : np.ndarray
+        array to encode
+    compress : {None, "zlib", "lzma"}, optional
+        compressor of the payload, by default None
+    level : int, optional
+        compression level, default level of the compressor if None
+    constant : bool, optional
+        store only one element if all elements are the same, by default False
+    min_nbytes : int, optional
+        smaller payloads are not compressed, by default 256
+    """
+    if not is_raw_dtype(value.dtype):
+        return encode_pickle(value)
+    flags = 0
+    order = b"F" if value.flags.f_contiguous and not value.flags.c_contiguous else b"C"
+    if constant and is_constant(value):
+        flags |= _CONSTANT
+        payload = value.ravel(order="K")[:1].tobytes()
+    else:
+        payload = value.tobytes(order=order.decode())
+    if compress is not None and len(payload) >= min_nbytes:
+        if compress == "zlib":
+            packed = zlib.compress(payload, -1 if level is None else level)
+        elif compress == "lzma":
+            packed = lzma.compress(payload, preset=level)
+        else:
+            raise ValueError(f"unknown compressor {compress}")
+        if len(packed) < len(payload):
+            flags |= COMPRESSORS[compress]
+            payload = packed
+    dtype = value.dtype.str.encode("ascii")
+    header = _HEADER.pack(MAGIC, VERSION, order, value.ndim, len(dtype), flags)
+    shape = struct.pack(f"<{value.ndim}q", *value.shape)
+    return b"".join([header, dtype, shape, payload])
+
+
+def encode_pickle(value: np.ndarray) -> bytes:
+    """Legacy format"""
+    return pickle.dumps(value, protocol=2)
+
+
+def decode_ndarray(data: bytes) -> np.ndarray:
+    """Decode either format, uncompressed raw buffers are not copied"""
+    if not data.startswith(MAGIC):
+        return pickle.loads(data)
+    version = data[len(MAGIC)]
+    if version == 1:
+        magic, version, order, ndim, ndtype = _HEADER_V1.unpack_from(data)
+        flags, offset = 0, _HEADER_V1.size
+    elif version == VERSION:
+        magic, version, order, ndim, ndtype, flags = _HEADER.unpack_from(data)
+        offset = _HEADER.size
+    else:
+        raise ValueError(f"ndarray format version {version} is not supported")
+    dtype = _dtype(bytes(data[offset : offset + ndtype]))
+    offset += ndtype
+    shape = struct.unpack_from(f"<{ndim}q", data, offset)
+    offset += 8 * ndim
+    compress = flags & _COMPRESS_MASK
+    if compress == COMPRESSORS["zlib"]:
+        data, offset = zlib.decompress(memoryview(data)[offset:]), 0
+    elif compress == COMPRESSORS["lzma"]:
+        data, offset = lzma.decompress(memoryview(data)[offset:]), 0
+    if flags & _CONSTANT:
+        element = np.frombuffer(data, dtype=dtype, count=1, offset=offset)[0]
+        return np.full(shape, element, dtype=dtype)
+    array = np.frombuffer(data, dtype=dtype, count=math.prod(shape), offset=offset)
+    return array.reshape(shape, order="F" if order == b"F" else "C")
+
+
+class PackedArray:
+    """ndarray with the encoding options of its field, see ArrayPolicy"""
+
+    __slots__ = ("array", "options")
+
+    def __init__(self, array: np.ndarray, options: dict):
+        self.array = array
+        self.options = options
+
+    def encode(self) -> bytes:
+        return encode_ndarray(self.array, **self.options)
+
+
+class ArrayPolicy:
+    def __init__(
+        self,
+        fields={},
+        compress=None,
+        level=None,
+        constant=True,
+        float32=False,
+        min_nbytes=256,
+    ):
+        """Encoding options of the ndarray fields of one collection
+
+        The keyword options are the defaults of all ndarray fields, and `fields`
+        overrides them by the dotted path of a field. Arrays in lists take the path
+        of the list, as MongoDB does.
+
+        Examples
+        --------
+        >>> policy = ArrayPolicy(
+        ...     fields={
+        ...         "forces": {"compress": "zlib"},
+        ...         "trajectory.forces": {"compress": "zlib"},
+        ...         "scaled_positions": {"float32": True},
+        ...         "trajectory.scaled_positions": {"float32": True},
+        ...     },
+        ... )
+        >>> db = login(policies={"raw": policy})
+
+        Parameters
+        ----------
+        fields : dict, optional
+            {<dotted path>: {<option>: value}}, by default empty
+        compress : {None, "zlib", "lzma"}, optional
+            compressor of the payload, by default None
+        level : int, optional
+            compression level, by default the default level of the compressor
+        constant : bool, optional
+            store arrays of one repeated value (e.g. all NaN) as that value, by
+            default True
+        float32 : bool, optional
+            down-cast float64 arrays to float32, by default False
+        min_nbytes : int, optional
+            smaller payloads are not compressed, by default 256
+        """
+        self.defaults = {
+            "compress": compress,
+            "level": level,
+            "constant": constant,
+            "float32": float32,
+            "min_nbytes": min_nbytes,
+        }
+        self.fields = {path: self.defaults | opts for path, opts in fields.items()}
+
+    def options(self, path: str) -> dict:
+        return self.fields.get(path, self.defaults)
+
+    def pack(self, array: np.ndarray, path: str) -> PackedArray:
+        options = dict(self.options(path))
+        if options.pop("float32") and array.dtype == np.float64:
+            array = array.astype(np.float32)
+        return PackedArray(array, options)
+
+    def apply(self, value, path=""):
+        """Copy of the document with ndarray wrapped as PackedArray, other values
+        are not copied"""
+        if isinstance(value, np.ndarray):
+            return self.pack(value, path)
+        elif isinstance(value, dict):
+            prefix = f"{path}." if path else ""
+            return {
+                key: self.apply(item, f"{prefix}{key}") for key, item in value.items()
+            }
+        elif isinstance(value, list):
+            return [self.apply(item, path) for item in value]
+        return value
+
+    def apply_update(self, update):
+        """Copy of an update document, the fields of its operators are dotted paths"""
+        if not isinstance(update, dict):  # aggregation pipeline
+            return update
+        return {
+            op: (
+                {path: self.apply(item, path) for path, item in fields.items()}
+                if isinstance(fields, dict)
+                else fields
+            )
+            for op, fields in update.items()
+        }
@@ -0,0 +1,596 @@
+"""Local storage backend: a MongoDB snapshot on disk, queried in memory
+
+The pipelines of calydb and analysis only use the pymongo Database/Collection
+interface, so they run unchanged on either backend of `login`:
+
+- "mongodb" (default), a NumpyDatabase of the MongoDB server
+- "local", a LocalDatabase of a snapshot directory, in the layout of mongodump:
+
+    <path>/<database>/<collection>.bson           concatenated BSON documents
+    <path>/<database>/<collection>.metadata.json  indexes
+
+A snapshot is written by `dump` (`cak db snapshot`) or by `mongodump --out
+<path>`, and read back by `mongorestore <path>`. The collections are loaded into
+mongomock when first used, with ndarray stored as Binary exactly as on the
+server, and the changed ones are written back by `LocalClient.save`. Aggregation
+stages and operators mongomock lacks and we use (`$merge` and `$bucketAuto` as the
+last stage, `$zip`) and `bulk_write` are done here.
+
+The data lives in one process, so the collections are not picklable: run the
+parallel pipelines with n_jobs=1. GridFS (TrajectoryStore) needs the server.
+"""
+import atexit
+import logging
+import math
+import os
+from collections.abc import Mapping
+
+import bson
+from bson import json_util
+from bson.codec_options import CodecOptions, TypeDecoder, TypeEncoder
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, DeleteOne, InsertOne, ReplaceOne, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from pymongo.results import BulkWriteResult
+
+from calypsokit.calydb.login import NumpyDatabase
+
+logger = logging.getLogger(__name__)
+
+# {(pid, path): LocalClient}, one in-memory copy of a snapshot per process
+_LOCAL_CLIENTS = {}
+
+
+def get_local_client(path, autosave=True) -> "LocalClient":
+    """The LocalClient of this process for path, created on first use
+
+    If autosave, the changed collections are saved when the process exits.
+    """
+    key = (os.getpid(), os.path.abspath(path))
+    if key not in _LOCAL_CLIENTS:
+        client = LocalClient(path)
+        if autosave:
+            atexit.register(client.save)
+        _LOCAL_CLIENTS[key] = client
+    return _LOCAL_CLIENTS[key]
+
+
+def dump(database, path, collections=None, filter={}, limit=0) -> dict:
+    """Write collections of a (server) database as a local snapshot
+
+    Parameters
+    ----------
+    database : pymongo.database.Database
+        database to dump
+    path : str
+        snapshot directory, written to <path>/<database name>/
+    collections : list[str], optional
+        names of the collections, by default all
+    filter : dict, optional
+        filter of the documents of each collection, by default all
+    limit : int, optional
+        maximum number of documents of each collection, by default no limit
+
+    Returns
+    -------
+    dict
+        {<collection name>: number of documents}
+    """
+    directory = os.path.join(path, database.name)
+    os.makedirs(directory, exist_ok=True)
+    if collections is None:
+        collections = database.list_collection_names()
+    counts = {}
+    # documents are copied as their raw bytes, ndarray are not decoded
+    codec_options = CodecOptions(document_class=RawBSONDocument)
+    for name in collections:
+        collection = database.get_collection(name, codec_options=codec_options)
+        filename = os.path.join(directory, f"{name}.bson")
+        counts[name] = 0
+        with open(f"{filename}.tmp", "wb") as f:
+            for doc in collection.find(filter, limit=limit):
+                f.write(doc.raw)
+                counts[name] += 1
+        os.replace(f"{filename}.tmp", filename)
+        _write_metadata(collection, directory)
+        logger.info(f"Dumped {counts[name]} documents of {name} to {filename}")
+    return counts
+
+
+def _write_metadata(collection, directory):
+    indexes = []
+    for name, info in collection.index_information().items():
+        info = dict(info)
+        key = {field: direction for field, direction in info.pop("key")}
+        indexes.append({"v": info.pop("v", 2), "key": key, "name": name} | info)
+    filename = os.path.join(directory, f"{collection.name}.metadata.json")
+    with open(filename, "w") as f:
+        f.write(
+            json_util.dumps({"indexes": indexes, "collectionName": collection.name})
+        )
+
+
+def _zip(parser, value):
+    """$zip expression, missing from mongomock"""
+    inputs = [parser.parse(item) for item in value["inputs"]]
+    if any(item is None for item in inputs):
+        return None
+    if not value.get("useLongestLength", False):
+        return [list(items) for items in zip(*inputs)]
+    defaults = value.get("defaults", [None] * len(inputs))
+    length = max((len(item) for item in inputs), default=0)
+    return [
+        [
+            item[i] if i < len(item) else default
+            for item, default in zip(inputs, defaults)
+        ]
+        for i in range(length)
+    ]
+
+
+def _patch_mongomock():
+    from mongomock.aggregate import _Parser
+
+    if getattr(_Parser, "_calypsokit_patched", False):
+        return
+    handle = _Parser._handle_array_operator
+
+    def _handle_array_operator(self, operator, value):
+        if operator == "$zip":
+            return _zip(self, value)
+        return handle(self, operator, value)
+
+    _Parser._handle_array_operator = _handle_array_operator
+    _Parser._calypsokit_patched = True
+
+
+class LocalClient:
+    def __init__(self, path):
+        """In-memory copy of the snapshot in path
+
+        Parameters
+        ----------
+        path : str
+            snapshot directory, created by `save` if not existing
+        """
+        try:
+            import mongomock
+        except ImportError as e:
+            raise ImportError(
+                "the local backend needs mongomock, pip install calypsokit[local]"
+            ) from e
+        _patch_mongomock()
+        self.path = path
+        self._client = mongomock.MongoClient()
+        self._loaded = set()  # {(database name, collection name)}
+        self._dirty = set()
+
+    def get_database(
+        self, name, codec_options=NumpyDatabase.codec_options, policies={}
+    ) -> "LocalDatabase":
+        return LocalDatabase(self, name, codec_options, policies)
+
+    def _filename(self, dbname, name, suffix=".bson"):
+        return os.path.join(self.path, dbname, f"{name}{suffix}")
+
+    def _collection(self, dbname, name):
+        """mongomock collection, loaded from the snapshot on first use"""
+        collection = self._client[dbname][name]
+        if (dbname, name) in self._loaded:
+            return collection
+        self._loaded.add((dbname, name))
+        filename = self._filename(dbname, name)
+        if not os.path.exists(filename):
+            return collection
+        with open(filename, "rb") as f:
+            batch = []
+            for doc in bson.decode_file_iter(f):
+                batch.append(doc)
+                if len(batch) == 1000:
+                    collection.insert_many(batch)
+                    batch = []
+            if len(batch) > 0:
+                collection.insert_many(batch)
+        metadata = self._filename(dbname, name, ".metadata.json")
+        if os.path.exists(metadata):
+            with open(metadata) as f:
+                indexes = json_util.loads(f.read()).get("indexes", [])
+            for index in indexes:
+                if index["name"] == "_id_":
+                    continue
+                options = {k: index[k] for k in ("unique", "sparse") if k in index}
+                keys = list(dict(index["key"]).items())
+                collection.create_index(keys, name=index["name"], **options)
+        logger.info(f"Loaded {collection.count_documents({})} documents of {name}")
+        return collection
+
+    def list_collection_names(self, dbname) -> list:
+        names = set(self._client[dbname].list_collection_names())
+        directory = os.path.join(self.path, dbname)
+        if os.path.isdir(directory):
+            names.update(
+                filename[: -len(".bson")]
+                for filename in os.listdir(directory)
+                if filename.endswith(".bson")
+            )
+        return sorted(names)
+
+    def drop_collection(self, dbname, name):
+        self._client[dbname].drop_collection(name)
+        self._loaded.add((dbname, name))
+        self._dirty.add((dbname, name))
+
+    def save(self):
+        """Write the changed collections back to the snapshot"""
+        for dbname, name in sorted(self._dirty):
+            filename = self._filename(dbname, name)
+            if name not in self._client[dbname].list_collection_names():
+                for suffix in (".bson", ".metadata.json"):
+                    if os.path.exists(self._filename(dbname, name, suffix)):
+                        os.remove(self._filename(dbname, name, suffix))
+                continue
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            collection = self._client[dbname][name]
+            with open(f"{filename}.tmp", "wb") as f:
+                for doc in collection.find():
+                    f.write(bson.encode(doc))
+            os.replace(f"{filename}.tmp", filename)
+            _write_metadata(collection, os.path.dirname(filename))
+            logger.info(f"Saved {name} to {filename}")
+        self._dirty.clear()
+
+
+class LocalDatabase:
+    # a snapshot is not opened again by workers, see NumpyDatabase.login_kwargs
+    login_kwargs = None
+
+    def __init__(
+        self, client, name, codec_options=NumpyDatabase.codec_options, policies={}
+    ):
+        """Database of a LocalClient, in place of a NumpyDatabase
+
+        Parameters
+        ----------
+        client : LocalClient
+            client
+        name : str
+            database name
+        codec_options : CodecOptions, optional
+            by default the NumpyCodec options
+        policies : dict, optional
+            {<collection name>: ArrayPolicy}, see NumpyDatabase
+        """
+        self.client = client
+        self.name = name
+        self.codec_options = codec_options
+        self.policies = policies
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self.get_collection(name)
+
+    def get_collection(self, name, codec_options=None, *args, **kwargs):
+        return LocalCollection(
+            self,
+            name,
+            self.codec_options if codec_options is None else codec_options,
+            self.policies.get(name, None),
+        )
+
+    def list_collection_names(self, *args, **kwargs) -> list:
+        return self.client.list_collection_names(self.name)
+
+    def drop_collection(self, name, *args, **kwargs):
+        self.client.drop_collection(self.name, name)
+
+    def save(self):
+        self.client.save()
+
+
+class LocalCursor:
+    """mongomock cursor yielding decoded documents"""
+
+    def __init__(self, cursor, decode):
+        self._cursor = cursor
+        self._decode = decode
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self._decode(next(self._cursor))
+
+    next = __next__
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if not callable(attr):
+            return attr
+
+        def method(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            return self if result is self._cursor else result
+
+        return method
+
+
+class LocalCollection:
+    def __init__(self, database, name, codec_options, policy=None):
+        """Collection of a LocalDatabase, in place of a pymongo Collection
+
+        Written documents are encoded by the type encoders of codec_options (and
+        the ArrayPolicy if any) as pymongo would, and read documents are decoded by
+        its type decoders.
+        """
+        self.database = database
+        self.name = name
+        self.codec_options = codec_options
+        self.policy = policy
+        registry = codec_options.type_registry
+        self._encoders = {
+            codec.python_type: codec.transform_python
+            for codec in registry.codecs
+            if isinstance(codec, TypeEncoder)
+        }
+        self._fallback = registry.fallback_encoder
+        self._decoders = {
+            codec.bson_type: codec.transform_bson
+            for codec in registry.codecs
+            if isinstance(codec, TypeDecoder)
+        }
+
+    @property
+    def _col(self):
+        return self.database.client._collection(self.database.name, self.name)
+
+    def _changed(self):
+        self.database.client._dirty.add((self.database.name, self.name))
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self._col, name)
+
+    def __getstate__(self):
+        raise TypeError(
+            "collections of the local backend are in one process, run with n_jobs=1"
+        )
+
+    def with_options(self, codec_options=None, *args, **kwargs):
+        return self.database.get_collection(self.name, codec_options)
+
+    # ---------- codec ----------
+    def _encode(self, value):
+        if isinstance(value, Mapping):
+            return {key: self._encode(item) for key, item in value.items()}
+        elif isinstance(value, (list, tuple)):
+            return [self._encode(item) for item in value]
+        encoder = self._encoders.get(type(value), None)
+        if encoder is not None:
+            return encoder(value)
+        elif self._fallback is not None:
+            return self._fallback(value)
+        return value
+
+    def _decode(self, value):
+        if isinstance(value, dict):
+            return {key: self._decode(item) for key, item in value.items()}
+        elif isinstance(value, list):
+            return [self._decode(item) for item in value]
+        decoder = self._decoders.get(type(value), None)
+        return value if decoder is None else decoder(value)
+
+    def _pack(self, document):
+        if self.policy is not None:
+            document = self.policy.apply(dict(document))
+        return self._encode(document)
+
+    def _pack_update(self, update):
+        if self.policy is not None:
+            update = self.policy.apply_update(update)
+        return self._encode(update)
+
+    # ---------- read ----------
+    def find(self, filter=None, *args, **kwargs):
+        cursor = self._col.find(self._encode(filter or {}), *args, **kwargs)
+        return LocalCursor(cursor, self._decode)
+
+    def find_one(self, filter=None, *args, **kwargs):
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        return next(self.find(filter, *args, **kwargs).limit(1), None)
+
+    def count_documents(self, filter, *args, **kwargs):
+        return self._col.count_documents(self._encode(filter), *args, **kwargs)
+
+    def distinct(self, key, filter=None, *args, **kwargs):
+        values = self._col.distinct(key, self._encode(filter), *args, **kwargs)
+        return self._decode(values)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        pipeline = self._encode(list(pipeline))
+        self._load_lookups(pipeline)
+        stage = pipeline[-1] if len(pipeline) > 0 else {}
+        for op in ("$merge", "$bucketAuto"):
+            if any(op in s for s in pipeline[:-1]):
+                raise NotImplementedError(f"{op} is supported as the last stage only")
+        if "$merge" in stage:
+            self._merge(self._col.aggregate(pipeline[:-1]), stage["$merge"])
+            return LocalCursor(iter([]), self._decode)
+        elif "$bucketAuto" in stage:
+            docs = self._bucket_auto(
+                self._col.aggregate(pipeline[:-1]), stage["$bucketAuto"]
+            )
+            return LocalCursor(iter(docs), self._decode)
+        return LocalCursor(self._col.aggregate(pipeline), self._decode)
+
+    def _load_lookups(self, pipeline):
+        """Load the collections joined by $lookup, $graphLookup and $unionWith"""
+        for stage in pipeline:
+            for op, spec in stage.items():
+                if op in ("$lookup", "$graphLookup") and "from" in spec:
+                    self.database[spec["from"]]._col
+                    self._load_lookups(spec.get("pipeline", []))
+                elif op == "$unionWith":
+                    spec = {"coll": spec} if isinstance(spec, str) else spec
+                    self.database[spec["coll"]]._col
+                    self._load_lookups(spec.get("pipeline", []))
+
+    def _merge(self, docs, spec):
+        into = spec["into"] if isinstance(spec["into"], str) else spec["into"]["coll"]
+        on = spec.get("on", "_id")
+        on = [on] if isinstance(on, str) else on
+        matched = spec.get("whenMatched", "merge")
+        not_matched = spec.get("whenNotMatched", "insert")
+        if not isinstance(matched, str) or "let" in spec:
+            raise NotImplementedError("$merge with a pipeline or let")
+        # the documents are encoded already
+        target = self.database.get_collection(into, CodecOptions())
+        for doc in docs:
+            filter = {field: doc[field] for field in on}
+            if target._col.find_one(filter, {"_id": 1}) is not None:
+                if matched == "fail":
+                    raise PyMongoError(f"$merge matched {filter} in {into}")
+                elif matched == "replace":
+                    target.replace_one(filter, doc)
+                elif matched == "merge":
+                    fields = {k: v for k, v in doc.items() if k != "_id"}
+                    if len(fields) > 0:
+                        target.update_one(filter, {"$set": fields})
+            elif not_matched == "insert":
+                target.insert_one(doc)
+            elif not_matched == "fail":
+                raise PyMongoError(f"$merge did not match {filter} in {into}")
+
+    @staticmethod
+    def _bucket_auto(docs, spec) -> list:
+        if set(spec) - {"groupBy", "buckets"}:
+            raise NotImplementedError("$bucketAuto with output or granularity")
+        path = spec["groupBy"]
+        if not (isinstance(path, str) and path.startswith("$")):
+            raise NotImplementedError("$bucketAuto grouped by an expression")
+        values = []
+        for doc in docs:
+            value = doc
+            for key in path[1:].split("."):
+                value = value.get(key, None) if isinstance(value, dict) else None
+            values.append(value)
+        values.sort()
+        size = math.ceil(len(values) / spec["buckets"]) if len(values) > 0 else 0
+        buckets, start = [], 0
+        while start < len(values):
+            stop = min(start + size, len(values))
+            # equal values are in the same bucket
+            while stop < len(values) and values[stop] == values[stop - 1]:
+                stop += 1
+            buckets.append({"min": values[start], "count": stop - start})
+            start = stop
+        # max of a bucket is the min of the next one, the last one is inclusive
+        for bucket, next_bucket in zip(buckets, buckets[1:] + [None]):
+            bucket["max"] = values[-1] if next_bucket is None else next_bucket["min"]
+        return [
+            {
+                "_id": {"min": bucket["min"], "max": bucket["max"]},
+                "count": bucket["count"],
+            }
+            for bucket in buckets
+        ]
+
+    # ---------- write ----------
+    def insert_one(self, document, *args, **kwargs):
+        self._changed()
+        result = self._col.insert_one(self._pack(document), *args, **kwargs)
+        document.setdefault("_id", result.inserted_id)
+        return result
+
+    def insert_many(self, documents, *args, **kwargs):
+        self._changed()
+        documents = list(documents)
+        packed = [self._pack(document) for document in documents]
+        result = self._col.insert_many(packed, *args, **kwargs)
+        for document, _id in zip(documents, result.inserted_ids):
+            document.setdefault("_id", _id)
+        return result
+
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        self._changed()
+        replacement = self._pack(replacement)
+        return self._col.replace_one(self._encode(filter), replacement, *args, **kwargs)
+
+    def update_one(self, filter, update, *args, **kwargs):
+        self._changed()
+        update = self._pack_update(update)
+        return self._col.update_one(self._encode(filter), update, *args, **kwargs)
+
+    def update_many(self, filter, update, *args, **kwargs):
+        self._changed()
+        update = self._pack_update(update)
+        return self._col.update_many(self._encode(filter), update, *args, **kwargs)
+
+    def delete_one(self, filter, *args, **kwargs):
+        self._changed()
+        return self._col.delete_one(self._encode(filter), *args, **kwargs)
+
+    def delete_many(self, filter, *args, **kwargs):
+        self._changed()
+        return self._col.delete_many(self._encode(filter), *args, **kwargs)
+
+    def drop(self, *args, **kwargs):
+        self.database.drop_collection(self.name)
+
+    def bulk_write(self, requests, ordered=True, *args, **kwargs):
+        """Run the requests one by one, as pymongo reports them"""
+        result = {
+            "writeErrors": [],
+            "writeConcernErrors": [],
+            "nInserted": 0,
+            "nUpserted": 0,
+            "nMatched": 0,
+            "nModified": 0,
+            "nRemoved": 0,
+            "upserted": [],
+        }
+        for index, request in enumerate(requests):
+            try:
+                self._write(request, index, result)
+            except PyMongoError as e:
+                result["writeErrors"].append(
+                    {"index": index, "code": getattr(e, "code", None), "errmsg": str(e)}
+                )
+                if ordered:
+                    break
+        if len(result["writeErrors"]) > 0:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _write(self, request, index, result):
+        if isinstance(request, InsertOne):
+            self.insert_one(request._doc)
+            result["nInserted"] += 1
+            return
+        elif isinstance(request, (DeleteOne, DeleteMany)):
+            delete = (
+                self.delete_one if isinstance(request, DeleteOne) else self.delete_many
+            )
+            result["nRemoved"] += delete(request._filter).deleted_count
+            return
+        elif isinstance(request, ReplaceOne):
+            res = self.replace_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+        elif isinstance(request, (UpdateOne, UpdateMany)):
+            update = (
+                self.update_one if isinstance(request, UpdateOne) else self.update_many
+            )
+            res = update(request._filter, request._doc, upsert=request._upsert)
+        else:
+            raise TypeError(f"{type(request).__name__} is not supported")
+        result["nMatched"] += res.matched_count
+        result["nModified"] += res.modified_count
+        if res.upserted_id is not None:
+            result["nUpserted"] += 1
+            result["upserted"].append({"index": index, "_id": res.upserted_id})
@@ -1,14 +1,24 @@
+import copy
 import os
-import pickle
 
 import dotenv
 import numpy as np
 import pymongo
 from bson import Binary
 from bson.binary import USER_DEFINED_SUBTYPE
-from bson.codec_options import CodecOptions, TypeCodec, TypeRegistry
+from bson.codec_options import CodecOptions, TypeCodec, TypeEncoder, TypeRegistry
+from joblib import effective_n_jobs
+from pymongo import InsertOne, ReplaceOne
+from pymongo.collection import Collection
 from pymongo.database import Database
 
+from calypsokit.calydb.codec import (
+    ArrayPolicy,
+    PackedArray,
+    decode_ndarray,
+    encode_ndarray,
+)
+
 
 # =========== Registor Numpy Type ==========
 class NumpyCodec(TypeCodec):
@@ -16,46 +26,312 @@ class NumpyCodec(TypeCodec):
     bson_type = Binary
 
     def transform_python(self, value):
-        return Binary(pickle.dumps(value, protocol=2), USER_DEFINED_SUBTYPE)
+        return Binary(encode_ndarray(value), USER_DEFINED_SUBTYPE)
 
     def transform_bson(self, value):
         if value.subtype == USER_DEFINED_SUBTYPE:
-            return pickle.loads(value)
+            return decode_ndarray(value)
         return value
 
 
+class PackedArrayEncoder(TypeEncoder):
+    python_type = PackedArray
+
+    def transform_python(self, value):
+        return Binary(value.encode(), USER_DEFINED_SUBTYPE)
+
+
 def fallback_encoder(value):
     if isinstance(value, np.ndarray):
-        return Binary(pickle.dumps(value, protocol=2), USER_DEFINED_SUBTYPE)
+        return Binary(encode_ndarray(value), USER_DEFINED_SUBTYPE)
     return value
 
 
+class PolicyCollection(Collection):
+    """Collection encoding the ndarray of written documents by its ArrayPolicy
+
+    Applied to insert_one, insert_many, replace_one, update_one, update_many and
+    the requests of bulk_write. Reading needs nothing, the format is
+    self-describing.
+    """
+
+    policy: ArrayPolicy
+
+    def insert_one(self, document, *args, **kwargs):
+        packed = self.policy.apply(dict(document))
+        result = super().insert_one(packed, *args, **kwargs)
+        document.setdefault("_id", result.inserted_id)
+        return result
+
+    def insert_many(self, documents, *args, **kwargs):
+        documents = list(documents)
+        packed = [self.policy.apply(dict(document)) for document in documents]
+        result = super().insert_many(packed, *args, **kwargs)
+        for document, _id in zip(documents, result.inserted_ids):
+            document.setdefault("_id", _id)
+        return result
+
+    def replace_one(self, filter, replacement, *args, **kwargs):
+        replacement = self.policy.apply(dict(replacement))
+        return super().replace_one(filter, replacement, *args, **kwargs)
+
+    def update_one(self, filter, update, *args, **kwargs):
+        update = self.policy.apply_update(update)
+        return super().update_one(filter, update, *args, **kwargs)
+
+    def update_many(self, filter, update, *args, **kwargs):
+        update = self.policy.apply_update(update)
+        return super().update_many(filter, update, *args, **kwargs)
+
+    def bulk_write(self, requests, *args, **kwargs):
+        return super().bulk_write(
+            [self._apply_request(request) for request in requests], *args, **kwargs
+        )
+
+    def _apply_request(self, request):
+        if isinstance(request, (InsertOne, ReplaceOne)):
+            request = copy.copy(request)
+            request._doc = self.policy.apply(dict(request._doc))
+        elif hasattr(request, "_doc"):  # UpdateOne, UpdateMany
+            request = copy.copy(request)
+            request._doc = self.policy.apply_update(request._doc)
+        return request
+
+    def with_options(self, *args, **kwargs):
+        collection = super().with_options(*args, **kwargs)
+        return self.database.get_collection(
+            self.name,
+            collection.codec_options,
+            collection.read_preference,
+            collection.write_concern,
+            collection.read_concern,
+        )
+
+
 class NumpyDatabase(Database):
     numpy_codec = NumpyCodec()
-    type_registry = TypeRegistry([numpy_codec], fallback_encoder=fallback_encoder)
+    type_registry = TypeRegistry(
+        [numpy_codec, PackedArrayEncoder()], fallback_encoder=fallback_encoder
+    )
     codec_options: CodecOptions
     codec_options = CodecOptions(type_registry=type_registry, tz_aware=False)
+    # kwargs of `login` to open this database again in another process, set by login
+    login_kwargs = None
 
-    def __init__(self, client, name, codec_options=codec_options, **kwargs):
+    def __init__(
+        self, client, name, codec_options=codec_options, policies={}, **kwargs
+    ):
+        """Database encoding ndarray in the raw-buffer format, see calydb.codec
+
+        Parameters
+        ----------
+        client : pymongo.MongoClient
+            client
+        name : str
+            database name
+        codec_options : CodecOptions, optional
+            by default the NumpyCodec options
+        policies : dict, optional
+            {<collection name>: ArrayPolicy}, the ndarray written to these
+            collections are encoded by their policy, by default empty
+        """
         super().__init__(client, name, codec_options, **kwargs)
+        self.policies = policies
+
+    def __getitem__(self, name):
+        return self.get_collection(name)
+
+    def get_collection(self, name, *args, **kwargs):
+        if name not in self.policies:
+            return super().get_collection(name, *args, **kwargs)
+        base = super().get_collection(name, *args, **kwargs)
+        collection = PolicyCollection(
+            self,
+            name,
+            False,
+            base.codec_options,
+            base.read_preference,
+            base.write_concern,
+            base.read_concern,
+        )
+        collection.policy = self.policies[name]
+        return collection
+
+
+# {(pid, uri, options): MongoClient}, one pooled client per process and parameters
+_CLIENTS = {}
 
+# .env variable: (MongoClient keyword, type)
+CLIENT_OPTIONS = {
+    "MONGODB_MAX_POOL_SIZE": ("maxPoolSize", int),
+    "MONGODB_MIN_POOL_SIZE": ("minPoolSize", int),
+    "MONGODB_MAX_IDLE_TIME_MS": ("maxIdleTimeMS", int),
+    "MONGODB_COMPRESSORS": ("compressors", str),
+    "MONGODB_CONNECT_TIMEOUT_MS": ("connectTimeoutMS", int),
+    "MONGODB_SOCKET_TIMEOUT_MS": ("socketTimeoutMS", int),
+    "MONGODB_SERVER_SELECTION_TIMEOUT_MS": ("serverSelectionTimeoutMS", int),
+}
 
-def login(addr=None, user=None, pwd=None, dbname=None, dotenv_path=None):
+
+def client_options_from_env() -> dict:
+    """MongoClient kwargs of the configured CLIENT_OPTIONS variables"""
+    options = {}
+    for var, (keyword, type) in CLIENT_OPTIONS.items():
+        value = os.environ.get(var, None)
+        if value is not None and value != "":
+            options[keyword] = type(value)
+    return options
+
+
+def get_client(uri, **options) -> pymongo.MongoClient:
+    """The MongoClient of this process for uri and options, created on first use
+
+    A MongoClient must not be used across fork, so the clients are keyed by the
+    process id as well, and a child process creates its own client instead of
+    using the one of its parent.
+    """
+    pid = os.getpid()
+    for key in [key for key in _CLIENTS if key[0] != pid]:
+        del _CLIENTS[key]  # inherited from the parent, never used here
+    key = (pid, uri, tuple(sorted(options.items())))
+    if key not in _CLIENTS:
+        _CLIENTS[key] = pymongo.MongoClient(uri, **options)
+    return _CLIENTS[key]
+
+
+def close_clients():
+    """Close and forget the clients of this process"""
+    pid = os.getpid()
+    for key in [key for key in _CLIENTS if key[0] == pid]:
+        _CLIENTS.pop(key).close()
+
+
+def login(
+    addr=None,
+    user=None,
+    pwd=None,
+    dbname=None,
+    dotenv_path=None,
+    policies={},
+    backend=None,
+    local_path=None,
+):
+    """Database of the .env configuration, on the client of this process
+
+    The pool and timeouts of the client are configured by the optional
+    CLIENT_OPTIONS variables in .env, e.g. MONGODB_MAX_POOL_SIZE=50.
+
+    With MONGODB_BACKEND=local (or backend="local"), the database is a LocalDatabase
+    of the snapshot in MONGODB_LOCAL_PATH instead, see calydb.local; no server,
+    user or password is needed.
+
+    The returned NumpyDatabase keeps the resolved kwargs in `login_kwargs`, so that
+    worker processes can login to the same database by themselves.
+    """
     dotenv.load_dotenv(dotenv_path=dotenv_path, override=True)
     addr = os.environ.get('MONGODB_ADDR', None) if addr is None else addr
     user = os.environ.get('MONGODB_USER', None) if user is None else user
     pwd = os.environ.get('MONGODB_PWD', None) if pwd is None else pwd
     dbname = os.environ.get('MONGODB_DATABASE', None) if dbname is None else dbname
+    if backend is None:
+        backend = os.environ.get('MONGODB_BACKEND', None) or "mongodb"
+    if local_path is None:
+        local_path = os.environ.get('MONGODB_LOCAL_PATH', None)
+
+    if backend == "local":
+        if local_path is None or dbname is None:
+            raise ValueError("MONGODB_LOCAL_PATH and MONGODB_DATABASE not configured")
+        from calypsokit.calydb.local import get_local_client
+
+        return get_local_client(local_path).get_database(dbname, policies=policies)
+    elif backend != "mongodb":
+        raise ValueError(f"unknown backend {backend}, 'mongodb' or 'local'")
 
     for key in (addr, user, pwd, dbname):
         if key is None:
             raise ValueError(f"{key} not configured in .env file")
 
-    client = pymongo.MongoClient(f"mongodb://{user}:{pwd}@{addr}")
-    database = NumpyDatabase(client, dbname)
+    client = get_client(f"mongodb://{user}:{pwd}@{addr}", **client_options_from_env())
+    database = NumpyDatabase(client, dbname, policies=policies)
+    database.login_kwargs = {
+        "addr": addr,
+        "user": user,
+        "pwd": pwd,
+        "dbname": dbname,
+        "dotenv_path": dotenv_path,
+        "policies": policies,
+        "backend": backend,
+    }
     return database
 
 
+# {(pid, token): object}, built once in each worker process on its own client
+_WORKER_OBJECTS = {}
+
+
+def worker_config(obj, token, collections, kwargs, login_kwargs=None, n_jobs=None):
+    """`obj` itself if its work runs in this process, else the picklable config for
+    each worker process to login and build its own copy, see `worker_object`
+
+    Collections cannot be pickled to worker processes, so the copy is built by
+    `type(obj)(*collections, **kwargs)` on the collections of the same names.
+
+    Parameters
+    ----------
+    obj : object
+        the object doing the work in this process
+    token : str
+        identity of `obj`, workers build one copy of each token
+    collections : list[Collection]
+        collections of `obj`, of one database
+    kwargs : dict
+        other kwargs to build the copy
+    login_kwargs : dict, optional
+        kwargs of `login` for the workers, by default the `login_kwargs` of the
+        database of `collections`
+    n_jobs : int, optional
+        n_jobs of joblib, by default None
+
+    Raises
+    ------
+    ValueError
+        if the work runs in worker processes, no `login_kwargs` is given and the
+        database was not opened by `login`
+    """
+    if login_kwargs is None and effective_n_jobs(n_jobs) == 1:
+        return obj
+    if login_kwargs is None:
+        login_kwargs = getattr(collections[0].database, "login_kwargs", None)
+    # a plain pymongo Database returns a Collection for any attribute
+    if not isinstance(login_kwargs, dict):
+        raise ValueError(
+            f"n_jobs={n_jobs} needs login_kwargs: the collections are not from a "
+            "database opened by login, and cannot be pickled to workers"
+        )
+    return {
+        "token": token,
+        "login_kwargs": login_kwargs,
+        "cls": type(obj),
+        "collections": [col.name for col in collections],
+        "kwargs": kwargs,
+    }
+
+
+def worker_object(config):
+    """The object of a `worker_config` in this process, built after one login in
+    each worker process"""
+    if not isinstance(config, dict):
+        return config
+    key = (os.getpid(), config["token"])
+    if key not in _WORKER_OBJECTS:
+        db = login(**config["login_kwargs"])
+        _WORKER_OBJECTS[key] = config["cls"](
+            *(db.get_collection(name) for name in config["collections"]),
+            **config["kwargs"],
+        )
+    return _WORKER_OBJECTS[key]
+
+
 def maintain_indexes(col) -> dict:
     iinfo = col.index_information()
     if ("material_id_1" in iinfo) and (not iinfo["material_id_1"].get("unique", False)):
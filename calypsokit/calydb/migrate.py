@@ -0,0 +1,299 @@
+"""Re-encode the ndarray fields of existing documents
+
+The _id of a collection are split into ranges, each scanned in _id order by one
+worker, which re-encodes every ndarray Binary by the current format (and an
+ArrayPolicy if given) and writes the changed fields back by unordered
+bulk_write. An update only matches if the fields are still those read, so a
+concurrent write between the read and the bulk_write is never reverted; the
+document is skipped and counted. The ranges and the last _id written in each are
+checkpointed in `<collection>_migrate`, so an interrupted migration resumes where
+it stopped.
+"""
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from bson.binary import USER_DEFINED_SUBTYPE, Binary
+from bson.codec_options import CodecOptions
+from joblib import Parallel, delayed, effective_n_jobs
+from pymongo import UpdateOne
+from tqdm import tqdm
+
+from calypsokit.calydb.codec import decode_ndarray, encode_ndarray
+from calypsokit.calydb.login import worker_config, worker_object
+
+logger = logging.getLogger(__name__)
+
+
+def _run_range(config, checkpoint, dry_run, rate):
+    return worker_object(config)._migrate_range(checkpoint, dry_run, rate)
+
+
+def _get_path(doc, path):
+    for key in path.split("."):
+        doc = doc[key]
+    return doc
+
+
+class CodecMigrator:
+    def __init__(
+        self,
+        collection,
+        policy=None,
+        batch_size=500,
+        nranges=64,
+        login_kwargs=None,
+        n_jobs=None,
+    ):
+        """Re-encode the ndarray fields of collection
+
+        Examples
+        --------
+        >>> migrator = CodecMigrator(db.raw, ArrayPolicy(...), n_jobs=4)
+        >>> migrator.migrate(dry_run=True)
+        {"ndocs": ..., "nchanged": ..., "old_bytes": ..., "new_bytes": ...}
+        >>> migrator.migrate(rate=2000)
+
+        Parameters
+        ----------
+        collection : pymongo.collection.Collection
+            collection to migrate
+        policy : ArrayPolicy, optional
+            encoding options of each field, the plain raw-buffer format if None
+        batch_size : int, optional
+            number of documents in one read and one bulk_write, by default 500
+        nranges : int, optional
+            number of _id ranges scanned in parallel, by default 64
+        login_kwargs : dict, optional
+            kwargs of `login` for each worker to connect by itself, by default
+            those of the database of collection, required for n_jobs != 1 if it
+            was not opened by `login` (a collection cannot be pickled)
+        n_jobs : int, optional
+            parallel jobs of joblib, by default None (one process)
+        """
+        self.col = collection
+        # read Binary as they are stored, NumpyCodec would decode them
+        self.rawcol = collection.with_options(codec_options=CodecOptions())
+        self.checkpoints = collection.database.get_collection(
+            f"{collection.name}_migrate"
+        )
+        self.policy = policy
+        self.batch_size = batch_size
+        self.nranges = nranges
+        self.login_kwargs = login_kwargs
+        self.n_jobs = n_jobs
+        self.migrator_kwargs = {"policy": policy, "batch_size": batch_size}
+        self.token = os.urandom(8).hex()
+
+    @property
+    def run(self) -> str:
+        """Key of the checkpoints, one per collection and policy"""
+        options = None
+        if self.policy is not None:
+            options = {"defaults": self.policy.defaults, "fields": self.policy.fields}
+        params = json.dumps(options, sort_keys=True, default=repr)
+        return f"{self.col.name}:{hashlib.sha1(params.encode()).hexdigest()}"
+
+    def plan(self, resume=True, save=True) -> list:
+        """Checkpoint of each _id range, the saved ones if resume, new ones are
+        saved if save"""
+        if resume:
+            checkpoints = list(self.checkpoints.find({"run": self.run}).sort("index"))
+            if len(checkpoints) > 0:
+                return checkpoints
+        if save:
+            self.checkpoints.delete_many({"run": self.run})
+        buckets = self.rawcol.aggregate(
+            [{"$bucketAuto": {"groupBy": "$_id", "buckets": self.nranges}}],
+            allowDiskUse=True,
+        )
+        buckets = list(buckets)
+        # max of a bucket is the min of the next one, only the last is inclusive
+        checkpoints = [
+            {
+                "_id": f"{self.run}:{index}",
+                "run": self.run,
+                "index": index,
+                "min": bucket["_id"]["min"],
+                "max": bucket["_id"]["max"],
+                "inclusive": index == len(buckets) - 1,
+                "last": None,
+                "done": False,
+            }
+            for index, bucket in enumerate(buckets)
+        ]
+        if save and len(checkpoints) > 0:
+            self.checkpoints.insert_many(checkpoints)
+        return checkpoints
+
+    def migrate(self, dry_run=False, rate=None, resume=True) -> dict:
+        """Re-encode all documents
+
+        Parameters
+        ----------
+        dry_run : bool, optional
+            only count the documents and bytes to change (of the remaining ranges
+            if resume), write nothing, by default False
+        rate : float, optional
+            maximum documents per second of all workers, unlimited if None
+        resume : bool, optional
+            continue from the checkpoints of the same collection and policy, by
+            default True
+
+        Returns
+        -------
+        dict
+            {"ndocs": scanned, "nchanged": changed, "nskipped": changed by others
+            after the read and left as they are, "old_bytes": ..., "new_bytes":
+            ...}, bytes of the ndarray fields of the changed documents
+        """
+        checkpoints = self.plan(resume, save=not dry_run)
+        checkpoints = [c for c in checkpoints if not c["done"]]
+        logger.info(f"Migrating {len(checkpoints)} _id ranges of {self.col.name}")
+        config = self._worker_config()
+        if rate is not None:
+            rate = rate / min(effective_n_jobs(self.n_jobs), max(len(checkpoints), 1))
+        returns = Parallel(
+            n_jobs=self.n_jobs,
+            backend="loky",
+            batch_size=1,
+            return_as="generator_unordered",
+        )(
+            delayed(_run_range)(config, checkpoint, dry_run, rate)
+            for checkpoint in checkpoints
+        )
+        total = {
+            "ndocs": 0,
+            "nchanged": 0,
+            "nskipped": 0,
+            "old_bytes": 0,
+            "new_bytes": 0,
+        }
+        for stat in tqdm(returns, total=len(checkpoints)):
+            for key in total:
+                total[key] += stat[key]
+        saved = total["old_bytes"] - total["new_bytes"]
+        ratio = saved / total["old_bytes"] if total["old_bytes"] > 0 else 0.0
+        logger.info(
+            f"{'Would re-encode' if dry_run else 'Re-encoded'} {total['nchanged']} of "
+            f"{total['ndocs']} documents, {saved / 2**20:.1f} MiB ({ratio:.1%}) of "
+            f"ndarray fields saved, {total['nskipped']} skipped as changed meanwhile"
+        )
+        return total
+
+    def _worker_config(self):
+        """This migrator if the ranges run in this process, else the picklable
+        config for each worker to login and build its own migrator"""
+        return worker_config(
+            self,
+            self.token,
+            [self.col],
+            self.migrator_kwargs,
+            self.login_kwargs,
+            self.n_jobs,
+        )
+
+    def _migrate_range(self, checkpoint, dry_run=False, rate=None) -> dict:
+        """Scan one _id range from its last checkpoint"""
+        stat = {
+            "ndocs": 0,
+            "nchanged": 0,
+            "nskipped": 0,
+            "old_bytes": 0,
+            "new_bytes": 0,
+        }
+        upper = "$lte" if checkpoint["inclusive"] else "$lt"
+        last = checkpoint["last"]
+        while True:
+            lower = {"$gte": checkpoint["min"]} if last is None else {"$gt": last}
+            start = time.monotonic()
+            batch = list(
+                self.rawcol.find({"_id": lower | {upper: checkpoint["max"]}})
+                .sort("_id", 1)
+                .limit(self.batch_size)
+            )
+            if len(batch) == 0:
+                break
+            requests = []
+            for doc in batch:
+                updates, old_bytes, new_bytes = self.reencode(doc)
+                if len(updates) > 0:
+                    # only if unchanged since read
+                    filter = {"_id": doc["_id"]}
+                    filter |= {path: _get_path(doc, path) for path in updates}
+                    requests.append(UpdateOne(filter, {"$set": updates}))
+                    stat["old_bytes"] += old_bytes
+                    stat["new_bytes"] += new_bytes
+            stat["ndocs"] += len(batch)
+            last = batch[-1]["_id"]
+            if dry_run or len(requests) == 0:
+                stat["nchanged"] += len(requests)
+            else:
+                matched = self.rawcol.bulk_write(requests, ordered=False).matched_count
+                stat["nchanged"] += matched
+                stat["nskipped"] += len(requests) - matched
+            if not dry_run:
+                self.checkpoints.update_one(
+                    {"_id": checkpoint["_id"]},
+                    {"$set": {"last": last, "last_updated_utc": datetime.utcnow()}},
+                )
+            if rate is not None:
+                time.sleep(max(len(batch) / rate - (time.monotonic() - start), 0))
+        if not dry_run:
+            self.checkpoints.update_one(
+                {"_id": checkpoint["_id"]}, {"$set": {"done": True}}
+            )
+        return stat
+
+    def reencode(self, doc: dict) -> tuple:
+        """`$set` of the changed ndarray fields of a raw document
+
+        Returns
+        -------
+        updates : dict
+            {<dotted path>: Binary or list}, lists are set as a whole
+        old_bytes, new_bytes : int
+            bytes of the changed fields before and after
+        """
+        updates = {}
+        old_bytes = new_bytes = 0
+        stack = [(doc, "")]
+        while stack:
+            value, path = stack.pop()
+            for key, item in value.items():
+                item_path = f"{path}.{key}" if path else key
+                if isinstance(item, dict):
+                    stack.append((item, item_path))
+                    continue
+                # arrays in a list are set as the whole list
+                items = item if isinstance(item, list) else [item]
+                new_items, changed = [], False
+                for element in items:
+                    if self._is_ndarray(element):
+                        new = self._encode(element, item_path)
+                        if new != element:
+                            changed = True
+                            old_bytes += len(element)
+                            new_bytes += len(new)
+                        element = new
+                    new_items.append(element)
+                if changed:
+                    updates[item_path] = (
+                        new_items if isinstance(item, list) else new_items[0]
+                    )
+        return updates, old_bytes, new_bytes
+
+    @staticmethod
+    def _is_ndarray(value) -> bool:
+        return isinstance(value, Binary) and value.subtype == USER_DEFINED_SUBTYPE
+
+    def _encode(self, value: Binary, path: str) -> Binary:
+        array = decode_ndarray(value)
+        if self.policy is None:
+            data = encode_ndarray(array)
+        else:
+            data = self.policy.pack(array, path).encode()
+        return Binary(data, USER_DEFINED_SUBTYPE)
@@ -1,202 +1,185 @@
+import os
+
 from joblib import Parallel, delayed
+from pymongo import UpdateOne
 from tqdm import tqdm
 
 from calypsokit.analysis import properties
-from calypsokit.calydb.login import login
+from calypsokit.calydb.login import login, worker_config, worker_object
 from calypsokit.calydb.queries import QueryStructure
+from calypsokit.utils.itertools import batched
+
+
+def _patch_chunk(config, patch_func, chunk):
+    worker_object(config)._patch_chunk(patch_func, chunk)
 
 
 class RawRecordPatcher:
-    def __init__(self, rawcol):
+    def __init__(self, rawcol, chunk_size=500, login_kwargs=None, n_jobs=None):
+        """Patch missing fields of the undeprecated raw records
+
+        The _id to patch are split in chunks, each chunk is queried by one
+        `QueryStructure.get_many` and written back by one bulk_write. Only the first
+        and the last frames of the trajectory are read.
+
+        Parameters
+        ----------
+        rawcol : pymongo.collection.Collection
+            raw collection
+        chunk_size : int, optional
+            number of records in one query and one bulk_write, by default 500
+        login_kwargs : dict, optional
+            kwargs of `login` for each worker to connect by itself, by default
+            those of the database of rawcol, required for n_jobs != 1 if it was not
+            opened by `login` (a collection cannot be pickled)
+        n_jobs : int, optional
+            parallel jobs of joblib, by default None (one process)
+        """
         self.rawcol = rawcol
-        self.qs = QueryStructure(rawcol, None, trajectory=True, type="pmg")
-
-    def parallel_patch_cell_abc(self):
+        self.chunk_size = chunk_size
+        self.login_kwargs = login_kwargs
+        self.n_jobs = n_jobs
+        self.token = os.urandom(8).hex()
+        self.qs = QueryStructure(
+            rawcol,
+            None,
+            trajectory=True,
+            type="pmg",
+            max_entries=chunk_size,
+            frames=[0, -1],
+        )
+
+    def _worker_config(self):
+        """This patcher if the chunks are patched in this process, else the
+        picklable config for each worker to login and build its own patcher"""
+        return worker_config(
+            self,
+            self.token,
+            [self.rawcol],
+            {"chunk_size": self.chunk_size},
+            self.login_kwargs,
+            self.n_jobs,
+        )
+
+    def parallel_patch(self, field, patch_func):
+        """Patch the undeprecated records without `field` in parallel
+
+        Parameters
+        ----------
+        field : str
+            (dotted) field name, records with this field are skipped
+        patch_func : Callable[[dict], dict]
+            map a QueryStructure record to its `$set` fields
+        """
+        config = self._worker_config()
         cursor = self.rawcol.find(
-            {"deprecated": False, "cell_abc": {"$exists": False}}, {"_id": 1}
+            {"deprecated": False, field: {"$exists": False}}, {"_id": 1}
         )
         _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_cell_abc)(_id) for _id in tqdm(_id_list)
+        chunks = list(batched(_id_list, self.chunk_size))
+        Parallel(n_jobs=self.n_jobs, backend="multiprocessing")(
+            delayed(_patch_chunk)(config, patch_func, chunk) for chunk in tqdm(chunks)
         )
 
-    def _patch_cell_abc(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        cell_abc = list(final_frame.lattice.abc)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"cell_abc": cell_abc}})
+    def _patch_chunk(self, patch_func, chunk):
+        requests = [
+            UpdateOne({"_id": record["_id"]}, {"$set": patch_func(record)})
+            for record in self.qs.get_many(chunk, self.chunk_size)
+            if record is not None
+        ]
+        if len(requests) > 0:
+            self.rawcol.bulk_write(requests, ordered=False)
+
+    def parallel_patch_cell_abc(self):
+        self.parallel_patch("cell_abc", self._patch_cell_abc)
+
+    @staticmethod
+    def _patch_cell_abc(record):
+        final_frame = record["_structure_"][-1]
+        return {"cell_abc": list(final_frame.lattice.abc)}
 
     def parallel_patch_cell_angles(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "cell_angles": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_cell_angles)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("cell_angles", self._patch_cell_angles)
 
-    def _patch_cell_angles(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        cell_angles = list(final_frame.lattice.angles)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"cell_angles": cell_angles}})
+    @staticmethod
+    def _patch_cell_angles(record):
+        final_frame = record["_structure_"][-1]
+        return {"cell_angles": list(final_frame.lattice.angles)}
 
     def parallel_patch_volume_per_atom(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "volume_per_atom": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_volume_per_atom)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("volume_per_atom", self._patch_volume_per_atom)
 
-    def _patch_volume_per_atom(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        volume_per_atom = record["volume"] / record["natoms"]
-        self.rawcol.update_one(
-            {"_id": _id},
-            {"$set": {"volume_per_atom": volume_per_atom}},
-        )
+    @staticmethod
+    def _patch_volume_per_atom(record):
+        return {"volume_per_atom": record["volume"] / record["natoms"]}
 
     def parallel_patch_volume_rate(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "volume_rate": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_volume_rate)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("volume_rate", self._patch_volume_rate)
 
-    def _patch_volume_rate(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        self.rawcol.update_one(
-            {"_id": _id},
-            {"$set": {"volume_rate": record["volume"] / record["clospack_volume"]}},
-        )
+    @staticmethod
+    def _patch_volume_rate(record):
+        return {"volume_rate": record["volume"] / record["clospack_volume"]}
 
     def parallel_patch_min_distance(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "min_distance": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_min_distance)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("min_distance", self._patch_min_distance)
 
-    def _patch_min_distance(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        min_distance = properties.get_min_distance(final_frame)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"min_distance": min_distance}})
+    @staticmethod
+    def _patch_min_distance(record):
+        final_frame = record["_structure_"][-1]
+        return {"min_distance": properties.get_min_distance(final_frame)}
 
     def parallel_patch_dim_larsen(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "dim_larsen": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_dim_larsen)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("dim_larsen", self._patch_dim_larsen)
 
-    def _patch_dim_larsen(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        dim_larsen = properties.get_dim_larsen(final_frame)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"dim_larsen": dim_larsen}})
+    @staticmethod
+    def _patch_dim_larsen(record):
+        final_frame = record["_structure_"][-1]
+        return {"dim_larsen": properties.get_dim_larsen(final_frame)}
 
     def parallel_patch_kabsch(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "trajectory.kabsch": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_kabsch)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("trajectory.kabsch", self._patch_kabsch)
 
-    def _patch_kabsch(self, _id):
-        record = self.qs.find_one({"_id": _id})
+    @staticmethod
+    def _patch_kabsch(record):
         celli = record["trajectory"]["cell"][0]
         cellr = record["trajectory"]["cell"][-1]
-        kabsch_info = properties.get_kabsch_info(celli, cellr)
-        self.rawcol.update_one(
-            {"_id": _id},
-            {"$set": {"trajectory.kabsch": kabsch_info}},
-        )
+        return {"trajectory.kabsch": properties.get_kabsch_info(celli, cellr)}
 
     def parallel_patch_shifted_d_frac(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "trajectory.shifted_d_frac": {"$exists": False}},
-            {"_id": 1},
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_shifted_d_frac)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("trajectory.shifted_d_frac", self._patch_shifted_d_frac)
 
-    def _patch_shifted_d_frac(self, _id):
-        record = self.qs.find_one({"_id": _id})
+    @staticmethod
+    def _patch_shifted_d_frac(record):
         fraci = record["trajectory"]["scaled_positions"][0]
         fracr = record["trajectory"]["scaled_positions"][-1]
-        shifted_d_frac_info = properties.get_shifted_d_frac(fraci, fracr)
-        self.rawcol.update_one(
-            {"_id": _id},
-            {"$set": {"trajectory.shifted_d_frac": shifted_d_frac_info}},
-        )
+        return {
+            "trajectory.shifted_d_frac": properties.get_shifted_d_frac(fraci, fracr)
+        }
 
     def parallel_patch_strain(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "trajectory.strain": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_strain)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("trajectory.strain", self._patch_strain)
 
-    def _patch_strain(self, _id):
-        record = self.qs.find_one({"_id": _id})
+    @staticmethod
+    def _patch_strain(record):
         celli = record["trajectory"]["cell"][0]
         cellr = record["trajectory"]["cell"][-1]
-        strain_info = properties.get_strain_info(celli, cellr)
-        self.rawcol.update_one(
-            {"_id": _id},
-            {"$set": {"trajectory.strain": strain_info}},
-        )
+        return {"trajectory.strain": properties.get_strain_info(celli, cellr)}
 
     def parallel_patch_cif(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "cif": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_cif)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("cif", self._patch_cif)
 
-    def _patch_cif(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        cif = properties.get_cif_str(final_frame)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"cif": cif}})
+    @staticmethod
+    def _patch_cif(record):
+        final_frame = record["_structure_"][-1]
+        return {"cif": properties.get_cif_str(final_frame)}
 
     def parallel_patch_poscar(self):
-        cursor = self.rawcol.find(
-            {"deprecated": False, "poscar": {"$exists": False}}, {"_id": 1}
-        )
-        _id_list = [record["_id"] for record in cursor]
-        Parallel(backend="multiprocessing")(
-            delayed(self._patch_poscar)(_id) for _id in tqdm(_id_list)
-        )
+        self.parallel_patch("poscar", self._patch_poscar)
 
-    def _patch_poscar(self, _id):
-        record = self.qs.find_one({"_id": _id})
-        trajectory = record["_structure_"]
-        final_frame = trajectory[-1]
-        poscar = properties.get_poscar_str(final_frame)
-        self.rawcol.update_one({"_id": _id}, {"$set": {"poscar": poscar}})
+    @staticmethod
+    def _patch_poscar(record):
+        final_frame = record["_structure_"][-1]
+        return {"poscar": properties.get_poscar_str(final_frame)}
 
 
 if __name__ == "__main__":
@@ -1,16 +1,81 @@
 import logging
+import sys
 
-from collections import UserDict
+from collections import OrderedDict, UserDict
 from datetime import datetime
 from typing import Any, Optional
 
+import numpy as np
 from ase import Atoms
 from bson import ObjectId
 from pymatgen.core.structure import Structure
 
+from calypsokit.calydb.trajstore import FRAME_FIELDS, TrajectoryStore
+from calypsokit.utils.itertools import batched, prefetched
 
 logger = logging.getLogger(__name__)
 
+# approximate memory of one pymatgen PeriodicSite (species, coords, lattice ref)
+_PMG_SITE_BYTES = 700
+
+
+def estimate_nbytes(obj) -> int:
+    """Approximate memory of a cached record, ndarray and structures are counted
+    by their data, containers recursively, other objects by sys.getsizeof"""
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes
+    elif isinstance(obj, Structure):
+        return len(obj) * _PMG_SITE_BYTES
+    elif isinstance(obj, Atoms):
+        return sum(arr.nbytes for arr in obj.arrays.values()) + obj.cell.array.nbytes
+    elif isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(
+            estimate_nbytes(key) + estimate_nbytes(value) for key, value in obj.items()
+        )
+    elif isinstance(obj, (list, tuple)):
+        return sys.getsizeof(obj) + sum(estimate_nbytes(item) for item in obj)
+    else:
+        return sys.getsizeof(obj)
+
+
+class LazyRecord(dict):
+    """Record whose `_structure_` is built from the raw fields on first access
+
+    `_structure_` is not an item until built, so it is not in keys(), items() or
+    copies of an unbuilt record. `record["_structure_"]` and `record.get(...)` build
+    it, `"_structure_" in record` is always True. Pickled as a plain dict with the
+    structure.
+    """
+
+    def __init__(self, record: dict, build, on_build=None):
+        super().__init__(record)
+        self._build = build
+        self._on_build = on_build
+
+    def __missing__(self, key):
+        if key != "_structure_":
+            raise KeyError(key)
+        structure = self._build(self)
+        self["_structure_"] = structure
+        if self._on_build is not None:
+            self._on_build(self)
+        return structure
+
+    def __contains__(self, key):
+        return key == "_structure_" or super().__contains__(key)
+
+    def get(self, key, default=None):
+        if key == "_structure_":
+            return self[key]
+        return super().get(key, default)
+
+    @property
+    def built(self) -> bool:
+        return super().__contains__("_structure_")
+
+    def __reduce__(self):
+        return (dict, (dict(self, _structure_=self["_structure_"]),))
+
 
 class QueryStructure(UserDict):
     """Query and cache structure or trajectory in this dict
@@ -21,6 +86,13 @@ class QueryStructure(UserDict):
     Call QueryStructure(...)[<_id>] will first find the cached dict, then call
     find_one(_id), return None if nothing is found.
 
+    Records are LazyRecord, `_structure_` is only built from the raw fields when it
+    is first read, so scans reading scalar properties never build structures.
+
+    The cache is unbounded by default. With `max_entries` or `max_bytes`, the least
+    recently used records are evicted, except the pinned ones. The byte size of a
+    record is estimated by `estimate_nbytes`.
+
     Examples
     --------
     Only query structure and output pymatgen-type
@@ -35,6 +107,10 @@ class QueryStructure(UserDict):
     ...     break
     {..., "_structure_": <one pmg structure>}
 
+    Fetch the next batches in background for a long scan
+    >>> for item in qs.find({}, prefetch=2, batch_size=1000):
+    ...     process(item)
+
     Query structure and other properties, output ase-type
     >>> col: collection
     >>> projection = {"enthalpy_per_atom": 1}
@@ -49,9 +125,34 @@ class QueryStructure(UserDict):
     >>> qs.find_one()
     {..., "_structure_": <list of ase structures>, "enthalpy_per_atom": <enth>}
 
+    Only the first and the last frames, read from TrajectoryStore if offloaded
+    >>> qs = QueryStructure(col, trajectory=True, frames=[0, -1])
+    >>> qs.find_one()
+    {..., "_structure_": [<initial structure>, <final structure>]}
+
+    Query many records in chunked round trips, in the given order
+    >>> records = qs.get_many([_id1, _id2])
+    >>> missing = qs.prefetch(ids)
+
+    Bound the cache, keep some records
+    >>> qs = QueryStructure(col, max_entries=1000, max_bytes=2**30)
+    >>> qs.pin(_id)
+    >>> qs.stats
+    {"hits": ..., "misses": ..., "evictions": ..., "entries": ..., "nbytes": ...}
+
     """
 
-    def __init__(self, collection, projection={}, trajectory=False, type="pmg"):
+    def __init__(
+        self,
+        collection,
+        projection={},
+        trajectory=False,
+        type="pmg",
+        max_entries=None,
+        max_bytes=None,
+        frames=None,
+        trajstore=None,
+    ):
         """Init this dict
 
         Parameters
@@ -65,8 +166,27 @@ class QueryStructure(UserDict):
         type: {'pmg', 'ase'}, default 'pmg'
             type of returned structure, 'pmg' for pymatgen Structure,
             'ase' for ase Atoms
+        max_entries: Optional[int], default None
+            maximum number of cached records, unbounded if None
+        max_bytes: Optional[int], default None
+            approximate maximum memory of cached records, unbounded if None
+        frames: Optional[list[int]], default None
+            with trajectory, only keep these frames (negative ones count from the
+            end) of `trajectory.cell/positions/scaled_positions/forces`, all if None
+        trajstore: Optional[TrajectoryStore], default None
+            store of the offloaded trajectories, TrajectoryStore of the collection
+            database if None
         """
         super().__init__()
+        self.data = OrderedDict()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.pinned = set()
+        self.nbytes = 0
+        self._sizes = {}  # {_id: estimated nbytes}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.col = collection
         if projection is None:
             self.projection = {}
@@ -83,6 +203,14 @@ class QueryStructure(UserDict):
             raise ValueError("projection must be a dict or None")
         self.trajectory = trajectory
         self.type = type
+        self.frames = frames
+        self._trajstore = trajstore
+
+    @property
+    def trajstore(self) -> TrajectoryStore:
+        if self._trajstore is None:
+            self._trajstore = TrajectoryStore(self.col.database)
+        return self._trajstore
 
     def find_one(self, filter: dict = {}):
         """find one structure
@@ -98,38 +226,191 @@ class QueryStructure(UserDict):
         """
         record = self.col.find_one(filter, self.projection)
         if record is not None:
-            if record["_id"] not in self.data:
-                record["_structure_"] = self.record2structure(record)
-                self.data[record["_id"]] = record
-            return self.data[record["_id"]]
+            self._load_frames([record])
+            return self._cache(record)
         else:
             return None
 
-    def find(self, filter: dict):
+    def find(self, filter: dict, prefetch: int = 0, batch_size: int = 1000):
         """find many sturctures
 
         Parameters
         ----------
         filter : dict
             query filter.
+        prefetch : int, optional
+            if positive, a background thread reads up to `prefetch` batches of the
+            cursor ahead (round trips and BSON/ndarray decoding) while the caller
+            processes the current one, by default 0 to stream the cursor as it is.
+            The offloaded trajectories (read by batch) and the structures (built
+            on first access) are still done in the caller's thread.
+        batch_size : int, optional
+            number of records in one batch of prefetch, by default 1000
 
         Yields
         ------
         record : dict or None, {..., "_structure_": <one structure or list>}
         """
         cursor = self.col.find(filter, self.projection)
-        for record in cursor:
-            if record["_id"] not in self.data:
-                record["_structure_"] = self.record2structure(record)
-                self.data[record["_id"]] = record
-            yield self.data[record["_id"]]
+        if prefetch == 0:
+            for record in cursor:
+                self._load_frames([record])
+                yield self._cache(record)
+            return
+        cursor.batch_size(batch_size)
+        records = prefetched(cursor, batch_size, prefetch)
+        try:
+            for batch in batched(records, batch_size):
+                self._load_frames(batch)
+                for record in batch:
+                    yield self._cache(record)
+        finally:
+            records.close()
+            cursor.close()
+
+    def get_many(self, ids, chunk_size=1000) -> list:
+        """find the records of many _id, only the uncached ones are queried by
+        chunked `$in` filters
+
+        Parameters
+        ----------
+        ids : Iterable[ObjectId]
+            _id to find, may be repeated
+        chunk_size : int, optional
+            number of _id in one query, by default 1000
+
+        Returns
+        -------
+        records : list[dict or None]
+            records in the order of ids, None if not found
+        """
+        ids = list(ids)
+        records, missing = self._fetch(ids, chunk_size)
+        return [records.get(_id, None) for _id in ids]
+
+    def prefetch(self, ids, chunk_size=1000) -> list:
+        """cache the records of many _id, see `get_many`
+
+        Returns
+        -------
+        missing : list[ObjectId]
+            _id not found in the collection
+        """
+        records, missing = self._fetch(ids, chunk_size)
+        return missing
+
+    def _fetch(self, ids, chunk_size):
+        records = {}  # {_id: record}, kept even if evicted from the cache
+        uncached = []
+        for _id in dict.fromkeys(ids):
+            if _id in self.data:
+                records[_id] = self[_id]
+            else:
+                uncached.append(_id)
+        for chunk in batched(uncached, chunk_size):
+            for record in self.find({"_id": {"$in": list(chunk)}}):
+                records[record["_id"]] = record
+        missing = [_id for _id in uncached if _id not in records]
+        if len(missing) > 0:
+            logger.debug(f"{len(missing)} _id not found in {self.col.name}")
+        return records, missing
 
     def __getitem__(self, _id: ObjectId):
         item = self.data.get(_id, None)
         if item is None:
             item = self.find_one({"_id": _id})
+        else:
+            self.hits += 1
+            self.data.move_to_end(_id)
         return item
 
+    def __setitem__(self, _id: ObjectId, record: dict):
+        if _id in self.data:
+            self.nbytes -= self._sizes.pop(_id)
+        self.data[_id] = record
+        self.data.move_to_end(_id)
+        self._sizes[_id] = estimate_nbytes(record)
+        self.nbytes += self._sizes[_id]
+        self._evict()
+
+    def __delitem__(self, _id: ObjectId):
+        del self.data[_id]
+        self.nbytes -= self._sizes.pop(_id)
+        self.pinned.discard(_id)
+
+    def _load_frames(self, records):
+        """Read the selected frames of the uncached records, from the TrajectoryStore
+        for the offloaded ones"""
+        if not self.trajectory:
+            return
+        records = [record for record in records if record["_id"] not in self.data]
+        stored = [record for record in records if "store" in record["trajectory"]]
+        if len(stored) > 0:
+            arrays = self.trajstore.read(stored, self.frames)
+            for record in stored:
+                record["trajectory"].update(arrays[record["_id"]])
+        if self.frames is not None:
+            for record in records:
+                if "store" in record["trajectory"]:
+                    continue
+                for field in FRAME_FIELDS:
+                    if field in record["trajectory"]:
+                        frames = np.asarray(record["trajectory"][field])
+                        record["trajectory"][field] = frames[list(self.frames)]
+
+    def _cache(self, record: dict) -> dict:
+        """Return the cached record of the same _id, otherwise build the structure
+        and cache this record"""
+        _id = record["_id"]
+        if _id in self.data:
+            self.hits += 1
+            self.data.move_to_end(_id)
+            return self.data[_id]
+        self.misses += 1
+        record = LazyRecord(record, self.record2structure, self._resize)
+        self[_id] = record
+        return record
+
+    def _resize(self, record: LazyRecord):
+        """Account the structure just built into the cache size"""
+        _id = record["_id"]
+        if self.data.get(_id, None) is record:
+            size = estimate_nbytes(record)
+            self.nbytes += size - self._sizes[_id]
+            self._sizes[_id] = size
+            self._evict()
+
+    def _evict(self):
+        """Drop the least recently used unpinned records until within the bounds"""
+        while (self.max_entries is not None and len(self.data) > self.max_entries) or (
+            self.max_bytes is not None and self.nbytes > self.max_bytes
+        ):
+            _id = next((_id for _id in self.data if _id not in self.pinned), None)
+            if _id is None:
+                break
+            del self[_id]
+            self.evictions += 1
+
+    def pin(self, *ids: ObjectId):
+        """Never evict the records of these _id, they may be cached later"""
+        self.pinned.update(ids)
+
+    def unpin(self, *ids: ObjectId):
+        """Allow the records of these _id to be evicted again"""
+        self.pinned.difference_update(ids)
+        self._evict()
+
+    @property
+    def stats(self) -> dict:
+        """Counters of the cache"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self.data),
+            "nbytes": self.nbytes,
+        }
+
     def record2structure(self, record):
         if self.trajectory:
             species = record["species"]
@@ -252,6 +533,48 @@ class Pipes:
         ]
         return pipeline
 
+    @staticmethod
+    def group_reduced_formula_pressure(rawcol="raw") -> list[dict[str, Any]]:
+        """Group the records of a unique collection by reduced formula and pressure,
+        across tasks
+
+        Parameters
+        ----------
+        rawcol : str, optional
+            name of the raw collection to look up, by default "raw"
+
+        Returns
+        -------
+        pipline: list[dict[str, Any]]
+            pipline list for aggregate on the unique collection, new records with
+            {"_id": {"reduced_formula": str, "pressure": <pressure_range.mid>},
+            "count": int, "ids": [_id, ...], "enth_list": [enth, ...]}
+        """
+        pipeline: list[dict[str, Any]] = [
+            {
+                "$lookup": {
+                    "from": f"{rawcol}",
+                    "localField": "_id",
+                    "foreignField": "_id",
+                    "as": "raw",
+                }
+            },
+            {"$unwind": "$raw"},
+            {"$match": {"raw.deprecated": False}},
+            {
+                "$group": {
+                    "_id": {
+                        "reduced_formula": "$raw.reduced_formula",
+                        "pressure": "$raw.pressure_range.mid",
+                    },
+                    "count": {"$sum": 1},
+                    "ids": {"$push": "$_id"},
+                    "enth_list": {"$push": "$raw.enthalpy_per_atom"},
+                }
+            },
+        ]
+        return pipeline
+
     @staticmethod
     def sort_enthalpy() -> list[dict[str, Any]]:
         """sort enthalpy_per_atom by group of task and formula
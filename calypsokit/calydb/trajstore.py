@@ -0,0 +1,226 @@
+"""Side store of trajectory arrays with frame-level random access
+
+The per-frame arrays of a raw record (`trajectory.cell`, `positions`,
+`scaled_positions` and `forces`) are written to one GridFS file, as contiguous
+C-order arrays one after another, with the raw _id as the file _id. The raw
+document keeps the layout in `trajectory.store`:
+
+    {"chunk_size": int, "fields": {<field>: {"offset": int, "dtype": str,
+    "shape": [nframes, ...]}}}
+
+so that some frames of many records are read by one query of only the GridFS
+chunks overlapping them, without decoding the other frames.
+"""
+import io
+import logging
+
+import numpy as np
+from gridfs import GridFSBucket
+from pymongo import UpdateOne
+
+from calypsokit.utils.itertools import batched
+
+logger = logging.getLogger(__name__)
+
+FRAME_FIELDS = ("cell", "positions", "scaled_positions", "forces")
+
+
+class TrajectoryStore:
+    def __init__(self, database, bucket="trajectory", chunk_size=65536):
+        """Trajectory arrays in the GridFS bucket of database
+
+        Examples
+        --------
+        >>> store = TrajectoryStore(db)
+        >>> store.offload(db.raw, {"deprecated": False})
+        >>> record = db.raw.find_one({"_id": _id})
+        >>> store.read([record], frames=[0, -1])[_id]["cell"].shape
+        (2, 3, 3)
+
+        Parameters
+        ----------
+        database : pymongo.database.Database
+            database of the GridFS bucket
+        bucket : str, optional
+            GridFS bucket name, by default "trajectory"
+        chunk_size : int, optional
+            bytes of one GridFS chunk of new files, smaller chunks read less bytes of
+            unused frames, by default 65536
+        """
+        self.database = database
+        self.name = bucket
+        self.files = database.get_collection(f"{bucket}.files")
+        self.chunks = database.get_collection(f"{bucket}.chunks")
+        self.chunk_size = chunk_size
+        self._bucket = None
+
+    @property
+    def bucket(self) -> GridFSBucket:
+        if self._bucket is None:
+            self._bucket = GridFSBucket(self.database, self.name)
+        return self._bucket
+
+    def put(self, _id, trajectory: dict) -> dict:
+        """Write the frame arrays of a trajectory to the file of _id
+
+        Returns
+        -------
+        dict
+            layout to be stored in `trajectory.store` of the raw document
+        """
+        fields = {}
+        buffer = io.BytesIO()
+        for field in FRAME_FIELDS:
+            if field not in trajectory:
+                continue
+            array = np.ascontiguousarray(trajectory[field])
+            fields[field] = {
+                "offset": buffer.tell(),
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            buffer.write(array.tobytes())
+        buffer.seek(0)
+        self.bucket.upload_from_stream_with_id(
+            _id, str(_id), buffer, chunk_size_bytes=self.chunk_size
+        )
+        return {"chunk_size": self.chunk_size, "fields": fields}
+
+    def delete(self, _id):
+        self.bucket.delete(_id)
+
+    def read(self, records, frames=None, fields=FRAME_FIELDS) -> dict:
+        """Read some frames of the trajectories of many records by one query
+
+        Parameters
+        ----------
+        records : Iterable[dict]
+            raw records with "_id" and "trajectory.store"
+        frames : list[int], optional
+            frame indices, negative ones count from the end, all frames if None
+        fields : Iterable[str], optional
+            fields to read, by default all frame fields
+
+        Returns
+        -------
+        dict
+            {_id: {field: ndarray of shape (len(frames), ...)}}
+        """
+        spans = {}  # {_id: {field: [(start, stop), ...]}}
+        layouts = {}
+        needed = {}  # {_id: set of chunk n}
+        for record in records:
+            _id, layout = record["_id"], record["trajectory"]["store"]
+            layouts[_id] = layout
+            spans[_id] = {}
+            for field in fields:
+                if field not in layout["fields"]:
+                    continue
+                info = layout["fields"][field]
+                nframes, *frame_shape = info["shape"]
+                frame_nbytes = np.dtype(info["dtype"]).itemsize * int(
+                    np.prod(frame_shape)
+                )
+                indices = range(nframes) if frames is None else frames
+                for index in indices:
+                    if not -nframes <= index < nframes:
+                        raise IndexError(
+                            f"frame {index} out of the {nframes} frames of {_id}"
+                        )
+                spans[_id][field] = [
+                    (
+                        info["offset"] + (index % nframes) * frame_nbytes,
+                        info["offset"] + (index % nframes + 1) * frame_nbytes,
+                    )
+                    for index in indices
+                ]
+                for start, stop in spans[_id][field]:
+                    if stop > start:
+                        needed.setdefault(_id, set()).update(
+                            range(
+                                start // layout["chunk_size"],
+                                (stop - 1) // layout["chunk_size"] + 1,
+                            )
+                        )
+        data = self._read_chunks(needed)
+        arrays = {}
+        for _id, field_spans in spans.items():
+            layout, chunks = layouts[_id], data.get(_id, {})
+            arrays[_id] = {}
+            for field, field_spans in field_spans.items():
+                info = layout["fields"][field]
+                frame_bytes = b"".join(
+                    self._slice(chunks, layout["chunk_size"], start, stop)
+                    for start, stop in field_spans
+                )
+                arrays[_id][field] = np.frombuffer(
+                    frame_bytes, dtype=info["dtype"]
+                ).reshape(len(field_spans), *info["shape"][1:])
+        return arrays
+
+    def _read_chunks(self, needed, batch_size=100) -> dict:
+        """{_id: {n: bytes}} of the needed chunks"""
+        data = {}
+        for batch in batched(needed.items(), batch_size):
+            filter = {
+                "$or": [
+                    {"files_id": _id, "n": {"$in": sorted(ns)}} for _id, ns in batch
+                ]
+            }
+            for chunk in self.chunks.find(filter, {"files_id": 1, "n": 1, "data": 1}):
+                data.setdefault(chunk["files_id"], {})[chunk["n"]] = bytes(
+                    chunk["data"]
+                )
+        return data
+
+    @staticmethod
+    def _slice(chunks, chunk_size, start, stop) -> bytes:
+        parts = []
+        for n in range(start // chunk_size, (stop - 1) // chunk_size + 1):
+            lo = max(start - n * chunk_size, 0)
+            hi = min(stop - n * chunk_size, chunk_size)
+            parts.append(chunks[n][lo:hi])
+        return b"".join(parts)
+
+    def offload(self, rawcol, filter={}, batch_size=100) -> int:
+        """Move the inline frame arrays of raw records to this store
+
+        Records already offloaded are skipped. The arrays are unset from the raw
+        documents after their file is written, so an interrupted offload is resumed
+        by calling it again: the files left by it for records still holding their
+        arrays are written again.
+
+        Returns
+        -------
+        int
+            number of offloaded records
+        """
+        filter = filter | {
+            "trajectory.store": {"$exists": False},
+            "trajectory.cell": {"$exists": True},
+        }
+        projection = {"_id": 1} | {f"trajectory.{field}": 1 for field in FRAME_FIELDS}
+        count = 0
+        for batch in batched(rawcol.find(filter, projection), batch_size):
+            # files (or chunks of an aborted upload) left by an interrupted offload
+            ids = [record["_id"] for record in batch]
+            self.files.delete_many({"_id": {"$in": ids}})
+            self.chunks.delete_many({"files_id": {"$in": ids}})
+            requests = []
+            for record in batch:
+                layout = self.put(record["_id"], record["trajectory"])
+                requests.append(
+                    UpdateOne(
+                        {"_id": record["_id"]},
+                        {
+                            "$set": {"trajectory.store": layout},
+                            "$unset": {
+                                f"trajectory.{field}": "" for field in layout["fields"]
+                            },
+                        },
+                    )
+                )
+            rawcol.bulk_write(requests, ordered=False)
+            count += len(requests)
+            logger.info(f"Offloaded {count} trajectories of {rawcol.name}")
+        return count
@@ -30,13 +30,14 @@ def test_connect(env: str, collection: str):
 @click.option(
     '--maxdate', nargs=6, default=None, help="year month day hour miniute second"
 )
-def deprecate(env: str, collection: str, mindate: tuple, maxdate: tuple):
+@click.option('--dry-run', is_flag=True, help="only count the records of each rule")
+def deprecate(env: str, collection: str, mindate: tuple, maxdate: tuple, dry_run: bool):
     assert isinstance(collection, str), "collection name must be a string"
     if mindate is not None:
         mindate = tuple(map(int, mindate))
     if maxdate is not None:
         maxdate = tuple(map(int, maxdate))
-    funcs.deprecate(env, collection, mindate, maxdate)
+    funcs.deprecate(env, collection, mindate, maxdate, dry_run)
 
 
 @db.command()
@@ -52,8 +53,128 @@ def check_duplicate(env: str, collection: str):  # TODO: add switch to delete (-
 @click.option('--rawcol', help="raw collection name")
 @click.option('--uniqcol', help="unique collection name")
 @click.option('--version', type=int, help="version number")
-def find_unique(env: str, rawcol: str, uniqcol: str, version: int):
-    funcs.find_unique(env, rawcol, uniqcol, version)
+@click.option(
+    '--mindate', nargs=6, default=None, help="year month day hour miniute second"
+)
+@click.option(
+    '--incremental',
+    is_flag=True,
+    help="only match new records against unique ones already in uniqcol",
+)
+@click.option(
+    '--prefilter/--no-prefilter',
+    default=True,
+    help="reject pairs by fingerprints before matching (on)",
+)
+@click.option(
+    '--verify-prefilter',
+    is_flag=True,
+    help="still match the rejected pairs and count false rejections",
+)
+@click.option(
+    '--match-cache', type=click.Path(), help="SQLite file to cache match verdicts"
+)
+@click.option(
+    '--matcher',
+    type=click.Choice(["pymatgen", "native"]),
+    default="pymatgen",
+    help="structure matcher backend (pymatgen)",
+)
+@click.option(
+    '--level',
+    'levels',
+    nargs=3,
+    multiple=True,
+    type=(float, int, str),
+    help="e_threshold version uniqcol of one level, repeat to find unique for "
+    "several thresholds in one pass",
+)
+@click.option(
+    '--resume/--no-resume',
+    default=True,
+    help="skip groups finished by an interrupted run with the same options (on)",
+)
+@click.option('-j', '--n-jobs', type=int, default=-1, help="parallel jobs (-1)")
+def find_unique(
+    env: str,
+    rawcol: str,
+    uniqcol: str,
+    version: int,
+    mindate: tuple,
+    incremental: bool,
+    prefilter: bool,
+    verify_prefilter: bool,
+    match_cache: str,
+    matcher: str,
+    levels: tuple,
+    resume: bool,
+    n_jobs: int,
+):
+    if incremental and len(levels) > 0:
+        raise click.UsageError("--incremental cannot be used with --level")
+    if mindate is not None:
+        mindate = tuple(map(int, mindate))
+    funcs.find_unique(
+        env,
+        rawcol,
+        uniqcol,
+        version,
+        mindate=mindate,
+        incremental=incremental,
+        prefilter=prefilter,
+        verify_prefilter=verify_prefilter,
+        match_cache=match_cache,
+        matcher_backend=matcher,
+        levels=levels,
+        resume=resume,
+        n_jobs=n_jobs,
+    )
+
+
+@db.command()
+@click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
+@click.option('--rawcol', help="raw collection name")
+@click.option('--uniqcol', help="unique collection name of each task")
+@click.option('--globcol', help="unique collection name across tasks")
+@click.option('--version', type=int, help="version number")
+@click.option(
+    '--e-threshold',
+    type=float,
+    default=float("inf"),
+    help="enthalpy_per_atom window (no window)",
+)
+@click.option(
+    '--match-cache', type=click.Path(), help="SQLite file to cache match verdicts"
+)
+@click.option(
+    '--matcher',
+    type=click.Choice(["pymatgen", "native"]),
+    default="pymatgen",
+    help="structure matcher backend (pymatgen)",
+)
+@click.option('-j', '--n-jobs', type=int, default=-1, help="parallel jobs (-1)")
+def global_unique(
+    env: str,
+    rawcol: str,
+    uniqcol: str,
+    globcol: str,
+    version: int,
+    e_threshold: float,
+    match_cache: str,
+    matcher: str,
+    n_jobs: int,
+):
+    funcs.global_unique(
+        env,
+        rawcol,
+        uniqcol,
+        globcol,
+        version,
+        e_threshold=e_threshold,
+        match_cache=match_cache,
+        matcher_backend=matcher,
+        n_jobs=n_jobs,
+    )
 
 
 @db.command()
@@ -64,6 +185,94 @@ def maintain_unique(env: str, rawcol: str, uniqcol: str):
     funcs.maintain_unique(env, rawcol, uniqcol)
 
 
+@db.command()
+@click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
+@click.option('--rawcol', help="raw collection name")
+@click.option('--uniqcol', help="unique collection name")
+@click.option(
+    '--batch-size', type=int, default=1000, help="deprecated records per batch (1000)"
+)
+def sync_deprecated(env: str, rawcol: str, uniqcol: str, batch_size: int):
+    funcs.sync_deprecated(env, rawcol, uniqcol, batch_size)
+
+
+@db.command()
+@click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
+@click.option('--rawcol', help="raw collection name")
+@click.option('--bucket', default='trajectory', help="GridFS bucket (trajectory)")
+@click.option(
+    '--chunk-size', type=int, default=65536, help="bytes of one GridFS chunk (65536)"
+)
+def offload_trajectory(env: str, rawcol: str, bucket: str, chunk_size: int):
+    funcs.offload_trajectory(env, rawcol, bucket, chunk_size)
+
+
+@db.command()
+@click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
+@click.option('-c', '--collection', help="collection name")
+@click.option(
+    '--compress', type=click.Choice(['zlib', 'lzma']), help="compress ndarray fields"
+)
+@click.option('--level', type=int, help="compression level")
+@click.option(
+    '--float32', multiple=True, help="down-cast this field to float32, repeatable"
+)
+@click.option(
+    '--constant/--no-constant',
+    default=True,
+    help="store constant (e.g. all-NaN) arrays as one value (on)",
+)
+@click.option('--batch-size', type=int, default=500, help="documents per batch (500)")
+@click.option('--ranges', type=int, default=64, help="number of _id ranges (64)")
+@click.option('--rate', type=float, help="max documents per second, all jobs")
+@click.option('--dry-run', is_flag=True, help="only report the projected savings")
+@click.option(
+    '--resume/--no-resume', default=True, help="continue from the checkpoints (on)"
+)
+@click.option('-j', '--n-jobs', type=int, default=-1, help="parallel jobs (-1)")
+def migrate_codec(
+    env: str,
+    collection: str,
+    compress,
+    level,
+    float32: tuple,
+    constant: bool,
+    batch_size: int,
+    ranges: int,
+    rate,
+    dry_run: bool,
+    resume: bool,
+    n_jobs: int,
+):
+    assert isinstance(collection, str), "collection name must be a string"
+    funcs.migrate_codec(
+        env,
+        collection,
+        compress=compress,
+        level=level,
+        float32=float32,
+        constant=constant,
+        batch_size=batch_size,
+        nranges=ranges,
+        rate=rate,
+        dry_run=dry_run,
+        resume=resume,
+        n_jobs=n_jobs,
+    )
+
+
+@db.command()
+@click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
+@click.option('-o', '--outdir', type=click.Path(), help="snapshot directory")
+@click.option(
+    '-c', '--collection', 'collections', multiple=True, help="repeatable, (all)"
+)
+@click.option('--limit', type=int, default=0, help="documents per collection (all)")
+def snapshot(env: str, outdir: str, collections: tuple, limit: int):
+    assert isinstance(outdir, str), "outdir must be a string"
+    funcs.snapshot(env, outdir, collections, limit)
+
+
 @db.command()
 @click.option('--env', type=click.Path(), default='.env', help="env var, (.env)")
 @click.option('--rawcol', help="raw collection name")
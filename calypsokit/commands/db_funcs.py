@@ -4,8 +4,23 @@ from pprint import pprint
 import calypsokit.calydb.cleanup as cleanup
 import calypsokit.calydb.queries as queries
 from calypsokit.analysis.find_unique import UniqueFinder
+from calypsokit.analysis.global_unique import GlobalUniqueFinder
+from calypsokit.calydb.codec import ArrayPolicy
+from calypsokit.calydb.local import LocalDatabase, dump
 from calypsokit.calydb.login import login
+from calypsokit.calydb.migrate import CodecMigrator
 from calypsokit.calydb.readout import ReadOut
+from calypsokit.calydb.trajstore import TrajectoryStore
+
+logger = logging.getLogger(__name__)
+
+
+def _n_jobs(db, n_jobs):
+    """Pipelines of a local database run in this process"""
+    if isinstance(db, LocalDatabase) and n_jobs != 1:
+        logger.info("Local backend, running with n_jobs=1")
+        return 1
+    return n_jobs
 
 
 def test_connect(env: str, collection: str):
@@ -14,13 +29,10 @@ def test_connect(env: str, collection: str):
     pprint(col.find_one())
 
 
-def deprecate(env: str, collection: str, mindate, maxdate):
+def deprecate(env: str, collection: str, mindate, maxdate, dry_run=False):
     db = login(dotenv_path=env)
     col = db.get_collection(collection)
-    cleanup.deprecate_large_enthalpy(col)
-    cleanup.deprecate_less_task(col, mindate, maxdate)
-    cleanup.deprecate_solitary_enth(col, mindate, maxdate)
-    cleanup.deprecate_min_dist(col)
+    pprint(cleanup.deprecate(col, mindate, maxdate, dry_run=dry_run))
 
 
 def check_duplicate(env: str, collection: str):
@@ -29,13 +41,68 @@ def check_duplicate(env: str, collection: str):
     queries.check_duplicate(col)
 
 
-def find_unique(env: str, rawcol: str, uniqcol: str, version):
+def find_unique(
+    env: str,
+    rawcol: str,
+    uniqcol: str,
+    version,
+    mindate=None,
+    incremental=False,
+    prefilter=True,
+    verify_prefilter=False,
+    match_cache=None,
+    matcher_backend="pymatgen",
+    levels=(),
+    resume=True,
+    n_jobs=-1,
+):
     db = login(dotenv_path=env)
     rawcol = db.get_collection(rawcol)
     uniqcol = db.get_collection(uniqcol)
-    version = int(version)
-    uniquefinder = UniqueFinder(rawcol, uniqcol)
-    uniquefinder.update(version=version)
+    version = None if version is None else int(version)
+    uniquefinder = UniqueFinder(
+        rawcol,
+        uniqcol,
+        prefilter=prefilter,
+        prefilter_kwargs={"verify": verify_prefilter},
+        match_cache=match_cache,
+        matcher_backend=matcher_backend,
+        login_kwargs={"dotenv_path": env},
+        n_jobs=_n_jobs(db, n_jobs),
+    )
+    dates = () if mindate is None else (mindate,)
+    if len(levels) > 0:
+        levels = [(e, v, db.get_collection(name)) for e, v, name in levels]
+        uniquefinder.update_levels(*dates, levels=levels, resume=resume)
+    else:
+        uniquefinder.update(
+            *dates, version=version, incremental=incremental, resume=resume
+        )
+
+
+def global_unique(
+    env: str,
+    rawcol: str,
+    uniqcol: str,
+    globcol: str,
+    version,
+    e_threshold=float("inf"),
+    match_cache=None,
+    matcher_backend="pymatgen",
+    n_jobs=-1,
+):
+    db = login(dotenv_path=env)
+    finder = GlobalUniqueFinder(
+        db.get_collection(rawcol),
+        db.get_collection(uniqcol),
+        db.get_collection(globcol),
+        e_threshold=e_threshold,
+        match_cache=match_cache,
+        matcher_backend=matcher_backend,
+        login_kwargs={"dotenv_path": env},
+        n_jobs=_n_jobs(db, n_jobs),
+    )
+    finder.update(version=int(version))
 
 
 def maintain_unique(env: str, rawcol: str, uniqcol: str):
@@ -46,12 +113,64 @@ def maintain_unique(env: str, rawcol: str, uniqcol: str):
     uniquefinder.maintain_deprecated()
 
 
+def sync_deprecated(env: str, rawcol: str, uniqcol: str, batch_size=1000):
+    db = login(dotenv_path=env)
+    rawcol = db.get_collection(rawcol)
+    uniqcol = db.get_collection(uniqcol)
+    uniquefinder = UniqueFinder(rawcol, uniqcol, write_batch_size=batch_size)
+    uniquefinder.maintain_indexes()
+    pprint(uniquefinder.sync_deprecated())
+
+
+def offload_trajectory(env: str, rawcol: str, bucket="trajectory", chunk_size=65536):
+    db = login(dotenv_path=env)
+    store = TrajectoryStore(db, bucket, chunk_size)
+    store.offload(db.get_collection(rawcol))
+
+
+def migrate_codec(
+    env: str,
+    collection: str,
+    compress=None,
+    level=None,
+    float32=(),
+    constant=True,
+    batch_size=500,
+    nranges=64,
+    rate=None,
+    dry_run=False,
+    resume=True,
+    n_jobs=-1,
+):
+    db = login(dotenv_path=env)
+    policy = ArrayPolicy(
+        fields={field: {"float32": True} for field in float32},
+        compress=compress,
+        level=level,
+        constant=constant,
+    )
+    migrator = CodecMigrator(
+        db.get_collection(collection),
+        policy,
+        batch_size=batch_size,
+        nranges=nranges,
+        login_kwargs={"dotenv_path": env},
+        n_jobs=_n_jobs(db, n_jobs),
+    )
+    pprint(migrator.migrate(dry_run=dry_run, rate=rate, resume=resume))
+
+
+def snapshot(env: str, outdir: str, collections=(), limit=0):
+    db = login(dotenv_path=env)
+    pprint(dump(db, outdir, list(collections) or None, limit=limit))
+
+
 def readout(
     env: str = None,
     rawcol: str = None,
     uniqcol: str = None,
     type: str = None,
-    outfile: str = None
+    outfile: str = None,
 ):
     db = login(dotenv_path=env)
     if type == 'cdvae':
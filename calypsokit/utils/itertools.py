@@ -1,4 +1,6 @@
 import itertools
+import queue
+import threading
 
 if "pairwise" not in dir(itertools):
 
@@ -58,3 +60,47 @@ def batched(iterable, n):
     it = iter(iterable)
     while batch := tuple(itertools.islice(it, n)):
         yield batch
+
+
+def prefetched(iterable, batch_size=1000, depth=2):
+    """Iterate in a background thread, `depth` batches of `batch_size` items ahead
+    of the consumer. Exceptions of the iterable are raised in the consumer.
+
+    >>> for item in prefetched(cursor, 1000, 2):
+    >>>     process(item)  # while the next batches are fetched
+    """
+    if depth < 1:
+        raise ValueError('depth must be at least one')
+    batches = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # give up once the consumer stops, so that this thread never blocks
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            for batch in batched(iterable, batch_size):
+                if not put(batch):
+                    return
+            put(done)
+        except BaseException as error:
+            put(error)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while (batch := batches.get()) is not done:
+            if isinstance(batch, BaseException):
+                raise batch
+            yield from batch
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,37 @@
+class UnionFind:
+    """Disjoint sets of hashable items, the root of each set is its representative
+
+    >>> uf = UnionFind(["a", "b", "c"])
+    >>> uf.union("a", "b")
+    'a'
+    >>> uf.groups()
+    {'a': ['a', 'b'], 'c': ['c']}
+    """
+
+    def __init__(self, items=()):
+        self.parent = {item: item for item in items}
+
+    def add(self, item):
+        self.parent.setdefault(item, item)
+
+    def find(self, item):
+        """root of the set containing `item`, with path halving"""
+        parent = self.parent
+        while parent[item] != item:
+            parent[item] = parent[parent[item]]
+            item = parent[item]
+        return item
+
+    def union(self, root, other):
+        """merge the set of `other` into the set of `root`, return the kept root"""
+        root, other = self.find(root), self.find(other)
+        if root != other:
+            self.parent[other] = root
+        return root
+
+    def groups(self) -> dict:
+        """{root: [items in this set, ...]}, items keep the insertion order"""
+        groups = {}
+        for item in self.parent:
+            groups.setdefault(self.find(item), []).append(item)
+        return groups
@@ -1,9 +1,27 @@
+import importlib.util
+import os
+import pickle
+import tempfile
 import unittest
+from datetime import datetime
+from pathlib import Path
 
+import numpy as np
 from ase import Atoms
+from pymatgen.analysis.structure_matcher import FrameworkComparator, StructureMatcher
+from pymatgen.core.lattice import Lattice
 from pymatgen.core.structure import Structure
+from pymongo import InsertOne, MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 
 from calypsokit.analysis import properties
+from calypsokit.analysis.find_unique import UniqueFinder
+from calypsokit.analysis.fingerprint import FingerprintFilter
+from calypsokit.analysis.lsh import StructureLSH
+from calypsokit.analysis.match_cache import MatchCache
+from calypsokit.analysis.matcher import MemoMatcher, NativeMatcher
+from calypsokit.analysis.scheduler import plan_tasks
+from calypsokit.calydb.login import NumpyDatabase, login
 
 
 class TestValidity(unittest.TestCase):
@@ -71,3 +89,380 @@ Direct
 
     def test_02_poscar_str(self):
         self.assertEqual(properties.get_poscar_str(self.atoms), self.ase_poscar)
+
+
+class TestFingerprint(unittest.TestCase):
+    matcher = StructureMatcher()
+    fpfilter = FingerprintFilter.from_matcher(matcher)
+    nacl = Structure.from_spacegroup(
+        "Fm-3m",
+        [[5.6, 0, 0], [0, 5.6, 0], [0, 0, 5.6]],
+        ["Na", "Cl"],
+        [[0] * 3, [0.5] * 3],
+    )
+    cscl = Structure(
+        [[3.2, 0, 0], [0, 3.2, 0], [0, 0, 3.2]], ["Na", "Cl"], [[0] * 3, [0.5] * 3]
+    )
+
+    def test_01_same(self):
+        strained = self.nacl.copy()
+        strained.apply_strain([0.02, -0.01, 0.03])
+        strained.perturb(0.05)
+        self.assertTrue(self.matcher.fit(self.nacl, strained))
+        fp1 = self.fpfilter.fingerprint(self.nacl)
+        fp2 = self.fpfilter.fingerprint(strained)
+        self.assertFalse(self.fpfilter.differ(fp1, fp2))
+
+    def test_02_supercell(self):
+        supercell = self.nacl.copy()
+        supercell.make_supercell([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+        fp1 = self.fpfilter.fingerprint(self.nacl)
+        fp2 = self.fpfilter.fingerprint(supercell)
+        self.assertFalse(self.fpfilter.differ(fp1, fp2))
+
+    def test_03_differ(self):
+        # the bounds of the default matcher are too loose to tell NaCl from CsCl
+        matcher = StructureMatcher(ltol=0.05, stol=0.1, angle_tol=2)
+        fpfilter = FingerprintFilter.from_matcher(matcher)
+        nacl = self.nacl.get_primitive_structure()
+        self.assertFalse(matcher.fit(nacl, self.cscl))
+        fp1 = fpfilter.fingerprint(nacl)
+        fp2 = fpfilter.fingerprint(self.cscl)
+        self.assertTrue(fpfilter.differ(fp1, fp2))
+
+    def test_04_no_false_reject(self):
+        rng = np.random.default_rng(1)
+        prototypes = [
+            self.nacl.get_primitive_structure(),
+            self.cscl,
+            Structure.from_spacegroup(
+                "I4/mmm",
+                Lattice.tetragonal(3.0, 7.0),
+                ["La", "H"],
+                [[0] * 3, [0, 0.5, 0.25]],
+            ),
+            Structure.from_spacegroup(
+                "Pm-3m",
+                Lattice.cubic(3.9),
+                ["Sr", "Ti", "O"],
+                [[0] * 3, [0.5] * 3, [0.5, 0.5, 0]],
+            ),
+        ]
+        # conventional cell, supercell, other species on the same framework
+        kcl = self.nacl.get_primitive_structure()
+        kcl.replace_species({"Na": "K"})
+        cscl = self.cscl.copy()
+        cscl.make_supercell([2, 1, 1])
+        prototypes += [self.nacl, cscl, kcl]
+        structures = []
+        for prototype in prototypes:
+            for _ in range(3):
+                structure = prototype.copy()
+                strain = np.diag(rng.normal(0, 0.07, 3)) + rng.normal(0, 0.03, (3, 3))
+                structure.apply_strain((strain + strain.T) / 2)
+                structure.perturb(rng.uniform(0, 0.4))
+                structures.append(structure)
+        for matcher in [
+            StructureMatcher(),
+            StructureMatcher(ltol=0.1, stol=0.15, angle_tol=3),
+            StructureMatcher(scale=False),
+            StructureMatcher(attempt_supercell=True, primitive_cell=False),
+            StructureMatcher(comparator=FrameworkComparator()),
+        ]:
+            fpfilter = FingerprintFilter.from_matcher(matcher)
+            fps = [fpfilter.fingerprint(structure) for structure in structures]
+            nfit = 0
+            for i, s1 in enumerate(structures):
+                for j, s2 in enumerate(structures[:i]):
+                    if matcher.fit(s1, s2):
+                        nfit += 1
+                        self.assertFalse(fpfilter.differ(fps[i], fps[j]), (i, j))
+            self.assertGreater(nfit, 0)
+        subset = StructureMatcher(attempt_supercell=True, allow_subset=True)
+        self.assertIsNone(FingerprintFilter.from_matcher(subset))
+
+
+class TestMemoMatcher(unittest.TestCase):
+    def test_01_same_verdict(self):
+        nacl, cscl = TestFingerprint.nacl, TestFingerprint.cscl
+        supercell = nacl * (2, 1, 1)
+        strained = nacl.copy()
+        strained.apply_strain([0.02, -0.01, 0.03])
+        structures = {"nacl": nacl, "cscl": cscl, "sc": supercell, "st": strained}
+        matcher = StructureMatcher()
+        memo = MemoMatcher(matcher)
+        for id1, s1 in structures.items():
+            for id2, s2 in structures.items():
+                self.assertEqual(memo.fit(id1, s1, id2, s2), matcher.fit(s1, s2))
+        self.assertEqual(memo.nreduced, len(structures))
+
+
+class TestNativeMatcher(unittest.TestCase):
+    def test_01_agree(self):
+        rng = np.random.default_rng(0)
+        prototypes = [
+            TestFingerprint.nacl,
+            TestFingerprint.cscl,
+            Structure.from_spacegroup(
+                "P6_3/mmc", Lattice.hexagonal(3.2, 5.2), ["Mg"], [[1 / 3, 2 / 3, 0.25]]
+            ),
+            Structure.from_spacegroup(
+                "I4/mmm",
+                Lattice.tetragonal(3.0, 7.0),
+                ["La", "H"],
+                [[0] * 3, [0, 0.5, 0.25]],
+            ),
+        ]
+        structures = []
+        for prototype in prototypes:
+            for _ in range(4):
+                structure = prototype.copy()
+                structure.apply_strain(rng.normal(0, 0.06, 3))
+                structure.perturb(rng.uniform(0, 0.3))
+                structures.append(structure)
+        matcher = StructureMatcher()
+        native = NativeMatcher(matcher)
+        for i, s1 in enumerate(structures):
+            for j, s2 in enumerate(structures):
+                self.assertEqual(native.fit(i, s1, j, s2), matcher.fit(s1, s2))
+        self.assertEqual(native.nfallback, 0)
+
+    def test_02_real_structures(self):
+        rutile = Structure.from_spacegroup(
+            "P4_2/mnm",
+            Lattice.tetragonal(4.594, 2.959),
+            ["Ti", "O"],
+            [[0, 0, 0], [0.3053, 0.3053, 0]],
+        )
+        wurtzite = Structure.from_spacegroup(
+            "P6_3mc",
+            Lattice.hexagonal(3.250, 5.207),
+            ["Zn", "O"],
+            [[1 / 3, 2 / 3, 0], [1 / 3, 2 / 3, 0.382]],
+        )
+        perovskite = Structure.from_spacegroup(
+            "Pm-3m",
+            Lattice.cubic(3.905),
+            ["Sr", "Ti", "O"],
+            [[0, 0, 0], [0.5, 0.5, 0.5], [0.5, 0.5, 0]],
+        )
+        structures = []
+        for structure in (rutile, wurtzite, perovskite):
+            sheared = structure.copy()
+            sheared.apply_strain([[0.04, 0.03, 0], [0.03, -0.02, 0], [0, 0, 0.05]])
+            relaxed = structure.copy()
+            relaxed.perturb(0.15)
+            # another setting of the same crystal
+            setting = structure.copy()
+            setting.make_supercell([[1, 1, 0], [0, 1, 0], [0, 0, 1]])
+            swapped = structure.copy()
+            swapped.replace_species(
+                {
+                    structure.species[0]: structure.species[-1],
+                    structure.species[-1]: structure.species[0],
+                }
+            )
+            structures += [structure, sheared, relaxed, setting, swapped]
+        matcher = StructureMatcher()
+        native = NativeMatcher(matcher)
+        verdicts = set()
+        for i, s1 in enumerate(structures):
+            for j, s2 in enumerate(structures):
+                verdict = matcher.fit(s1, s2)
+                self.assertEqual(native.fit(i, s1, j, s2), verdict, (i, j))
+                verdicts.add(verdict)
+        self.assertEqual(verdicts, {True, False})
+        self.assertEqual(native.nfallback, 0)
+
+    def test_03_fit_many(self):
+        rng = np.random.default_rng(2)
+        prototypes = [
+            TestFingerprint.nacl,
+            TestFingerprint.cscl,
+            TestFingerprint.cscl * (1, 1, 2),
+            Structure.from_spacegroup(
+                "Pm-3m",
+                Lattice.cubic(3.9),
+                ["Sr", "Ti", "O"],
+                [[0] * 3, [0.5] * 3, [0.5, 0.5, 0]],
+            ),
+        ]
+        structures = []
+        for prototype in prototypes:
+            for _ in range(3):
+                structure = prototype.copy()
+                structure.apply_strain(rng.normal(0, 0.05, 3))
+                structure.perturb(rng.uniform(0, 0.3))
+                structures.append(structure)
+        others = list(enumerate(structures))
+        for matcher in [StructureMatcher(), StructureMatcher(attempt_supercell=True)]:
+            # max_sites=4 sends the perovskite pairs to pymatgen
+            native = NativeMatcher(matcher, max_sites=4)
+            pairwise = NativeMatcher(matcher, max_sites=4)
+            for i, s1 in others:
+                verdicts = native.fit_many(i, s1, others)
+                self.assertEqual(
+                    verdicts, [pairwise.fit(i, s1, j, s2) for j, s2 in others]
+                )
+                self.assertEqual(verdicts, [matcher.fit(s1, s2) for s2 in structures])
+            self.assertGreater(native.nfallback, 0)
+
+
+class TestStructureLSH(unittest.TestCase):
+    lsh = StructureLSH()
+
+    def test_01_supercell(self):
+        nacl = TestFingerprint.nacl
+        vector = self.lsh.vector(nacl)
+        scaled = nacl * (1, 2, 1)
+        scaled.scale_lattice(scaled.volume * 1.1)
+        self.assertTrue(np.allclose(vector, self.lsh.vector(scaled)))
+        self.assertEqual(self.lsh.keys(vector), self.lsh.keys(self.lsh.vector(scaled)))
+
+    def test_02_collide(self):
+        nacl = TestFingerprint.nacl
+        perturbed = nacl.copy()
+        perturbed.perturb(0.02)
+        keys1 = self.lsh.keys(self.lsh.vector(nacl))
+        keys2 = self.lsh.keys(self.lsh.vector(perturbed))
+        self.assertTrue(any(k1 == k2 for k1, k2 in zip(keys1, keys2)))
+
+
+class TestScheduler(unittest.TestCase):
+    groups = [
+        {"_id": i, "count": n, "ids": list(range(n)), "enth_list": list(range(n))[::-1]}
+        for i, n in enumerate([3, 12, 2, 30, 4])
+    ]
+
+    def test_01_plan_tasks(self):
+        tasks = plan_tasks(self.groups, chunk_size=10, max_group_size=20)
+        counts = [sum(group["count"] for group in task) for task in tasks]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+        self.assertEqual(sum(counts), sum(group["count"] for group in self.groups))
+        # tiny groups are batched
+        self.assertIn([4, 3, 2], [[g["count"] for g in task] for task in tasks])
+        # huge group is split into shards of contiguous enthalpy
+        shards = [task[0] for task in tasks if "shard" in task[0]]
+        self.assertEqual(len(shards), 2)
+        self.assertLessEqual(max(shards[0]["enth_list"]), min(shards[1]["enth_list"]))
+
+
+class TestMatchCache(unittest.TestCase):
+    def test_01_persist(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "match_cache.sqlite"
+            params = MatchCache.hash_params({}, 0.005)
+            cache = MatchCache(path, params)
+            cache.put("b", "a", True)
+            cache.put("a", "c", False)
+            cache.flush()
+            self.assertIsNone(cache.get("a", "b"))
+            cache = MatchCache(path, params)
+            cache.preload(["a", "b"])
+            self.assertTrue(cache.get("a", "b"))
+            self.assertIsNone(cache.get("a", "c"))
+            other = MatchCache(path, MatchCache.hash_params({}, 0.01))
+            other.preload(["a", "b", "c"])
+            self.assertIsNone(other.get("a", "b"))
+
+
+class TestUniqueFinder(unittest.TestCase):
+    def test_01_worker_config(self):
+        db = NumpyDatabase(MongoClient(connect=False), "calydb")
+        finder = UniqueFinder(db.raw, db.uniq)
+        self.assertIs(finder._worker_config(), finder)
+        finder = UniqueFinder(db.raw, db.uniq, n_jobs=2)
+        self.assertRaises(ValueError, finder._worker_config)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = login(
+                "localhost:27017",
+                "user",
+                "pwd",
+                "calydb",
+                dotenv_path=os.path.join(tmpdir, ".env"),
+                backend="mongodb",
+            )
+        finder = UniqueFinder(db.raw, db.uniq, n_jobs=2)
+        config = pickle.loads(pickle.dumps(finder._worker_config()))
+        self.assertEqual(config["login_kwargs"]["dbname"], "calydb")
+        self.assertEqual(config["collections"], ["raw", "uniq"])
+
+    @unittest.skipIf(importlib.util.find_spec("mongomock") is None, "needs mongomock")
+    def test_02_parallel(self):
+        from calypsokit.calydb.local import LocalClient
+
+        rng = np.random.default_rng(0)
+        docs = []
+        for task in range(2):
+            for base in range(3):
+                structure = Structure(
+                    np.diag(rng.uniform(3, 5, 3)),
+                    ["La", "H", "H", "H"],
+                    rng.random((4, 3)),
+                )
+                for copy in range(3):
+                    perturbed = structure.copy()
+                    perturbed.perturb(0.02 * copy)
+                    docs.append(
+                        {
+                            "species": [sp.symbol for sp in perturbed.species],
+                            "cell": perturbed.lattice.matrix.tolist(),
+                            "positions": perturbed.cart_coords.tolist(),
+                            "natoms": 4,
+                            "formula": "LaH3",
+                            "symmetry": {"1e-1": {"number": 1}},
+                            "enthalpy_per_atom": -1.0 + 0.01 * base + 0.001 * copy,
+                            "trajectory": {"source_dir": f"task{task}"},
+                            "deprecated": False,
+                            "last_updated_utc": datetime(2023, 6, 1),
+                        }
+                    )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = LocalClient(tmpdir).get_database("calydb")
+            db.raw.insert_many(docs)
+            db.save()
+            login_kwargs = {
+                "backend": "local",
+                "local_path": tmpdir,
+                "dbname": "calydb",
+            }
+            db = login(**login_kwargs)
+            uniq = {}
+            for n_jobs, backend in ((1, "pymatgen"), (2, "pymatgen"), (1, "native")):
+                uniqcol = db.get_collection(f"uniq{n_jobs}{backend}")
+                finder = UniqueFinder(
+                    db.raw,
+                    uniqcol,
+                    matcher_backend=backend,
+                    login_kwargs=login_kwargs,
+                    n_jobs=n_jobs,
+                    chunk_size=1,
+                )
+                finder.update(version=1)
+                uniq[n_jobs, backend] = {
+                    doc["_id"]: doc["members"] for doc in uniqcol.find()
+                }
+            self.assertEqual(len(uniq[1, "pymatgen"]), 6)
+            self.assertEqual(uniq[2, "pymatgen"], uniq[1, "pymatgen"])
+            # the native backend fits each window in one fit_many
+            self.assertEqual(uniq[1, "native"], uniq[1, "pymatgen"])
+
+    @unittest.skipIf(importlib.util.find_spec("mongomock") is None, "needs mongomock")
+    def test_03_commit(self):
+        from calypsokit.calydb.local import LocalClient
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = LocalClient(tmpdir).get_database("calydb")
+            finder = UniqueFinder(db.raw, db.uniq)
+            db.uniq.insert_one({"_id": 0, "formula": "LaH3"})
+            targets = {0.005: (None, db.uniq)}
+            key = {"task": "a", "formula": "LaH3"}
+            requests = {0.005: [InsertOne({"_id": 0}), InsertOne({"_id": 1})]}
+            finder._commit("run", targets, requests, [(key, 0.005)])
+            self.assertEqual(finder.finished_groups("run", [0.005]), {("a", "LaH3")})
+            # not a duplicate, the group is not journaled
+            requests = {0.005: [UpdateOne({"_id": 0}, {"$set": {"_id": 2}})]}
+            key = {"task": "b", "formula": "LaH3"}
+            with self.assertRaises(BulkWriteError):
+                finder._commit("run", targets, requests, [(key, 0.005)])
+            self.assertEqual(finder.finished_groups("run", [0.005]), {("a", "LaH3")})
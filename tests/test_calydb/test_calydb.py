@@ -1,18 +1,26 @@
+import pickle
 import unittest
 from datetime import datetime, timedelta
 from pprint import pprint
+from unittest import mock
 
 import numpy as np
 import pandas as pd
 from ase import Atoms
+from bson import Binary, ObjectId
 from pymatgen.core.structure import Structure
 from pymongo.errors import DuplicateKeyError
 
+from calypsokit.analysis.find_unique import UniqueFinder
+from calypsokit.calydb import cleanup
+from calypsokit.calydb.codec import ArrayPolicy, decode_ndarray
 from calypsokit.calydb.login import login, maintain_indexes
+from calypsokit.calydb.migrate import CodecMigrator
 from calypsokit.calydb.patch import RawRecordPatcher
 from calypsokit.calydb.queries import QueryStructure
 from calypsokit.calydb.readout import ReadOut
 from calypsokit.calydb.record import RecordDict
+from calypsokit.calydb.trajstore import TrajectoryStore
 
 
 class TestCalyDB(unittest.TestCase):
@@ -112,3 +120,267 @@ class TestCalyDB(unittest.TestCase):
         df = readout.unique2cdvae(self.db, 'rawcol', 'uniqcol', debug=10)
         # print(df)
         self.assertEqual(len(df), 10)
+
+    def test_10_QueryStructure_cache(self):
+        doc = {
+            "species": ["Si", "Si"],
+            "cell": (np.eye(3) * 3).tolist(),
+            "positions": [[0, 0, 0], [1.5, 1.5, 1.5]],
+        }
+        docs = [doc | {"material_id": f"debug-{i:02d}"} for i in range(5)]
+        ids = self.debugcol.insert_many(docs).inserted_ids
+        qs = QueryStructure(self.debugcol, max_entries=2)
+        qs.pin(ids[0])
+        for _id in ids:
+            self.assertIsInstance(qs[_id]["_structure_"], Structure)
+        self.assertEqual(list(qs.data), [ids[0], ids[4]])
+        self.assertIsNotNone(qs[ids[4]])
+        self.assertEqual(qs.stats["hits"], 1)
+        self.assertEqual(qs.stats["misses"], 5)
+        self.assertEqual(qs.stats["evictions"], 3)
+        qs = QueryStructure(self.debugcol, max_bytes=1)
+        self.assertIsNotNone(qs[ids[0]])
+        self.assertEqual(len(qs), 0)
+
+    def test_11_QueryStructure_get_many(self):
+        doc = {
+            "species": ["Si", "Si"],
+            "cell": (np.eye(3) * 3).tolist(),
+            "positions": [[0, 0, 0], [1.5, 1.5, 1.5]],
+        }
+        docs = [doc | {"material_id": f"debug-{i:02d}"} for i in range(5)]
+        ids = self.debugcol.insert_many(docs).inserted_ids
+        unknown = ObjectId()
+        qs = QueryStructure(self.debugcol)
+        self.assertEqual(qs.prefetch(ids[:2] + [unknown], chunk_size=1), [unknown])
+        records = qs.get_many([ids[4], unknown, ids[0], ids[4]], chunk_size=2)
+        self.assertEqual(records[0]["_id"], ids[4])
+        self.assertIsNone(records[1])
+        self.assertEqual(records[2]["_id"], ids[0])
+        self.assertIs(records[3], records[0])
+        self.assertEqual(qs.stats["misses"], 3)
+
+    def test_12_QueryStructure_lazy(self):
+        doc = {
+            "species": ["Si", "Si"],
+            "cell": (np.eye(3) * 3).tolist(),
+            "positions": [[0, 0, 0], [1.5, 1.5, 1.5]],
+            "enthalpy_per_atom": -1.0,
+        }
+        _id = self.debugcol.insert_one(doc).inserted_id
+        qs = QueryStructure(self.debugcol, {"enthalpy_per_atom": 1})
+        record = qs[_id]
+        self.assertEqual(record["enthalpy_per_atom"], -1.0)
+        self.assertFalse(record.built)
+        nbytes = qs.nbytes
+        self.assertIsInstance(record["_structure_"], Structure)
+        self.assertTrue(record.built)
+        self.assertIs(record["_structure_"], record.get("_structure_"))
+        self.assertGreater(qs.nbytes, nbytes)
+
+    def test_13_TrajectoryStore(self):
+        nframes, natoms = 5, 2
+        trajectory = {
+            "nframes": nframes,
+            "cell": np.eye(3) * 3 + np.random.rand(nframes, 3, 3),
+            "positions": np.random.rand(nframes, natoms, 3),
+        }
+        doc = {
+            "species": ["Si"] * natoms,
+            "cell": trajectory["cell"][-1],
+            "positions": trajectory["positions"][-1],
+            "trajectory": trajectory,
+        }
+        _id = self.debugcol.insert_one(doc).inserted_id
+        store = TrajectoryStore(self.db, "debugtraj", chunk_size=64)
+        try:
+            self.assertEqual(store.offload(self.debugcol), 1)
+            record = self.debugcol.find_one({"_id": _id})
+            self.assertNotIn("cell", record["trajectory"])
+            arrays = store.read([record], frames=[0, -1])[_id]
+            self.assertTrue(np.allclose(arrays["cell"], trajectory["cell"][[0, -1]]))
+            qs = QueryStructure(
+                self.debugcol, None, trajectory=True, frames=[-1], trajstore=store
+            )
+            (final,) = qs[_id]["_structure_"]
+            self.assertTrue(np.allclose(final.lattice.matrix, trajectory["cell"][-1]))
+            with self.assertRaises(IndexError):
+                store.read([record], frames=[nframes])
+            # interrupted after the upload, before the raw document was updated
+            empty = {"cell": np.zeros((0, 3, 3))}
+            doc = {"material_id": "debug-empty", "trajectory": empty}
+            empty_id = self.debugcol.insert_one(doc).inserted_id
+            store.put(empty_id, empty)
+            self.assertEqual(store.offload(self.debugcol), 1)
+            record = self.debugcol.find_one({"_id": empty_id})
+            self.assertEqual(store.read([record])[empty_id]["cell"].shape, (0, 3, 3))
+        finally:
+            store.files.delete_many({})
+            store.chunks.delete_many({})
+
+    def test_14_CodecMigrator(self):
+        legacy = Binary(pickle.dumps(np.full((4, 3), np.nan), protocol=2), 0x80)
+        self.debugcol.insert_many(
+            [{"material_id": f"debug-{i:02d}", "forces": legacy} for i in range(10)]
+        )
+        migrator = CodecMigrator(self.debugcol, ArrayPolicy(), batch_size=3, nranges=2)
+        try:
+            stat = migrator.migrate(dry_run=True)
+            self.assertEqual(stat["nchanged"], 10)
+            self.assertLess(stat["new_bytes"], stat["old_bytes"])
+            self.assertEqual(self.debugcol.count_documents({"forces": legacy}), 10)
+            # a write between the read and the bulk_write is not reverted
+            reencode = migrator.reencode
+
+            def reencode_meanwhile(doc):
+                if doc["material_id"] == "debug-00":
+                    self.debugcol.update_one(
+                        {"_id": doc["_id"]}, {"$set": {"forces": np.zeros((4, 3))}}
+                    )
+                return reencode(doc)
+
+            with mock.patch.object(migrator, "reencode", reencode_meanwhile):
+                stat = migrator.migrate()
+            self.assertEqual([stat["nchanged"], stat["nskipped"]], [9, 1])
+            forces = self.debugcol.find_one({"material_id": "debug-00"})["forces"]
+            self.assertTrue(np.all(forces == 0))
+            # the skipped one is migrated by the next run
+            self.assertEqual(migrator.migrate(resume=False)["nchanged"], 1)
+            self.assertEqual(migrator.migrate(resume=False)["nchanged"], 0)
+            raw = migrator.rawcol.find_one({"material_id": "debug-01"})
+            self.assertTrue(np.isnan(decode_ndarray(raw["forces"])).all())
+        finally:
+            migrator.checkpoints.drop()
+
+    def test_15_deprecate_less_task(self):
+        docs = [
+            {
+                "material_id": f"debug-{task}-{i:02d}",
+                "trajectory": {"source_dir": f"debug-{task}"},
+                "deprecated": i < deprecated,
+            }
+            for task, n, deprecated in [("a", 3, 0), ("b", 12, 0), ("c", 11, 2)]
+            for i in range(n)
+        ]
+        self.debugcol.insert_many(docs)
+        stat = cleanup.deprecate_less_task(self.debugcol, dry_run=True)
+        self.assertEqual((stat["ntasks"], stat["nrecords"]), (2, 12))
+        self.assertEqual(self.debugcol.count_documents({"deprecated": True}), 2)
+        cleanup.deprecate_less_task(self.debugcol)
+        self.assertEqual(self.debugcol.count_documents({"deprecated": True}), 14)
+        self.assertEqual(
+            self.debugcol.count_documents({"deprecated_reason": {"$exists": True}}), 12
+        )
+        stat = cleanup.deprecate_less_task(self.debugcol, dry_run=True)
+        self.assertEqual(stat["ntasks"], 0)
+
+    def test_16_deprecate_rules(self):
+        docs = [
+            {
+                "material_id": f"debug-{i:02d}",
+                "trajectory": {"source_dir": "debug-a"},
+                "formula": "Si2",
+                "enthalpy_per_atom": -3.0 - 0.01 * i,
+                "min_distance": 1.0,
+                "deprecated": False,
+            }
+            for i in range(12)
+        ]
+        docs[0]["enthalpy_per_atom"] = -10.0  # solitary
+        docs[1]["enthalpy_per_atom"] = 610612509.0
+        docs[2]["min_distance"] = 0.3
+        self.debugcol.insert_many(docs)
+        stats = cleanup.deprecate(self.debugcol, dry_run=True)
+        self.assertEqual(self.debugcol.count_documents({"deprecated": True}), 0)
+        stats = cleanup.deprecate(self.debugcol)
+        counts = {name: stat["nrecords"] for name, stat in stats.items()}
+        self.assertEqual(
+            counts,
+            {
+                "read": 12,
+                "large_enthalpy": 1,
+                "less_task": 0,
+                "solitary": 1,
+                "min_dist": 1,
+                "write": 3,
+            },
+        )
+        record = self.debugcol.find_one({"material_id": "debug-00"})
+        self.assertEqual(
+            record["deprecated_reason"], "error enthalpy : solitary and too small"
+        )
+
+    def test_17_sync_deprecated(self):
+        enthalpies = [-3.0, -3.1, None, -3.3, -3.4, -3.5, -3.6]
+        ids = self.debugcol.insert_many(
+            [
+                {
+                    "material_id": f"debug-{i:02d}",
+                    "enthalpy_per_atom": enth,
+                    "trajectory": {"source_dir": "aaabbcd"[i]},
+                    "formula": "X",
+                }
+                for i, enth in enumerate(enthalpies)
+            ]
+        ).inserted_ids
+        uniqcol = self.db.get_collection("debugcol_uniq")
+        uniqcol.insert_many(
+            [
+                {
+                    "_id": ids[0],
+                    "version": 1,
+                    "task": "a",
+                    "members": ids[0:3],
+                    "cluster_size": 3,
+                },
+                {"_id": ids[3], "task": "b", "members": ids[3:5], "cluster_size": 2},
+                {"_id": ids[5], "task": "c", "members": ids[5:6], "cluster_size": 1},
+                {"_id": ids[6], "task": "d", "members": ids[6:7], "cluster_size": 1},
+            ]
+        )
+        finder = UniqueFinder(self.debugcol, uniqcol, write_batch_size=2)
+        try:
+            finder.maintain_indexes()
+            self.assertIn(
+                "deprecated_1_last_updated_utc_1__id_1",
+                self.debugcol.index_information(),
+            )
+            # representative, member and single-member cluster deprecated
+            self.debugcol.update_many(
+                {"_id": {"$in": [ids[0], ids[4], ids[5]]}},
+                {"$set": cleanup.deprecation("debug")},
+            )
+            stat = finder.sync_deprecated()
+            self.assertEqual(
+                [stat[key] for key in ("nrecords", "pruned", "promoted", "removed")],
+                [3, 1, 1, 1],
+            )
+            records = {record["task"]: record for record in uniqcol.find()}
+            self.assertEqual(sorted(records), ["a", "b", "d"])
+            # a null enthalpy is never the lowest
+            self.assertEqual(
+                records["a"],
+                {
+                    "_id": ids[1],
+                    "version": 1,
+                    "task": "a",
+                    "formula": "X",
+                    "members": ids[1:3],
+                    "cluster_size": 2,
+                },
+            )
+            self.assertEqual(records["b"]["members"], ids[3:4])
+            self.assertEqual(finder.sync_deprecated(lag=0)["nrecords"], 0)
+            # the lag re-reads the synced records, which changes nothing
+            self.assertEqual(finder.sync_deprecated()["nrecords"], 3)
+            self.assertEqual(
+                {record["task"]: record for record in uniqcol.find()}, records
+            )
+            self.debugcol.update_one(
+                {"_id": ids[6]}, {"$set": cleanup.deprecation("debug")}
+            )
+            self.assertEqual(finder.sync_deprecated(lag=0)["nrecords"], 1)
+            self.assertEqual(uniqcol.count_documents({}), 2)
+        finally:
+            uniqcol.drop()
+            finder.watermarks.drop()
@@ -0,0 +1,91 @@
+import unittest
+from itertools import chain
+
+import numpy as np
+
+from calypsokit.calydb.cleanup import default_rules, find_solitary
+from calypsokit.utils.itertools import groupby_delta
+
+
+def solitary_loop(sorted_enth, delta):
+    """The former loop of deprecate_solitary_enth"""
+    positions = []
+    naccumu = 0
+    for ene_group in list(groupby_delta(sorted_enth, delta))[:5]:
+        naccumu += len(ene_group)
+        if len(ene_group) >= 10:
+            break
+        elif len(ene_group) == 1:
+            positions.append(naccumu - 1)
+    return positions
+
+
+class TestFindSolitary(unittest.TestCase):
+    def test_01_cases(self):
+        cases = [
+            ([], []),
+            ([1.0], []),
+            ([1.0, 3.0], [0]),
+            ([1.0, 3.0, 5.0], [0, 1]),
+            ([1.0, 3.0, 3.5, 5.0, 7.0], [0, 3]),
+            ([float(i) for i in range(0, 20, 2)], [0, 1, 2, 3, 4]),
+            ([0.0] + [2.0] * 10 + [4.0, 6.0], [0]),
+        ]
+        for enth, expected in cases:
+            self.assertEqual(list(find_solitary([enth], 1.0)), expected)
+            self.assertEqual(solitary_loop(enth, 1.0), expected)
+
+    def test_02_same_as_loop(self):
+        rng = np.random.default_rng(0)
+        for _ in range(50):
+            groups = []
+            for _ in range(rng.integers(1, 30)):
+                size = rng.integers(0, 40)
+                steps = np.where(rng.random(size) < 0.3, 1.5, rng.random(size) * 0.2)
+                groups.append(list(np.cumsum(steps) * rng.choice([1, 5])))
+            offsets = np.cumsum([0] + [len(g) for g in groups])
+            expected = list(
+                chain.from_iterable(
+                    [offset + p for p in solitary_loop(g, 1.0)]
+                    for g, offset in zip(groups, offsets)
+                )
+            )
+            self.assertEqual(list(find_solitary(groups, 1.0)), expected)
+
+
+class TestDeprecationRules(unittest.TestCase):
+    def test_01_default_rules(self):
+        columns = {
+            "enthalpy_per_atom": np.array([-3.0, 610612509.0, -9.0, -3.05, -3.0]),
+            "min_distance": np.array([1.0, 1.0, 1.0, 0.3, np.nan]),
+            "trajectory.source_dir": np.array(["a", "a", "b", "b", "b"], dtype=object),
+            "formula": np.array(["X", "X", "X", "X", "X"], dtype=object),
+        }
+        rules = {rule.name: rule for rule in default_rules(lte=2)}
+        selected = {
+            name: list(np.flatnonzero(rule.select(columns)))
+            for name, rule in rules.items()
+        }
+        self.assertEqual(
+            selected,
+            {
+                "large_enthalpy": [1],
+                "less_task": [0, 1],
+                "solitary": [0, 2],
+                "min_dist": [3],
+            },
+        )
+
+    def test_02_solitary_null_enthalpy(self):
+        # Mongo sorts null before numbers, so does the solitary rule
+        columns = {
+            "enthalpy_per_atom": np.array([-3.0, np.nan, -5.0, -3.02]),
+            "trajectory.source_dir": np.array(["a"] * 4, dtype=object),
+            "formula": np.array(["X"] * 4, dtype=object),
+        }
+        rule = {rule.name: rule for rule in default_rules()}["solitary"]
+        mongo_order = [1, 2, 3, 0]
+        sorted_enth = [[None, -5.0, -3.02, -3.0]]
+        expected = sorted(mongo_order[i] for i in find_solitary(sorted_enth))
+        self.assertEqual(expected, [1, 2])
+        self.assertEqual(list(np.flatnonzero(rule.select(columns))), expected)
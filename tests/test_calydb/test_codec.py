@@ -0,0 +1,107 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import bson
+import numpy as np
+from pymongo import MongoClient
+
+from calypsokit.calydb.codec import (
+    MAGIC,
+    ArrayPolicy,
+    PackedArray,
+    decode_ndarray,
+    encode_ndarray,
+)
+from calypsokit.calydb.login import NumpyDatabase, login
+from calypsokit.calydb.migrate import CodecMigrator
+
+
+class TestNdarrayCodec(unittest.TestCase):
+    def test_01_roundtrip(self):
+        arrays = [
+            np.random.rand(3, 4),
+            np.asfortranarray(np.random.rand(3, 4)),
+            np.random.rand(6, 3)[::2],
+            np.arange(6, dtype=">i4").reshape(2, 3),
+            np.array(["Si", "H"]),
+            np.zeros((0, 3)),
+            np.array(3.0),
+        ]
+        for array in arrays:
+            data = encode_ndarray(array)
+            self.assertTrue(data.startswith(MAGIC))
+            decoded = decode_ndarray(data)
+            self.assertEqual(decoded.dtype, array.dtype)
+            self.assertTrue(np.array_equal(decoded, array))
+            self.assertFalse(decoded.flags.writeable)
+
+    def test_02_legacy_pickle(self):
+        array = np.random.rand(3, 3)
+        decoded = decode_ndarray(pickle.dumps(array, protocol=2))
+        self.assertTrue(np.array_equal(decoded, array))
+        objects = np.array([1, "a"], dtype=object)
+        data = encode_ndarray(objects)
+        self.assertFalse(data.startswith(MAGIC))
+        self.assertTrue(np.array_equal(decode_ndarray(data), objects))
+
+    def test_03_compact(self):
+        array = np.random.rand(100, 3).round(2)
+        for compress in ("zlib", "lzma"):
+            data = encode_ndarray(array, compress=compress)
+            self.assertLess(len(data), array.nbytes)
+            self.assertTrue(np.array_equal(decode_ndarray(data), array))
+        nan = np.full((8, 3), np.nan)
+        data = encode_ndarray(nan, constant=True)
+        self.assertLess(len(data), 100)
+        decoded = decode_ndarray(data)
+        self.assertEqual(decoded.shape, (8, 3))
+        self.assertTrue(np.isnan(decoded).all())
+
+    def test_04_policy(self):
+        policy = ArrayPolicy(
+            fields={
+                "forces": {"compress": "zlib"},
+                "trajectory.positions": {"float32": True},
+            }
+        )
+        doc = {
+            "forces": np.full((4, 3), np.nan),
+            "trajectory": {"positions": [np.random.rand(4, 3)]},
+            "natoms": 4,
+        }
+        packed = policy.apply(doc)
+        self.assertIsInstance(packed["forces"], PackedArray)
+        self.assertEqual(packed["forces"].options["compress"], "zlib")
+        self.assertEqual(packed["trajectory"]["positions"][0].array.dtype, np.float32)
+        self.assertIsInstance(doc["forces"], np.ndarray)
+        update = policy.apply_update({"$set": {"forces": doc["forces"]}})
+        self.assertIsInstance(update["$set"]["forces"], PackedArray)
+        options = NumpyDatabase.codec_options
+        decoded = bson.decode(bson.encode(packed, codec_options=options), options)
+        self.assertTrue(np.isnan(decoded["forces"]).all())
+        self.assertEqual(decoded["trajectory"]["positions"][0].dtype, np.float32)
+        self.assertEqual(decoded["natoms"], 4)
+
+
+class TestCodecMigrator(unittest.TestCase):
+    def test_01_worker_config(self):
+        db = NumpyDatabase(MongoClient(connect=False), "calydb")
+        migrator = CodecMigrator(db.raw)
+        self.assertIs(migrator._worker_config(), migrator)
+        migrator = CodecMigrator(db.raw, n_jobs=2)
+        self.assertRaises(ValueError, migrator._worker_config)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = login(
+                "localhost:27017",
+                "user",
+                "pwd",
+                "calydb",
+                dotenv_path=os.path.join(tmpdir, ".env"),
+                backend="mongodb",
+            )
+        migrator = CodecMigrator(db.raw, ArrayPolicy(compress="zlib"), n_jobs=2)
+        config = pickle.loads(pickle.dumps(migrator._worker_config()))
+        self.assertEqual(config["login_kwargs"]["dbname"], "calydb")
+        self.assertEqual(config["collections"], ["raw"])
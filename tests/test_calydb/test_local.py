@@ -0,0 +1,135 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from bson.binary import Binary
+from bson.codec_options import CodecOptions
+from pymongo import DeleteMany, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from calypsokit.calydb.codec import ArrayPolicy
+from calypsokit.calydb.local import LocalClient, LocalDatabase
+from calypsokit.calydb.login import login
+from calypsokit.calydb.patch import RawRecordPatcher
+
+
+@unittest.skipIf(importlib.util.find_spec("mongomock") is None, "needs mongomock")
+class TestLocalBackend(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = self.tmpdir.name
+        self.db = LocalClient(self.path).get_database("calydb")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_01_snapshot(self):
+        policies = {"raw": ArrayPolicy(fields={"forces": {"compress": "zlib"}})}
+        db = self.db.client.get_database("calydb", policies=policies)
+        forces = np.full((8, 3), np.nan)
+        db.raw.insert_many(
+            [
+                {"material_id": i, "cell": np.eye(3) * i, "forces": forces}
+                for i in range(5)
+            ]
+        )
+        db.raw.create_index("material_id", unique=True)
+        db.save()
+        self.assertTrue(os.path.exists(os.path.join(self.path, "calydb", "raw.bson")))
+
+        db = LocalClient(self.path).get_database("calydb")
+        self.assertEqual(db.list_collection_names(), ["raw"])
+        record = db.raw.find_one({"material_id": 3})
+        np.testing.assert_array_equal(record["cell"], np.eye(3) * 3)
+        np.testing.assert_array_equal(record["forces"], forces)
+        self.assertTrue(db.raw.index_information()["material_id_1"]["unique"])
+        raw = db.raw.with_options(codec_options=CodecOptions())
+        self.assertIsInstance(raw.find_one()["cell"], Binary)
+
+    def test_02_bulk_write(self):
+        col = self.db.raw
+        col.insert_one({"_id": 0, "n": 0})
+        with self.assertRaises(BulkWriteError):
+            col.bulk_write(
+                [InsertOne({"_id": 0}), InsertOne({"_id": 1, "n": 1})], ordered=False
+            )
+        result = col.bulk_write(
+            [
+                UpdateOne({"_id": 1}, {"$set": {"n": 10}}),
+                UpdateOne({"_id": 2}, {"$set": {"n": 2}}, upsert=True),
+                DeleteMany({"_id": 0}),
+            ]
+        )
+        self.assertEqual(
+            (result.modified_count, result.upserted_count, result.deleted_count),
+            (1, 1, 1),
+        )
+        self.assertEqual([doc["n"] for doc in col.find().sort("_id")], [10, 2])
+
+    def test_03_aggregate(self):
+        self.db.raw.insert_many(
+            [{"_id": i, "task": f"t{i % 2}", "e": float(i)} for i in range(10)]
+        )
+        self.db.uniq.insert_many([{"_id": i} for i in range(0, 10, 3)])
+        self.db.uniq.aggregate(
+            [
+                {
+                    "$lookup": {
+                        "from": "raw",
+                        "localField": "_id",
+                        "foreignField": "_id",
+                        "as": "raw",
+                    }
+                },
+                {"$unwind": "$raw"},
+                {"$project": {"task": "$raw.task"}},
+                {"$merge": {"into": "uniq", "whenNotMatched": "discard"}},
+            ]
+        )
+        tasks = [doc["task"] for doc in self.db.uniq.find().sort("_id")]
+        self.assertEqual(tasks, ["t0", "t1", "t0", "t1"])
+
+        buckets = list(
+            self.db.raw.aggregate([{"$bucketAuto": {"groupBy": "$_id", "buckets": 3}}])
+        )
+        self.assertEqual(sum(bucket["count"] for bucket in buckets), 10)
+        self.assertEqual(buckets[0]["_id"]["min"], 0)
+        self.assertEqual(buckets[-1]["_id"]["max"], 9)
+        for bucket, next_bucket in zip(buckets, buckets[1:]):
+            self.assertEqual(bucket["_id"]["max"], next_bucket["_id"]["min"])
+
+        zipped = self.db.raw.aggregate(
+            [
+                {
+                    "$group": {
+                        "_id": "$task",
+                        "ids": {"$push": "$_id"},
+                        "e": {"$push": "$e"},
+                    }
+                },
+                {"$project": {"zipped": {"$zip": {"inputs": ["$ids", "$e"]}}}},
+                {"$sort": {"_id": 1}},
+            ]
+        )
+        self.assertEqual(next(zipped)["zipped"][:2], [[0, 0.0], [2, 2.0]])
+
+    def test_04_login(self):
+        kwargs = {
+            "dbname": "calydb",
+            "dotenv_path": os.path.join(self.path, ".env"),
+            "backend": "local",
+            "local_path": self.path,
+        }
+        db = login(**kwargs)
+        self.assertIsInstance(db, LocalDatabase)
+        self.assertIs(login(**kwargs).client, db.client)
+
+    def test_05_patcher(self):
+        # a local database has no login_kwargs, it is patched in this process
+        patcher = RawRecordPatcher(self.db.raw)
+        self.assertIs(patcher._worker_config(), patcher)
+        self.assertRaises(
+            ValueError, RawRecordPatcher(self.db.raw, n_jobs=2)._worker_config
+        )
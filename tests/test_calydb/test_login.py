@@ -0,0 +1,108 @@
+import os
+import pickle
+import tempfile
+import unittest
+from unittest import mock
+
+from pymongo import MongoClient
+
+from calypsokit.calydb.login import (
+    NumpyDatabase,
+    client_options_from_env,
+    close_clients,
+    get_client,
+    login,
+    worker_config,
+    worker_object,
+)
+from calypsokit.calydb.patch import RawRecordPatcher
+
+
+class TestClientRegistry(unittest.TestCase):
+    uri = "mongodb://localhost:1"
+
+    def tearDown(self):
+        close_clients()
+
+    def test_01_one_client_per_options(self):
+        client = get_client(self.uri, connect=False)
+        self.assertIs(get_client(self.uri, connect=False), client)
+        other = get_client(self.uri, connect=False, maxPoolSize=5)
+        self.assertIsNot(other, client)
+        self.assertEqual(other.options.pool_options.max_pool_size, 5)
+        close_clients()
+        self.assertIsNot(get_client(self.uri, connect=False), client)
+
+    def test_02_options_from_env(self):
+        env = {
+            "MONGODB_MAX_POOL_SIZE": "50",
+            "MONGODB_COMPRESSORS": "zlib",
+            "MONGODB_SOCKET_TIMEOUT_MS": "",
+        }
+        with mock.patch.dict(os.environ, env, clear=True):
+            options = client_options_from_env()
+        self.assertEqual(options, {"maxPoolSize": 50, "compressors": "zlib"})
+
+
+class Holder:
+    def __init__(self, col, size=1):
+        self.col = col
+        self.size = size
+
+
+class TestWorkerObject(unittest.TestCase):
+    def tearDown(self):
+        close_clients()
+
+    def test_01_config(self):
+        db = NumpyDatabase(MongoClient(connect=False), "calydb")
+        holder = Holder(db.rawcol)
+        self.assertIs(worker_config(holder, "t", [holder.col], {}), holder)
+        self.assertIs(worker_object(holder), holder)
+        self.assertRaises(
+            ValueError, worker_config, holder, "t", [holder.col], {}, n_jobs=2
+        )
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = login(
+                "localhost:1",
+                "user",
+                "pwd",
+                "calydb",
+                dotenv_path=os.path.join(tmpdir, ".env"),
+                backend="mongodb",
+            )
+            holder = Holder(db.rawcol, size=2)
+            config = worker_config(holder, "t", [holder.col], {"size": 2}, n_jobs=2)
+            config = pickle.loads(pickle.dumps(config))
+            copy = worker_object(config)
+        self.assertIs(worker_object(config), copy)
+        self.assertEqual(copy.col.full_name, "calydb.rawcol")
+        self.assertEqual(copy.size, 2)
+
+
+class TestRawRecordPatcher(unittest.TestCase):
+    def tearDown(self):
+        close_clients()
+
+    def test_01_worker_config(self):
+        db = NumpyDatabase(MongoClient(connect=False), "calydb")
+        patcher = RawRecordPatcher(db.rawcol)
+        self.assertIs(patcher._worker_config(), patcher)
+        patcher = RawRecordPatcher(db.rawcol, n_jobs=2)
+        self.assertRaises(ValueError, patcher.parallel_patch, "cif", dict)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = login(
+                "localhost:1",
+                "user",
+                "pwd",
+                "calydb",
+                dotenv_path=os.path.join(tmpdir, ".env"),
+                backend="mongodb",
+            )
+            patcher = RawRecordPatcher(db.rawcol, chunk_size=10, n_jobs=2)
+            config = pickle.loads(pickle.dumps(patcher._worker_config()))
+            self.assertEqual(config["login_kwargs"]["dbname"], "calydb")
+            worker = worker_object(config)
+        self.assertIs(worker_object(config), worker)
+        self.assertEqual(worker.rawcol.full_name, "calydb.rawcol")
+        self.assertEqual(worker.chunk_size, 10)
@@ -2,7 +2,7 @@ import unittest
 
 import numpy as np
 
-from calypsokit.utils.itertools import groupby_delta, pairwise
+from calypsokit.utils.itertools import groupby_delta, pairwise, prefetched
 
 
 class TestIterTools(unittest.TestCase):
@@ -20,3 +20,18 @@ class TestIterTools(unittest.TestCase):
         it = []
         for i in groupby_delta(it, 1):
             print(i)
+
+    def test_03_prefetched(self):
+        self.assertEqual(list(prefetched(range(10), 3, 2)), list(range(10)))
+        self.assertEqual(list(prefetched([], 3, 2)), [])
+        # stop early, the background thread must not block
+        it = prefetched(range(100), 1, 1)
+        self.assertEqual(next(it), 0)
+        it.close()
+
+        def broken():
+            yield 1
+            raise RuntimeError("broken")
+
+        with self.assertRaises(RuntimeError):
+            list(prefetched(broken(), 1, 2))
@@ -0,0 +1,20 @@
+import unittest
+
+from calypsokit.utils.unionfind import UnionFind
+
+
+class TestUnionFind(unittest.TestCase):
+    def test_01_union(self):
+        uf = UnionFind(["a", "b", "c", "d"])
+        self.assertEqual(uf.union("a", "b"), "a")
+        self.assertEqual(uf.union("c", "d"), "c")
+        self.assertEqual(uf.union("b", "d"), "a")
+        self.assertEqual(uf.find("d"), "a")
+        self.assertEqual(uf.groups(), {"a": ["a", "b", "c", "d"]})
+
+    def test_02_add(self):
+        uf = UnionFind()
+        uf.add("x")
+        uf.add("x")
+        uf.add("y")
+        self.assertEqual(uf.groups(), {"x": ["x"], "y": ["y"]})